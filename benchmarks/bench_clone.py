@@ -0,0 +1,53 @@
+"""
+Benchmark of the clone modes.
+
+Clones the same repo in every mode, mines the same commit window and reports the time and the size on disk
+of each mode and what it saves compared to the full clone.
+
+Usage: python -m benchmarks.bench_clone --clone_url https://github.com/psf/requests.git --max_commits 200
+"""
+from pathlib import Path
+import shutil
+import tempfile
+import time
+
+import click
+
+from similar_dev_search.data.constants import BUILD_PATH
+from similar_dev_search.data.models import CloneOptions, CommitFilter
+from similar_dev_search.services.git import GitService, RepositoryProvider
+
+modes = {
+    "full": CloneOptions(),
+    "bare": CloneOptions(bare=True),
+    "blobless": CloneOptions(bare=True, blobless=True),
+    "shallow": CloneOptions(bare=True, shallow=True),
+    "blobless+shallow": CloneOptions(bare=True, blobless=True, shallow=True),
+}
+
+
+@click.command()
+@click.option('--clone_url', required=True, help='Url of the cloned repo')
+@click.option('--max_commits', default=200, help='Number of mined commits')
+@click.option('--build_path', default=BUILD_PATH, help='Path to the tree-sitter build library')
+def main(clone_url: str, max_commits: int, build_path: str) -> None:
+    commit_filter = CommitFilter(max_commits=max_commits)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for mode, clone_options in modes.items():
+            path = str(Path(directory, mode))
+            stats = GitService.clone_repo(clone_url, path, clone_options=clone_options, commit_filter=commit_filter)
+            start = time.perf_counter()
+            commits = len(list(RepositoryProvider(path).iter_commits(build_path, commit_filter)))
+            mine_seconds = time.perf_counter() - start
+            results[mode] = (stats.seconds, GitService.get_size(path), mine_seconds, commits)
+            shutil.rmtree(path)
+    full_seconds, full_size, _, _ = results["full"]
+    print(f"{'mode':>18} {'clone s':>9} {'MB':>9} {'mine s':>9} {'commits':>8} {'saved s':>9} {'saved MB':>9}")
+    for mode, (seconds, size, mine_seconds, commits) in results.items():
+        print(f"{mode:>18} {seconds:9.2f} {size / 2 ** 20:9.1f} {mine_seconds:9.2f} {commits:8d} "
+              f"{full_seconds - seconds:9.2f} {(full_size - size) / 2 ** 20:9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Micro-benchmark of the per-file tree-sitter overhead.
+
+Compares the per-call path (the grammar is loaded, a parser is created and both queries are compiled
+for every file) with the TreeSitterRegistry path.
+
+Usage: python -m benchmarks.bench_tree_sitter --build_path build/ --language python --files 500
+"""
+import time
+
+import click
+from tree_sitter import Language, Parser
+
+from similar_dev_search.data.constants import BUILD_PATH
+from similar_dev_search.services.code_parser import CodeEntitiesParser, queries
+
+samples = {
+    "python": """
+import os
+from collections import defaultdict
+
+
+class Counter:
+    def add(self, key):
+        value = defaultdict(int)
+        value[key] += 1
+        return os.path.join(key, str(value))
+""",
+    "java": """
+package org.example;
+
+import java.util.List;
+
+public class Counter {
+    private int value;
+
+    public void add(List<String> keys) {
+        int size = keys.size();
+        value += size;
+    }
+}
+""",
+    "javascript": """
+import { readFile } from 'fs';
+
+class Counter {
+    add(key) {
+        let value = 0;
+        value = readFile(key);
+        return value;
+    }
+}
+""",
+}
+
+
+def parse_uncached(language: str, code: bytes, tree_sitter_build_path: str) -> dict:
+    parser = Parser()
+    parser.set_language(Language(tree_sitter_build_path + "my-languages.so", language))
+    tree = parser.parse(code)
+    parse_lang = Language(tree_sitter_build_path + "my-languages.so", language)
+    result = {}
+    for key, query_str in zip(["imports", "names"], queries[language]):
+        query = parse_lang.query(query_str)
+        result[key] = list(set([code[x[0].start_byte: x[0].end_byte].decode() for x in query.captures(tree.root_node)]))
+    return result
+
+
+def parse_registry(language: str, code: bytes, tree_sitter_build_path: str) -> dict:
+    return CodeEntitiesParser.go_parse(language, code, tree_sitter_build_path)
+
+
+def measure(function, language: str, code: bytes, tree_sitter_build_path: str, files: int) -> float:
+    start = time.perf_counter()
+    for _ in range(files):
+        function(language, code, tree_sitter_build_path)
+    return (time.perf_counter() - start) / files
+
+
+@click.command()
+@click.option('--build_path', default=BUILD_PATH, help='Path to the tree-sitter build library')
+@click.option('--language', default='python', type=click.Choice(sorted(samples.keys())), help='Language to parse')
+@click.option('--files', default=500, help='Number of parsed files')
+@click.option('--repeat', default=1, help='Number of times the sample is repeated in a file')
+def main(build_path: str, language: str, files: int, repeat: int) -> None:
+    code = bytes(samples[language] * repeat, "utf8")
+    uncached = measure(parse_uncached, language, code, build_path, files)
+    registry = measure(parse_registry, language, code, build_path, files)
+    print(f"{language}, {len(code)} bytes per file, {files} files")
+    print(f"per-call setup: {uncached * 1e6:10.1f} us/file")
+    print(f"registry:       {registry * 1e6:10.1f} us/file")
+    print(f"speedup:        {uncached / registry:10.2f}x")
+
+
+if __name__ == '__main__':
+    main()
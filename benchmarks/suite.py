@@ -0,0 +1,178 @@
+"""
+Benchmark suite of the mining and search hot paths on synthetic data.
+
+Every benchmark runs at the selected scales and the results are written to a json file. Passing the file
+of a previous run to --compare prints the ratio of the timings, so regressions are visible between versions.
+
+Usage: python -m benchmarks.suite --scale small --scale medium --output bench.json --compare old_bench.json
+"""
+from contextlib import redirect_stderr, redirect_stdout
+import io
+import json
+import os
+from pathlib import Path
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+
+import click
+
+from benchmarks.synthetic import extensions, generate_repository, generate_users_dict, SyntheticFile
+from similar_dev_search.data.constants import BUILD_PATH, TREE_SITTER_LIBRARY
+from similar_dev_search.data.models import EncodedChange
+from similar_dev_search.services.code_parser import CodeEntitiesParser
+from similar_dev_search.services.git import RepositoryProvider
+from similar_dev_search.services.user_vectors import UserVectorService
+from similar_dev_search.services.vocabulary import FeatureVocabulary
+
+scales = {
+    "small": {"commits": 50, "files": 20, "authors": 5, "users": 1000},
+    "medium": {"commits": 200, "files": 100, "authors": 20, "users": 10000},
+    "large": {"commits": 1000, "files": 500, "authors": 50, "users": 100000},
+}
+
+
+def measure(function, repeat: int) -> dict:
+    """
+    Run a function several times.
+
+    :param function: The function without arguments.
+    :param repeat: Number of runs.
+    :return: Min and median time in seconds and the result of the last run.
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+            result = function()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times), "result": result}
+
+
+def bench_get_repository(directory: str, scale: dict, build_path: str, repeat: int) -> dict:
+    path = generate_repository(os.path.join(directory, "repo"), scale["commits"], scale["files"],
+                               n_authors=scale["authors"])
+    timing = measure(lambda: RepositoryProvider(path).get_repository(build_path), repeat)
+    repository = timing.pop("result")
+    changes = sum(len(commit.changes) for commit in repository.commits)
+    return {**timing, "commits": len(repository.commits), "changes": changes,
+            "commits_per_second": len(repository.commits) / timing["median"]}
+
+
+def bench_parse_file(scale: dict, build_path: str, repeat: int) -> dict:
+    rng = random.Random(0)
+    result = {}
+    for language in sorted(extensions):
+        code = SyntheticFile(language, rng, ["user", "repo", "name"], scale["files"]).get_content().decode()
+        timing = measure(lambda: CodeEntitiesParser.parse_file([language], code, build_path), repeat)
+        timing.pop("result")
+        result[language] = {**timing, "bytes": len(code)}
+    return result
+
+
+def encode_change(vocabulary: FeatureVocabulary, change: dict) -> dict:
+    language_id, variable_ids, import_ids = vocabulary.encode_names(
+        change["language"], change["variable_names"], change["import_names"])
+    return vars(EncodedChange("", language_id, change["deletions"], change["additions"], variable_ids, import_ids))
+
+
+def bench_users(directory: str, scale: dict, repeat: int) -> dict:
+    users = generate_users_dict(scale["users"])
+    repositories = [{"commits": [
+        {"author": name, "changes": [{"language": "Python", "additions": 1, "deletions": 0,
+                                      "variable_names": [key[3:] for key in features if key.startswith("v__")],
+                                      "import_names": []}]}
+        for name, features in users.items()]}]
+    users_dict = measure(lambda: UserVectorService.get_users_dict(repositories), repeat)
+    users_dict.pop("result")
+    vocabulary = FeatureVocabulary(os.path.join(directory, "vocabulary.sqlite"))
+    encoded = [{"author": commit["author"], "changes": [encode_change(vocabulary, change) for change in commit["changes"]]}
+               for commit in repositories[0]["commits"]]
+    feature_counts = measure(lambda: UserVectorService.get_commits_counts(encoded, vocabulary), repeat)
+    counts = feature_counts.pop("result")
+    names = vocabulary.get_names()
+    counts_vectors = measure(lambda: UserVectorService.get_counts_vectors(counts, names), repeat)
+    counts_vectors.pop("result")
+    users_pandas = measure(lambda: UserVectorService.get_users_pandas(users), repeat)
+    users_pandas.pop("result")
+    vectors = UserVectorService.get_normalized(UserVectorService.get_user_vectors(users))
+    name = vectors.authors[0]
+    similar_dev = measure(lambda: UserVectorService.get_similar_dev(vectors, name, 20), max(repeat, 5))
+    similar_dev.pop("result")
+    return {"get_users_dict": users_dict, "get_users_pandas": users_pandas, "get_commits_counts": feature_counts,
+            "get_counts_vectors": counts_vectors, "get_similar_dev": similar_dev, "users": len(users),
+            "features": vectors.matrix.shape[1]}
+
+
+def get_version() -> str:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def flatten(results: dict, prefix: str = "") -> {str: float}:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        elif key == "median":
+            flat[prefix.rstrip(".")] = value
+    return flat
+
+
+def compare(results: dict, baseline_path: str) -> None:
+    with open(baseline_path, "r") as f:
+        baseline = flatten(json.loads(f.read())["results"])
+    current = flatten(results)
+    print(f"{'benchmark':<50} {'baseline s':>12} {'current s':>12} {'ratio':>8}")
+    for name in sorted(current.keys() & baseline.keys()):
+        print(f"{name:<50} {baseline[name]:12.4f} {current[name]:12.4f} {current[name] / baseline[name]:8.2f}")
+
+
+@click.command()
+@click.option('--scale', 'selected_scales', multiple=True, type=click.Choice(list(scales)), default=["small"],
+              help='Scale to run, can be repeated')
+@click.option('--build_path', default=BUILD_PATH, help='Path to the tree-sitter build library')
+@click.option('--repeat', default=3, help='Number of runs of every benchmark')
+@click.option('--output', default='bench.json', help='Path to the json file with the results')
+@click.option('--compare', 'baseline_path', default=None, help='Json file of a previous run to compare with')
+def main(selected_scales: [str], build_path: str, repeat: int, output: str, baseline_path: str) -> None:
+    has_grammars = os.path.exists(build_path + TREE_SITTER_LIBRARY)
+    if not has_grammars:
+        print(f"No tree-sitter library in {build_path}, parsing benchmarks are skipped and mining doesn't parse code")
+    results = {}
+    for scale_name in selected_scales:
+        scale = scales[scale_name]
+        print(f"Running {scale_name}: {scale}")
+        with tempfile.TemporaryDirectory() as directory:
+            results[scale_name] = {"get_repository": bench_get_repository(directory, scale, build_path, repeat)}
+            if has_grammars:
+                results[scale_name]["parse_file"] = bench_parse_file(scale, build_path, repeat)
+            results[scale_name].update(bench_users(directory, scale, repeat))
+    report = {
+        "version": get_version(),
+        "created": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "has_grammars": has_grammars,
+        "scales": {name: scales[name] for name in selected_scales},
+        "results": results,
+    }
+    with open(output, "w") as f:
+        f.write(json.dumps(report, indent=2))
+    print(f"Results are written to {output}")
+    if baseline_path:
+        compare(results, baseline_path)
+    else:
+        for name, value in sorted(flatten(results).items()):
+            print(f"{name:<50} {value:12.4f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""
+Generator of synthetic git repositories and developer features for benchmarks.
+
+Repositories are written with dulwich directly into a bare repo, so no network and no git binary are needed.
+Every author prefers one language and a part of the identifier vocabulary, so mined developers have
+distinguishable vectors. The output only depends on the arguments and the seed.
+"""
+from collections import Counter
+import random
+
+from dulwich.index import commit_tree
+from dulwich.objects import Blob, Commit
+from dulwich.repo import Repo
+
+extensions = {"python": "py", "java": "java", "javascript": "js"}
+
+words = ["user", "repo", "commit", "file", "tree", "node", "path", "name", "value", "count", "index", "item", "cache",
+         "query", "vector", "score", "token", "parser", "buffer", "stream", "config", "result", "error", "event"]
+modules = ["os", "json", "math", "time", "random", "collections", "itertools", "functools", "pathlib", "typing"]
+
+
+def get_identifier(rng: random.Random, vocabulary: [str]) -> str:
+    return rng.choice(vocabulary) + "_" + rng.choice(vocabulary)
+
+
+def get_class_name(rng: random.Random, vocabulary: [str]) -> str:
+    return rng.choice(vocabulary).capitalize() + rng.choice(vocabulary).capitalize()
+
+
+def get_header(language: str, rng: random.Random, vocabulary: [str]) -> [str]:
+    if language == "python":
+        return [f"import {rng.choice(modules)}", f"from {rng.choice(modules)} import {get_identifier(rng, vocabulary)}", ""]
+    if language == "java":
+        return [f"import java.util.{get_class_name(rng, vocabulary)};", "",
+                f"public class {get_class_name(rng, vocabulary)} {{"]
+    return [f"import {{ {get_identifier(rng, vocabulary)} }} from '{rng.choice(modules)}';", ""]
+
+
+def get_footer(language: str) -> [str]:
+    return ["}"] if language == "java" else []
+
+
+def get_body(language: str, rng: random.Random, vocabulary: [str]) -> [str]:
+    name, arg, var = (get_identifier(rng, vocabulary) for _ in range(3))
+    if language == "python":
+        return [f"def {name}({arg}):", f"    {var} = {arg} + 1", f"    return {var}", ""]
+    if language == "java":
+        return [f"    public int {name}(int {arg}) {{", f"        int {var} = {arg} + 1;", f"        return {var};", "    }"]
+    return [f"function {name}({arg}) {{", f"    let {var} = {arg} + 1;", f"    return {var};", "}"]
+
+
+class SyntheticFile:
+    def __init__(self, language: str, rng: random.Random, vocabulary: [str], functions: int) -> None:
+        self.language = language
+        self.header = get_header(language, rng, vocabulary)
+        self.body = [line for _ in range(functions) for line in get_body(language, rng, vocabulary)]
+        self.footer = get_footer(language)
+
+    def modify(self, rng: random.Random, vocabulary: [str]) -> None:
+        """
+        Add a function and remove another one, if there are any.
+        """
+        if self.body and rng.random() < 0.5:
+            start = rng.randrange(0, len(self.body) // 4) * 4
+            del self.body[start:start + 4]
+        start = rng.randrange(0, len(self.body) // 4 + 1) * 4
+        self.body[start:start] = get_body(self.language, rng, vocabulary)
+
+    def get_content(self) -> bytes:
+        return ("\n".join(self.header + self.body + self.footer) + "\n").encode()
+
+
+def generate_repository(path: str, n_commits: int = 100, n_files: int = 20, languages: [str] = None,
+                        n_authors: int = 5, functions_per_file: int = 10, seed: int = 0) -> str:
+    """
+    Generate a bare git repository with a linear history.
+
+    :param path: Path to the new repository.
+    :param n_commits: Number of commits.
+    :param n_files: Number of files the history converges to.
+    :param languages: Languages of the files, all supported languages by default.
+    :param n_authors: Number of commit authors.
+    :param functions_per_file: Number of functions in a new file.
+    :param seed: Seed of the generator.
+    :return: Path to the repository.
+    """
+    rng = random.Random(seed)
+    languages = languages or sorted(extensions)
+    r = Repo.init_bare(path, mkdir=True)
+    authors = [(f"Developer {i} <dev{i}@example.com>".encode(), languages[i % len(languages)],
+                rng.sample(words, len(words) // 2)) for i in range(n_authors)]
+    files = {}
+    blobs = {}
+    parents = []
+    for i in range(n_commits):
+        author, language, vocabulary = rng.choice(authors)
+        for _ in range(rng.randint(1, 3)):
+            own_files = [p for p, f in files.items() if f.language == language]
+            if len(files) < n_files and (not own_files or rng.random() < 0.3):
+                file_path = f"src/{language}/{get_identifier(rng, vocabulary)}_{i}.{extensions[language]}"
+                files[file_path] = SyntheticFile(language, rng, vocabulary, functions_per_file)
+            elif own_files:
+                file_path = rng.choice(own_files)
+                files[file_path].modify(rng, vocabulary)
+            else:
+                continue
+            blob = Blob.from_string(files[file_path].get_content())
+            r.object_store.add_object(blob)
+            blobs[file_path] = blob.id
+        commit = Commit()
+        commit.tree = commit_tree(r.object_store, [(p.encode(), blob_id, 0o100644) for p, blob_id in blobs.items()])
+        commit.parents = parents
+        commit.author = commit.committer = author
+        commit.author_time = commit.commit_time = 1600000000 + i * 3600
+        commit.author_timezone = commit.commit_timezone = 0
+        commit.message = f"Commit {i}\n".encode()
+        r.object_store.add_object(commit)
+        parents = [commit.id]
+    r.refs[b"refs/heads/master"] = parents[0]
+    r.refs.set_symbolic_ref(b"HEAD", b"refs/heads/master")
+    return path
+
+
+def generate_users_dict(n_users: int, n_features: int = 5000, features_per_user: int = 100, seed: int = 0) -> dict:
+    """
+    Generate features of developers in the form of UserVectorService.get_users_dict.
+    Feature popularity follows a Zipf-like distribution, as identifiers do in real code.
+
+    :param n_users: Number of developers.
+    :param n_features: Number of distinct features.
+    :param features_per_user: Number of features of a developer.
+    :param seed: Seed of the generator.
+    :return: Dict of the developer name and the feature counter.
+    """
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(n_features)]
+    names = [f"v__{rng.choice(words)}_{rank}" for rank in range(n_features)]
+    users = {}
+    for i in range(n_users):
+        user = Counter()
+        for name in rng.choices(names, weights, k=features_per_user):
+            user[name] += 10
+        user["a__" + rng.choice(sorted(extensions))] += rng.randint(1, 1000)
+        users[f"Developer {i} <dev{i}@example.com>"] = user
+    return users
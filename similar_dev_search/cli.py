@@ -1,13 +1,27 @@
+from collections import Counter
+from datetime import datetime
+
 import click
-from joblib import Parallel, delayed
 from prettytable import PrettyTable
+import tqdm
 
-from cli_utils.fetch_repos import find_repos, handle_repo
-from cli_utils.get_similar_devs import get_user_vectors_dataframe
-from data.constants import BUILD_PATH, JSONS_PATH, N_JOBS, REPOS_PATH
-from services.file_system import FileSystemService
+from cli_utils import get_similar_devs
+from cli_utils.fetch_repos import iter_repos, mine_repos_pipeline
+from cli_utils.serve import SearchEngine, serve as serve_engine
+from data.constants import ANN_N_BITS, ANN_N_PROBES, ANN_N_TABLES, BUILD_PATH, COLUMNAR_PATH, CPU_WORKERS, GITHUB_BASE_URL, \
+    GITHUB_CACHE_MAX_BYTES, GITHUB_CACHE_PATH, GITHUB_CACHE_TTL, GITHUB_N_THREADS, HASHING_N_FEATURES, INDEX_PATH, \
+    IO_WORKERS, JSONS_PATH, KNN_BLOCK_SIZE, KNN_GRAPH_PATH, MAX_FILE_BYTES, N_JOBS, OUTPUT_FORMATS, PARSE_CACHE_MAX_BYTES, \
+    PARSE_CACHE_PATH, PIPELINE_QUEUE_SIZE, QUEUE_LEASE_SECONDS, QUEUE_PATH, REPOS_PATH, SERVE_CACHE_SIZE, SERVE_HOST, \
+    SERVE_MAX_BATCH, SERVE_PORT, SERVE_RELOAD_SECONDS, STATE_PATH, VOCABULARY_PATH
+from data.models import CloneOptions, CommitFilter, MiningOptions
+from services.ann import LshIndex
+from services.cache import HttpCache
+from services.columnar import ColumnarService
+from services.file_system import JsonService
 from services.user_vectors import UserVectorService
-from similar_dev_search.services.git import GitService
+from services.work_queue import WorkQueue
+from similar_dev_search.services.git import GithubService, GitService
+from similar_dev_search.services.profiler import profiler
 from similar_dev_search.services.setup import setup
 
 
@@ -16,6 +30,33 @@ def cli():
     pass
 
 
+def print_counters(counters: Counter) -> None:
+    table = PrettyTable(['Files', 'Count'])
+    table.align = "r"
+    for stage, count in sorted(counters.items()):
+        table.add_row([stage, count])
+    print(table)
+
+
+def save_profile(profile_path: str) -> None:
+    """
+    Print the stage totals and save them with the cProfile dumps if they are enabled.
+
+    :param profile_path: Path to the json report.
+    """
+    table = PrettyTable(['Stage', 'Calls', 'Items', 'MB', 'Wall s', 'CPU s', 'Self wall s', 'Self CPU s'])
+    table.align = "r"
+    for stage, stats in profiler.get_report().items():
+        table.add_row([stage, stats["calls"], stats["items"], round(stats["size"] / 2 ** 20, 1), round(stats["wall"], 2),
+                       round(stats["cpu"], 2), round(stats["self_wall"], 2), round(stats["self_cpu"], 2)])
+    print(table)
+    profiler.save_report(profile_path)
+    print(f"Profile saved to {profile_path}")
+    if profiler.pstats_path is not None:
+        for path in profiler.save_pstats():
+            print(f"Stage profile saved to {path}")
+
+
 @cli.command()
 @click.option('--username', default='scikit-learn', help='Username for start repo')
 @click.option('--reponame', default='scikit-learn', help='Start repo name')
@@ -26,45 +67,272 @@ def cli():
 @click.option('--build_path', default=BUILD_PATH, help='Path to the tree-sitter build library')
 @click.option('--jsons_path', default=JSONS_PATH, help='Path to the json files')
 @click.option('--repos_path', default=REPOS_PATH, help='Path to the repos')
-@click.option('--n_jobs', default=N_JOBS, help='Number of jobs')
+@click.option('--cpu_workers', '--n_jobs', 'cpu_workers', default=CPU_WORKERS, help='Number of mining processes')
+@click.option('--io_workers', default=IO_WORKERS, help='Number of threads cloning repos')
+@click.option('--queue_size', default=PIPELINE_QUEUE_SIZE, help='Number of repos waiting between the pipeline stages')
+@click.option('--parse_cache_path', default=PARSE_CACHE_PATH, help='Path to the parse cache database')
+@click.option('--parse_cache_size_mb', default=PARSE_CACHE_MAX_BYTES // 1024 // 1024, help='Max size of the parse cache')
+@click.option('--since', type=click.DateTime(), default=None, help='Mine only commits made after the date')
+@click.option('--until', type=click.DateTime(), default=None, help='Mine only commits made before the date')
+@click.option('--max_commits', type=int, default=None, help='Max number of walked commits per repo')
+@click.option('--branch', 'branches', multiple=True, help='Branch to mine, can be repeated (default: HEAD)')
+@click.option('--state_path', default=STATE_PATH, help='Path to the mining watermarks')
+@click.option('--refresh', is_flag=True, help='Fetch already mined repos and mine only new commits')
+@click.option('--output_format', default='json', type=click.Choice(OUTPUT_FORMATS), help='Format of mined commits')
+@click.option('--columnar_path', default=COLUMNAR_PATH, help='Path to the columnar repositories')
+@click.option('--vocabulary_path', default=VOCABULARY_PATH, help='Path to the feature vocabulary database')
+@click.option('--chunk_size', default=0, help='Commits per mining task (0: one task per repo)')
+@click.option('--queue_path', default=QUEUE_PATH, help='Path to the work queue database shared by the mining workers')
+@click.option('--lease_seconds', default=QUEUE_LEASE_SECONDS, help='Seconds a task of a stopped worker stays claimed')
+@click.option('--grammar', 'grammars', multiple=True,
+              help='Tree-sitter grammar of java, javascript or python as a name or name=url, optionally pinned by '
+                   '#revision, can be repeated (default: all three at the commits recorded in the build path)')
+@click.option('--max_file_size_kb', default=MAX_FILE_BYTES // 1024, help='Files larger than this are not mined')
+@click.option('--bare', is_flag=True, help='Clone repos without a working tree')
+@click.option('--blobless', is_flag=True, help='Clone repos without blobs, fetching the mined ones on demand')
+@click.option('--shallow', is_flag=True, help='Clone only the commits selected by --max_commits and --since')
+@click.option('--github_url', default=GITHUB_BASE_URL, help='Base URL of the GitHub API')
+@click.option('--github_threads', default=GITHUB_N_THREADS, help='Number of concurrent GitHub API calls')
+@click.option('--github_cache_path', default=GITHUB_CACHE_PATH, help='Path to the GitHub response cache database')
+@click.option('--github_cache_ttl', default=GITHUB_CACHE_TTL, help='Seconds a cached response is used without revalidation')
+@click.option('--github_cache_size_mb', default=GITHUB_CACHE_MAX_BYTES // 1024 // 1024, help='Max size of the GitHub cache')
+@click.option('--no_github_cache', is_flag=True, help='Always request the GitHub API')
+@click.option('--profile', 'profile_path', default=None, help='Json file to save time, items and bytes of every stage to')
+@click.option('--profile_pstats', default=None, help='Directory to save a cProfile pstats file of every stage to')
 def fetch_repos(username: str, reponame: str, max_repos: int, max_depth: int, max_top_starred_repos: int,
-                max_contributors: int, build_path: str, jsons_path: str, repos_path: str, n_jobs: int) -> None:
-    print("Searching repositories...")
-    repos_list = list(find_repos(
+                max_contributors: int, build_path: str, jsons_path: str, repos_path: str, cpu_workers: int,
+                io_workers: int, queue_size: int, parse_cache_path: str, parse_cache_size_mb: int, since: datetime,
+                until: datetime, max_commits: int, branches: [str], state_path: str, refresh: bool, output_format: str,
+                columnar_path: str, vocabulary_path: str, chunk_size: int, queue_path: str, lease_seconds: int,
+                grammars: [str], max_file_size_kb: int, bare: bool, blobless: bool, shallow: bool, github_url: str,
+                github_threads: int, github_cache_path: str, github_cache_ttl: int, github_cache_size_mb: int,
+                no_github_cache: bool, profile_path: str, profile_pstats: str) -> None:
+    profiler.configure(profile_pstats)
+    print("Setup tree-sitter...")
+    gs = GitService()
+    setup(gs, list(grammars), build_path)
+    print("Setup done...")
+    commit_filter = CommitFilter(
+        since=int(since.timestamp()) if since else None,
+        until=int(until.timestamp()) if until else None,
+        max_commits=max_commits,
+        branches=list(branches))
+    options = MiningOptions(
+        build_path,
+        jsons_path,
+        parse_cache_path,
+        parse_cache_size_mb * 1024 * 1024,
+        commit_filter,
+        state_path,
+        refresh,
+        output_format,
+        columnar_path,
+        CloneOptions(bare, blobless, shallow),
+        max_file_size_kb * 1024,
+        vocabulary_path)
+    work_queue = WorkQueue(queue_path, lease_seconds)
+    work_queue.set_meta("config", {"options": options, "repos_path": repos_path, "chunk_size": chunk_size,
+                                   "grammars": list(grammars)})
+    if refresh:
+        work_queue.requeue_done()
+    print("Searching and mining repositories...")
+    github_cache = None
+    if not no_github_cache:
+        github_cache = HttpCache(github_cache_path, github_cache_ttl, github_cache_size_mb * 1024 * 1024)
+    repos = iter_repos(
         username,
         reponame,
         max_depth=max_depth,
         max_top_starred_repos=max_top_starred_repos,
-        max_contributors=max_contributors))
-    print("Searching done...")
+        max_contributors=max_contributors,
+        github_service=GithubService(github_url, pool_size=github_threads, cache=github_cache),
+        n_threads=github_threads)
+    search = {"username": username, "reponame": reponame, "max_depth": max_depth,
+              "max_top_starred_repos": max_top_starred_repos, "max_contributors": max_contributors,
+              "github_url": github_url}
+    counters = mine_repos_pipeline(
+        repos, max_repos, repos_path, options, work_queue, io_workers, cpu_workers, chunk_size, queue_size, search)
+    print()
+    print_counters(counters)
+    if profile_path:
+        save_profile(profile_path)
+
+
+@cli.command()
+@click.option('--queue_path', default=QUEUE_PATH, help='Path to the work queue database created by fetch-repos')
+@click.option('--lease_seconds', default=QUEUE_LEASE_SECONDS, help='Seconds a task of a stopped worker stays claimed')
+@click.option('--cpu_workers', '--n_jobs', 'cpu_workers', default=CPU_WORKERS, help='Number of mining processes')
+@click.option('--io_workers', default=IO_WORKERS, help='Number of threads cloning repos')
+@click.option('--queue_size', default=PIPELINE_QUEUE_SIZE, help='Number of repos waiting between the pipeline stages')
+@click.option('--profile', 'profile_path', default=None, help='Json file to save time, items and bytes of every stage to')
+@click.option('--profile_pstats', default=None, help='Directory to save a cProfile pstats file of every stage to')
+def mine_worker(queue_path: str, lease_seconds: int, cpu_workers: int, io_workers: int, queue_size: int,
+                profile_path: str, profile_pstats: str) -> None:
+    """
+    Mine the repos of a work queue created by fetch-repos with its options, e.g. on another machine
+    sharing the filesystem or after fetch-repos stopped.
+    """
+    profiler.configure(profile_pstats)
+    work_queue = WorkQueue(queue_path, lease_seconds)
+    config = work_queue.get_meta("config")
+    if config is None:
+        raise click.ClickException(f"No fetch-repos configuration in {queue_path}")
+    options = config["options"]
     print("Setup tree-sitter...")
-    gs = GitService()
-    setup(gs)
+    setup(GitService(), config["grammars"], options.tree_sitter_build_path)
     print("Setup done...")
-    repositories_count = FileSystemService.get_file_count(jsons_path)
-    Parallel(n_jobs=n_jobs)(
-        delayed(handle_repo)(
-            repo.owner.login,
-            repo.name,
-            repos_path + repo.name,
-            build_path,
-            jsons_path)
-        for repo in repos_list[:max(0, max_repos - repositories_count + 1)]
-    )
+    print("Mining repositories...")
+    counters = mine_repos_pipeline(None, 0, config["repos_path"], options, work_queue, io_workers, cpu_workers,
+                                   config["chunk_size"], queue_size)
+    print()
+    print_counters(counters)
+    if profile_path:
+        save_profile(profile_path)
+
+
+@cli.command()
+@click.option('--build_path', default=BUILD_PATH, help='Path to the tree-sitter build library')
+@click.option('--grammar', 'grammars', multiple=True,
+              help='Tree-sitter grammar of java, javascript or python as a name or name=url, optionally pinned by '
+                   '#revision, can be repeated (default: all three at the commits recorded in the build path)')
+def build_grammars(build_path: str, grammars: [str]) -> None:
+    built = setup(GitService(), list(grammars), build_path)
+    print("Tree-sitter library built" if built else "Tree-sitter library is up to date")
+
+
+@cli.command()
+@click.option('--jsons_path', default=JSONS_PATH, help='Path to the json files')
+@click.option('--columnar_path', default=COLUMNAR_PATH, help='Path to the columnar repositories')
+def convert_jsons(jsons_path: str, columnar_path: str) -> None:
+    paths = list(JsonService.get_json_paths(jsons_path))
+    for path in tqdm.tqdm(paths):
+        ColumnarService.convert_json(path, columnar_path)
+
+
+@cli.command()
+@click.option('--jsons_path', default=JSONS_PATH, help='Path to the json files')
+@click.option('--columnar_path', default=None, help='Path to the columnar repositories, used instead of json files')
+@click.option('--vocabulary_path', default=VOCABULARY_PATH, help='Path to the feature vocabulary database')
+@click.option('--index_path', default=INDEX_PATH, help='Path to the user vectors index')
+@click.option('--n_jobs', default=N_JOBS, help='Number of jobs')
+@click.option('--hashing', is_flag=True, help='Hash features into a fixed number of columns')
+@click.option('--n_features', default=HASHING_N_FEATURES, help='Number of columns in the hashing mode')
+@click.option('--hash_sources', is_flag=True, help='Detect stale index by file hashes instead of mtimes')
+@click.option('--ann', is_flag=True, help='Build the approximate nearest neighbour index')
+@click.option('--update', is_flag=True, help='Add new repositories to the existing index instead of rebuilding it')
+@click.option('--ann_tables', default=ANN_N_TABLES, help='Number of LSH tables, more tables increase recall')
+@click.option('--ann_bits', default=ANN_N_BITS, help='Number of bits per LSH table, more bits make buckets smaller')
+@click.option('--profile', 'profile_path', default=None, help='Json file to save time, items and bytes of every stage to')
+@click.option('--profile_pstats', default=None, help='Directory to save a cProfile pstats file of every stage to')
+def build_index(jsons_path: str, columnar_path: str, vocabulary_path: str, index_path: str, n_jobs: int, hashing: bool,
+                n_features: int, hash_sources: bool, ann: bool, update: bool, ann_tables: int, ann_bits: int,
+                profile_path: str, profile_pstats: str) -> None:
+    profiler.configure(profile_pstats)
+    get_similar_devs.build_index(jsons_path, index_path, columnar_path, n_jobs, hashing, n_features, hash_sources,
+                                 LshIndex(ann_tables, ann_bits) if ann else None, vocabulary_path, update)
+    if profile_path:
+        save_profile(profile_path)
 
 
 @cli.command()
 @click.option('--dev_name', default='./', help='Developer name to search similar developers')
 @click.option('--jsons_path', default=JSONS_PATH, help='Path to the json files')
-@click.option('--max-cosine-similarity-devs', default=7000, help='Max number of developers to count cosine similarity')
-def start_search(dev_name: str, jsons_path: str, max_cosine_similarity_devs: int) -> None:
-    dataframe = get_user_vectors_dataframe(jsons_path)
-    devs = UserVectorService().get_similar_dev(dataframe, dev_name, max_cosine_similarity_devs)
+@click.option('--columnar_path', default=None, help='Path to the columnar repositories, used instead of json files')
+@click.option('--vocabulary_path', default=VOCABULARY_PATH, help='Path to the feature vocabulary database')
+@click.option('--index_path', default=INDEX_PATH, help='Path to the user vectors index')
+@click.option('-k', '--k', 'k', default=20, help='Number of similar developers')
+@click.option('--n_jobs', default=N_JOBS, help='Number of jobs')
+@click.option('--hashing', is_flag=True, help='Hash features into a fixed number of columns')
+@click.option('--n_features', default=HASHING_N_FEATURES, help='Number of columns in the hashing mode')
+@click.option('--ann', is_flag=True, help='Use the approximate nearest neighbour search')
+@click.option('--ann_tables', default=ANN_N_TABLES, help='Number of LSH tables if the ANN index is built in memory')
+@click.option('--ann_bits', default=ANN_N_BITS, help='Number of bits per LSH table if the ANN index is built in memory')
+@click.option('--n_probes', default=ANN_N_PROBES, help='Number of probed neighbour buckets per LSH table')
+@click.option('--profile', 'profile_path', default=None, help='Json file to save time, items and bytes of every stage to')
+@click.option('--profile_pstats', default=None, help='Directory to save a cProfile pstats file of every stage to')
+def start_search(dev_name: str, jsons_path: str, columnar_path: str, vocabulary_path: str, index_path: str, k: int,
+                 n_jobs: int, hashing: bool, n_features: int, ann: bool, ann_tables: int, ann_bits: int, n_probes: int,
+                 profile_path: str, profile_pstats: str) -> None:
+    profiler.configure(profile_pstats)
+    vectors = get_similar_devs.load_user_vectors(jsons_path, index_path, columnar_path, n_jobs, hashing, n_features,
+                                                 vocabulary_path)
+    ann_index = get_similar_devs.load_ann_index(vectors, index_path, ann_tables, ann_bits) if ann else None
+    devs = UserVectorService().get_similar_dev(vectors, dev_name, k, ann_index=ann_index, n_probes=n_probes)
     table = PrettyTable(['Name', 'Similarity'])
     table.align = "r"
     for dev in devs:
         table.add_row([dev[0], dev[1]])
     print(table)
+    if profile_path:
+        save_profile(profile_path)
+
+
+@cli.command()
+@click.option('--jsons_path', default=JSONS_PATH, help='Path to the json files')
+@click.option('--columnar_path', default=None, help='Path to the columnar repositories, used instead of json files')
+@click.option('--vocabulary_path', default=VOCABULARY_PATH, help='Path to the feature vocabulary database')
+@click.option('--index_path', default=INDEX_PATH, help='Path to the user vectors index')
+@click.option('-k', '--k', 'k', default=20, help='Number of similar developers')
+@click.option('--n_queries', default=100, help='Number of random developers to query')
+@click.option('--ann_tables', default=ANN_N_TABLES, help='Number of LSH tables if the ANN index is built in memory')
+@click.option('--ann_bits', default=ANN_N_BITS, help='Number of bits per LSH table if the ANN index is built in memory')
+@click.option('--n_probes', default=ANN_N_PROBES, help='Number of probed neighbour buckets per LSH table')
+def evaluate_ann(jsons_path: str, columnar_path: str, vocabulary_path: str, index_path: str, k: int, n_queries: int,
+                 ann_tables: int, ann_bits: int, n_probes: int) -> None:
+    vectors = UserVectorService.get_normalized(get_similar_devs.load_user_vectors(
+        jsons_path, index_path, columnar_path, vocabulary_path=vocabulary_path))
+    ann_index = get_similar_devs.load_ann_index(vectors, index_path, ann_tables, ann_bits)
+    result = ann_index.evaluate_recall(vectors, k, n_queries, n_probes)
+    table = PrettyTable(['Metric', 'Value'])
+    table.align = "r"
+    for metric, value in result.items():
+        table.add_row([metric, round(value, 4)])
+    print(table)
+
+
+@cli.command()
+@click.option('--output_path', default=KNN_GRAPH_PATH, help='Path to the kNN graph file')
+@click.option('--dev_names_file', default=None, help='File with one developer name per line (default: all developers)')
+@click.option('--jsons_path', default=JSONS_PATH, help='Path to the json files')
+@click.option('--columnar_path', default=None, help='Path to the columnar repositories, used instead of json files')
+@click.option('--vocabulary_path', default=VOCABULARY_PATH, help='Path to the feature vocabulary database')
+@click.option('--index_path', default=INDEX_PATH, help='Path to the user vectors index')
+@click.option('-k', '--k', 'k', default=20, help='Number of similar developers')
+@click.option('--block_size', default=KNN_BLOCK_SIZE, help='Number of developers scored at once by a job')
+@click.option('--n_jobs', default=N_JOBS, help='Number of jobs')
+def knn_graph(output_path: str, dev_names_file: str, jsons_path: str, columnar_path: str, vocabulary_path: str,
+              index_path: str, k: int, block_size: int, n_jobs: int) -> None:
+    dev_names = None
+    if dev_names_file:
+        with open(dev_names_file, "r") as f:
+            dev_names = [line.strip() for line in f if line.strip()]
+    vectors = get_similar_devs.load_user_vectors(jsons_path, index_path, columnar_path, n_jobs,
+                                                 vocabulary_path=vocabulary_path)
+    count = get_similar_devs.get_knn_graph(vectors, output_path, dev_names, k, block_size, n_jobs)
+    print(f"Saved {k} similar developers of {count} developers to {output_path}")
+
+
+@cli.command()
+@click.option('--jsons_path', default=JSONS_PATH, help='Path to the json files')
+@click.option('--columnar_path', default=None, help='Path to the columnar repositories, used instead of json files')
+@click.option('--vocabulary_path', default=VOCABULARY_PATH, help='Path to the feature vocabulary database')
+@click.option('--index_path', default=INDEX_PATH, help='Path to the user vectors index')
+@click.option('--n_jobs', default=N_JOBS, help='Number of jobs')
+@click.option('--host', default=SERVE_HOST, help='Host to listen on')
+@click.option('--port', default=SERVE_PORT, help='Port to listen on')
+@click.option('--ann', is_flag=True, help='Use the approximate nearest neighbour search')
+@click.option('--ann_tables', default=ANN_N_TABLES, help='Number of LSH tables if the ANN index is built in memory')
+@click.option('--ann_bits', default=ANN_N_BITS, help='Number of bits per LSH table if the ANN index is built in memory')
+@click.option('--n_probes', default=ANN_N_PROBES, help='Number of probed neighbour buckets per LSH table')
+@click.option('--cache_size', default=SERVE_CACHE_SIZE, help='Number of cached query results')
+@click.option('--reload_seconds', default=SERVE_RELOAD_SECONDS, help='Interval of the checks for new data (0: never)')
+@click.option('--max_batch', default=SERVE_MAX_BATCH, help='Max number of developers in a batch query')
+def serve(jsons_path: str, columnar_path: str, vocabulary_path: str, index_path: str, n_jobs: int, host: str, port: int,
+          ann: bool, ann_tables: int, ann_bits: int, n_probes: int, cache_size: int, reload_seconds: int,
+          max_batch: int) -> None:
+    engine = SearchEngine(jsons_path, index_path, columnar_path, n_jobs, ann, ann_tables, ann_bits, n_probes, cache_size,
+                          vocabulary_path=vocabulary_path)
+    serve_engine(engine, host, port, reload_seconds, max_batch)
 
 
 if __name__ == '__main__':
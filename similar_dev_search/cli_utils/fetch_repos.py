@@ -1,60 +1,573 @@
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from copy import copy
+import json
+import multiprocessing
 from pathlib import Path
+from queue import Full, Queue
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Union
 
-from github import Repository
+from git import GitCommandError
+from github import GithubException, NamedUser, Repository
 
-from similar_dev_search.services.file_system import FileSystemService, JsonService
+from similar_dev_search.data.constants import CPU_WORKERS, GITHUB_N_THREADS, IO_WORKERS, PIPELINE_QUEUE_SIZE, \
+    QUEUE_POLL_SECONDS
+from similar_dev_search.data.models import CloneStats, Commit, MiningOptions, MiningPlan, QueueChunk, Watermark
+from similar_dev_search.services.cache import ParseCache
+from similar_dev_search.services.code_parser import FileClassifier
+from similar_dev_search.services.columnar import ColumnarReader, ColumnarService, ColumnarWriter
+from similar_dev_search.services.file_system import FileSystemService, JsonStreamWriter, StateService
 from similar_dev_search.services.git import GitService, GithubService
 from similar_dev_search.services.git import RepositoryProvider
+from similar_dev_search.services.profiler import profiler
+from similar_dev_search.services.vocabulary import get_vocabulary
+from similar_dev_search.services.work_queue import WorkQueue
 
 
-def find_repos(username: str, repo_name: str, depth: int = 1, max_depth: int = 3, max_top_starred_repos: int = 5,
-               max_contributors: int = 10) -> {Repository}:
+def find_repos(username: str, repo_name: str, max_depth: int = 3, max_top_starred_repos: int = 5,
+               max_contributors: int = 10, github_service: GithubService = None,
+               n_threads: int = GITHUB_N_THREADS) -> [Repository]:
     """
-    Find all repos recursively. Max depth responsible for the number of nested calls.
-    Max depth doesn't mean the number of repos, but the number of nested calls.
-    Max depth is selected intuitively.
+    Find repos breadth-first: the repos starred the most among the top starred repos of the contributors
+    of the repos found on the previous level. Max depth is the number of expanded levels.
+    Every repo and every contributor is visited once. API calls of a level are made on a thread pool.
 
     :param username: Username of the repo author.
     :param repo_name: Name of the repo.
-    :param depth: Depth of the search.
     :param max_depth: Max depth of the search.
     :param max_top_starred_repos: Max number of top starred repos.
     :param max_contributors: Max number of contributors.
-    :return: Set of all repos.
+    :param github_service: Shared GitHub client, a new one is created by default.
+    :param n_threads: Number of concurrent API calls.
+    :return: Repos in the order they were found.
     """
-    ghs = GithubService()
-    repo = ghs.get_repo(username, repo_name)
-    contributors = repo.get_contributors()
-    result = {repo}
-    if depth <= max_depth:
-        for contributor in contributors[:max_contributors]:
-            stars = ghs.get_user(contributor.login).get_starred()
-            stars = get_top_starred_repos(stars)[:max_top_starred_repos]
-            for star in stars:
-                result = result | find_repos(star.owner.login, star.name, depth + 1, max_depth, max_top_starred_repos,
-                                             max_contributors)
-    return result
+    return list(iter_repos(username, repo_name, max_depth, max_top_starred_repos, max_contributors, github_service,
+                           n_threads))
 
 
-def handle_repo(username: str, repo_name: str, repo_path: str, tree_sitter_build_path: str, jsons_path: str) -> None:
+def iter_repos(username: str, repo_name: str, max_depth: int = 3, max_top_starred_repos: int = 5,
+               max_contributors: int = 10, github_service: GithubService = None,
+               n_threads: int = GITHUB_N_THREADS) -> Iterator[Repository]:
     """
-    Clone repo and export to json.
+    Lazily find repos in the order of find_repos. Every repo is yielded as soon as its level is expanded,
+    so they can be cloned while the next level is searched, and the search stops when enough repos are taken.
+    """
+    ghs = github_service or GithubService(pool_size=n_threads)
+    start = ghs.get_repo(username, repo_name)
+    yield start
+    found = {start.full_name: start}
+    visited_users = set()
+    frontier = [start]
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        for _ in range(max_depth):
+            users = []
+            for contributors in pool.map(lambda r: get_contributors(ghs, r, max_contributors), frontier):
+                for user in contributors:
+                    if user.login not in visited_users:
+                        visited_users.add(user.login)
+                        users.append(user)
+            frontier = []
+            for stars in pool.map(lambda u: get_user_top_starred_repos(ghs, u, max_top_starred_repos), users):
+                for star in stars:
+                    if star.full_name not in found:
+                        found[star.full_name] = star
+                        frontier.append(star)
+                        yield star
+            if not frontier:
+                break
 
-    :param username: Username of the repo author.
+
+def get_contributors(ghs: GithubService, repo: Repository, max_contributors: int) -> [NamedUser]:
+    try:
+        return ghs.get_contributors(repo, max_contributors)
+    except GithubException as e:
+        print(f"Failed to get contributors of {repo.full_name}: {e}")
+        return []
+
+
+def get_user_top_starred_repos(ghs: GithubService, user: NamedUser, max_top_starred_repos: int) -> [Repository]:
+    try:
+        return get_top_starred_repos(ghs.get_starred(user))[:max_top_starred_repos]
+    except GithubException as e:
+        print(f"Failed to get starred repos of {user.login}: {e}")
+        return []
+
+
+def get_output_path(options: MiningOptions) -> str:
+    return options.columnar_path if options.output_format == "columnar" else options.jsons_path
+
+
+def output_exists(options: MiningOptions, repo_name: str) -> bool:
+    if options.output_format == "columnar":
+        return Path(options.columnar_path, repo_name, "meta.json").is_file()
+    return Path(options.jsons_path, repo_name + ".json").is_file()
+
+
+def get_commit_writer(options: MiningOptions, repo_name: str, append: bool) -> Union[JsonStreamWriter, ColumnarWriter]:
+    """
+    Create a writer of mined commits for the selected output format.
+
+    :param options: Mining options.
+    :param repo_name: Name of the repo.
+    :param append: Append the commits to the existing output.
+    :return: The writer.
+    """
+    if options.output_format == "columnar":
+        return ColumnarWriter(options.columnar_path, repo_name, append)
+    return JsonStreamWriter(options.jsons_path, repo_name, append)
+
+
+def print_progress(options: MiningOptions) -> None:
+    count = FileSystemService.get_file_count(options.jsons_path)
+    if options.output_format == "columnar":
+        count = len(list(ColumnarService.get_repository_paths(options.columnar_path)))
+    print("\r", count, "handled repositories...", end='', flush=True)
+
+
+def plan_repo_mining(repo_name: str, repo_path: str, options: MiningOptions) -> Optional[MiningPlan]:
+    """
+    Decide which commits of a cloned repo have to be mined.
+    A repo without output is mined fully. A repo with output is skipped unless the refresh is requested,
+    in that case the clone is fetched and only the commits made after the watermark are mined.
+
+    :param repo_name: Name of the repo.
+    :param repo_path: Path to the repo.
+    :param options: Mining options.
+    :return: Mining plan or None if there is nothing to mine.
+    """
+    exists = output_exists(options, repo_name)
+    if exists and not options.refresh:
+        return None
+    commit_filter = copy(options.commit_filter)
+    watermark = None
+    if exists:
+        watermark = get_repo_watermark(options, repo_name)
+        if watermark is None:  # the output was mined from the current state of the clone
+            watermark = Watermark(RepositoryProvider(repo_path).get_ref_tips(commit_filter))
+        GitService.fetch_repo(repo_path)
+        commit_filter.exclude = [tip.encode() for tip in watermark.ref_tips.values()]
+    ref_tips = RepositoryProvider(repo_path).get_ref_tips(commit_filter)
+    if watermark is not None and watermark.ref_tips == ref_tips:
+        return None
+    return MiningPlan(repo_name, repo_path, commit_filter, ref_tips, watermark)
+
+
+def prepare_clone(clone_url: str, repo_name: str, repo_path: str, options: MiningOptions) -> Optional[CloneStats]:
+    """
+    Clone a repo or fetch an existing clone of a repo without output and report the time and the size of the clone.
+    A clone of an already mined repo is left as is, plan_repo_mining fetches it on refresh.
+
+    :param clone_url: Clone url of the repo.
+    :param repo_name: Name of the repo.
+    :param repo_path: Path to the repo.
+    :param options: Mining options.
+    :return: Clone stats or None if the clone was not touched.
+    """
+    if output_exists(options, repo_name) and (not options.refresh or GitService.is_repo(repo_path)):
+        return None
+    try:
+        stats = GitService.clone_repo(clone_url, repo_path, clone_options=options.clone_options,
+                                      commit_filter=options.commit_filter)
+    except GitCommandError as e:
+        print(f"Failed to clone {clone_url}: {e}")
+        return None
+    print(stats)
+    return stats
+
+
+def get_repo_watermark(options: MiningOptions, repo_name: str) -> Optional[Watermark]:
+    """
+    Get the watermark of a mined repo. A columnar output keeps the watermark in its metadata.
+
+    :param options: Mining options.
+    :param repo_name: Name of the repo.
+    :return: The watermark or None if the repo has no watermark.
+    """
+    if options.output_format == "columnar":
+        meta = ColumnarReader(str(Path(options.columnar_path, repo_name))).meta
+        if "watermark" in meta:
+            return Watermark(**meta["watermark"])
+    return StateService.get_watermark(options.state_path, repo_name)
+
+
+def export_commits(plan: MiningPlan, options: MiningOptions, commits: Iterable[Commit]) -> None:
+    """
+    Write mined commits of a planned repo and save its watermark. The watermark of a columnar output
+    is saved with the output. A json output saved without its watermark drops the commits mined again.
+
+    :param plan: Mining plan of the repo.
+    :param options: Mining options.
+    :param commits: The commits.
+    """
+    with get_commit_writer(options, plan.repo_name, plan.watermark is not None) as writer:
+        for commit in commits:
+            with profiler.stage("export", items=1):
+                writer.write(commit)
+        previous_commits = plan.watermark.commits if plan.watermark is not None else 0
+        watermark = Watermark(plan.ref_tips, previous_commits + writer.count)
+        if isinstance(writer, ColumnarWriter):
+            writer.watermark = watermark
+    StateService.save_watermark(options.state_path, plan.repo_name, watermark)
+
+
+def create_repository_provider(repo_path: str, options: MiningOptions) -> RepositoryProvider:
+    return RepositoryProvider(
+        repo_path,
+        ParseCache(options.parse_cache_path, options.parse_cache_max_bytes),
+        FileClassifier(options.max_file_bytes))
+
+
+def handle_repo(clone_url: str, repo_name: str, repo_path: str, options: MiningOptions) -> Counter:
+    """
+    Clone repo and export mined commits.
+
+    :param clone_url: Clone url of the repo found by find_repos.
     :param repo_name: Name of the repo.
     :param repo_path: Path to the repo.
-    :param tree_sitter_build_path: Path to the tree-sitter build library.
-    :param jsons_path: Path to the json files.
-    """
-    ghs = GithubService()
-    gs = GitService()
-    repo = ghs.get_repo(username, repo_name)
-    gs.clone_repo(repo.clone_url, repo_path)
-    if not Path((Path(jsons_path).resolve() / repo.name).__str__() + ".json").is_file():
-        p = RepositoryProvider(repo_path)
-        repository = p.get_repository(tree_sitter_build_path)
-        JsonService.export_to_json(jsons_path, repo.name, repository)
-    print("\r", FileSystemService.get_file_count(jsons_path), "handled repositories...", end='', flush=True)
+    :param options: Mining options.
+    :return: Counters of the file classifier.
+    """
+    prepare_clone(clone_url, repo_name, repo_path, options)
+    with profiler.stage("plan", items=1):
+        plan = plan_repo_mining(repo_name, repo_path, options)
+    counters = mine_plan(plan, options) if plan is not None else Counter()
+    print_progress(options)
+    return counters
+
+
+def mine_plan(plan: MiningPlan, options: MiningOptions) -> Counter:
+    """
+    Export mined commits of a planned repo and save its watermark.
+
+    :param plan: Mining plan of the repo.
+    :param options: Mining options.
+    :return: Counters of the file classifier.
+    """
+    p = create_repository_provider(plan.repo_path, options)
+    export_commits(plan, options, encode_commits(p.iter_commits(options.tree_sitter_build_path, plan.commit_filter),
+                                                 options))
+    return p.classifier.counters
+
+
+# Repository providers opened by the current worker process, keyed by the repo path
+repository_providers = {}
+
+
+def encode_commits(commits: Iterable[Commit], options: MiningOptions) -> Iterator[Commit]:
+    """
+    Replace the feature names of mined commits with their ids in the vocabulary of the mining options.
+    The commits are passed as is if the options have no vocabulary.
+
+    :param commits: Mined commits.
+    :param options: Mining options.
+    :return: Encoded commits.
+    """
+    if options.vocabulary_path is None:
+        yield from commits
+        return
+    vocabulary = get_vocabulary(options.vocabulary_path)
+    for commit in commits:
+        with profiler.stage("encode", items=len(commit.changes)):
+            commit = vocabulary.encode_commit(commit)
+        yield commit
+
+
+def get_repository_provider(repo_path: str, options: MiningOptions) -> RepositoryProvider:
+    if repo_path not in repository_providers:
+        repository_providers[repo_path] = create_repository_provider(repo_path, options)
+    return repository_providers[repo_path]
+
+
+def mine_commit_chunk(repo_path: str, commit_ids: [bytes], options: MiningOptions) -> ([Commit], Counter):
+    """
+    Mine a chunk of commits of a repo in a worker process.
+
+    :param repo_path: Path to the repo.
+    :param commit_ids: Ids of the commits.
+    :param options: Mining options.
+    :return: Mined commits in the order of ids and counters of the file classifier for the chunk.
+    """
+    provider = get_repository_provider(repo_path, options)
+    provider.classifier.counters = Counter()
+    commits = list(encode_commits(provider.mine_commits(commit_ids, options.tree_sitter_build_path), options))
+    return commits, provider.classifier.counters
+
+
+def print_queue_progress(work_queue: WorkQueue) -> None:
+    counts = work_queue.get_counts()
+    print("\r", counts["done"], "handled repositories of", sum(counts.values()), "found...", end='', flush=True)
+
+
+def merge_chunks(work_queue: WorkQueue, owner: str, repo_name: str, plan: MiningPlan, options: MiningOptions) -> None:
+    """
+    Write the mined chunks of a repo in the walk order and save its watermark.
+
+    :param work_queue: The work queue.
+    :param owner: Owner of the merge lease.
+    :param repo_name: Name of the repo.
+    :param plan: Mining plan of the repo.
+    :param options: Mining options.
+    """
+    export_commits(plan, options, work_queue.iter_merged_commits(repo_name))
+    work_queue.complete_repo(repo_name, owner)
+
+
+class MiningScheduler:
+    """
+    Submits mining tasks to a process pool keeping a bounded number of unfinished tasks, so the planned repos
+    wait in the queue of the pipeline and the chunks wait in the work queue instead of piling up as pending futures.
+
+    A repo task mines a whole repo and writes its output. A chunk task mines a chunk of commits claimed from
+    the work queue, the mined chunk is saved to the work queue and the worker completing the last chunk
+    of a repo merges the chunks into the output.
+    """
+
+    def __init__(self, pool: ProcessPoolExecutor, work_queue: WorkQueue, owner: str, options: MiningOptions,
+                 max_pending: int) -> None:
+        self.pool = pool
+        self.work_queue = work_queue
+        self.owner = owner
+        self.options = options
+        self.max_pending = max(max_pending, 1)
+        self.tasks: Dict[Future, Union[MiningPlan, QueueChunk]] = {}
+        self.counters = Counter()
+
+    def has_capacity(self) -> bool:
+        return len(self.tasks) < self.max_pending
+
+    def submit_repo(self, plan: MiningPlan) -> None:
+        self.tasks[self.pool.submit(profiler.task(mine_plan), plan, self.options)] = plan
+
+    def submit_chunk(self, chunk: QueueChunk) -> None:
+        future = self.pool.submit(profiler.task(mine_commit_chunk), chunk.plan.repo_path, chunk.commit_ids, self.options)
+        self.tasks[future] = chunk
+
+    def fill(self, plan_queue: Queue) -> None:
+        """
+        Submit the planned repos and the chunks of the work queue while there is capacity.
+        The merges left by stopped workers are done on the way.
+
+        :param plan_queue: Queue of the planned repos.
+        """
+        while self.has_capacity() and not plan_queue.empty():
+            self.submit_repo(plan_queue.get())
+        while self.has_capacity():
+            merge = self.work_queue.claim_merge(self.owner)
+            if merge is not None:
+                merge_chunks(self.work_queue, self.owner, merge[0], merge[1], self.options)
+                continue
+            chunk = self.work_queue.claim_chunk(self.owner)
+            if chunk is None:
+                return
+            self.submit_chunk(chunk)
+
+    def collect(self) -> None:
+        """
+        Take the results of the finished tasks, a failed task is returned to the work queue.
+        """
+        for future in [future for future in self.tasks if future.done()]:
+            task = self.tasks.pop(future)
+            try:
+                result, stages = future.result()
+            except Exception as e:
+                print(f"Failed to mine {task.repo if isinstance(task, QueueChunk) else task.repo_name}: {e}")
+                if isinstance(task, QueueChunk):
+                    self.work_queue.fail_chunk(task, self.owner, str(e))
+                else:
+                    self.work_queue.fail_repo(task.repo_name, self.owner, str(e))
+                continue
+            profiler.merge(stages)
+            if isinstance(task, QueueChunk):
+                commits, counters = result
+                if self.work_queue.complete_chunk(task, self.owner, commits):
+                    merge_chunks(self.work_queue, self.owner, task.repo, task.plan, self.options)
+            else:
+                counters = result
+                self.work_queue.complete_repo(task.repo_name, self.owner)
+            self.counters.update(counters)
+            print_queue_progress(self.work_queue)
+
+    def wait(self, timeout: float) -> None:
+        """
+        Wait until a task is finished or the timeout passes and take the results of the finished tasks.
+
+        :param timeout: Max number of seconds to wait.
+        """
+        if self.tasks:
+            wait(list(self.tasks), timeout=timeout, return_when=FIRST_COMPLETED)
+        else:
+            time.sleep(timeout)
+        self.collect()
+
+
+def discover_repos(repos: Iterable[Repository], work_queue: WorkQueue, owner: str, max_repos: int, errors: list,
+                   stop: threading.Event, search: dict = None) -> None:
+    """
+    Add the first max_repos repos found by the search to the work queue. The repos of the search are counted
+    whether they were queued by it or by another search, so a search from another seed adds its own repos
+    to a shared queue and a stopped discovery is resumed by walking the search again. A finished search
+    is recorded under its parameters and is not walked again if it found max_repos repos or all of its repos.
+    The discovery of the owner, registered before the workers start, is finished in the end.
+    """
+    key = "search:" + json.dumps(search or {}, sort_keys=True)
+    try:
+        found = work_queue.get_meta(key)
+        if found is not None and (found["repos"] >= max_repos or found["exhausted"]):
+            print(f"Skipping the discovery, the search already queued {found['repos']} repos")
+            return
+        count = 0
+        for repo in repos:
+            if stop.is_set():
+                return
+            work_queue.add_repo(repo.name, repo.clone_url)
+            count += 1
+            if count >= max_repos:
+                break
+        work_queue.set_meta(key, {"repos": count, "exhausted": count < max_repos})
+    except Exception as e:
+        errors.append(e)
+    finally:
+        work_queue.finish_discovery(owner)
+
+
+def put_plan(plan_queue: Queue, plan: MiningPlan, stop: threading.Event) -> bool:
+    """
+    Put a plan to the pipeline queue, waiting for a free place until the pipeline is stopped.
+
+    :return: False if the pipeline was stopped.
+    """
+    while not stop.is_set():
+        try:
+            plan_queue.put(plan, timeout=QUEUE_POLL_SECONDS)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def queue_plan(work_queue: WorkQueue, owner: str, plan_queue: Queue, repo_name: str, plan: Optional[MiningPlan],
+               commit_ids: Optional[List[bytes]], chunk_size: int, stop: threading.Event) -> None:
+    """
+    Complete a prepared repo without new commits, split its mining into chunk tasks of the work queue
+    or put its plan to the pipeline queue. A plan not queued before the pipeline stopped returns the repo
+    to the work queue.
+    """
+    if plan is None:
+        work_queue.complete_repo(repo_name, owner)
+        print_queue_progress(work_queue)
+    elif commit_ids is not None:
+        chunks = [commit_ids[i:i + chunk_size] for i in range(0, len(commit_ids), chunk_size)]
+        if not chunks:
+            work_queue.complete_repo(repo_name, owner)
+        else:
+            work_queue.add_chunks(repo_name, owner, plan, chunks)
+    elif not put_plan(plan_queue, plan, stop):
+        work_queue.fail_repo(repo_name, owner, "stopped")
+
+
+def prepare_repos(work_queue: WorkQueue, owner: str, plan_queue: Queue, repos_path: str, options: MiningOptions,
+                  chunk_size: int, stop: threading.Event, discovery: threading.Thread = None) -> None:
+    """
+    Claim repos from the work queue, clone and plan them. The plans of the repos with new commits are put
+    to the pipeline queue to be mined whole or split into chunk tasks of the work queue.
+    A repo that failed to clone or to plan is returned to the work queue.
+    The preparers wait for new repos while a discovery is running.
+    """
+    while not stop.is_set():
+        claimed = work_queue.claim_repo(owner)
+        if claimed is None:
+            if not work_queue.has_repos_to_prepare() and (discovery is None or not discovery.is_alive()):
+                return
+            stop.wait(QUEUE_POLL_SECONDS)
+            continue
+        repo_name, clone_url = claimed
+        repo_path = repos_path + repo_name
+        try:
+            prepare_clone(clone_url, repo_name, repo_path, options)
+            with profiler.stage("plan", items=1):
+                plan = plan_repo_mining(repo_name, repo_path, options)
+                commit_ids = None
+                if plan is not None and chunk_size > 0:
+                    commit_ids = RepositoryProvider(repo_path).get_commit_ids(plan.commit_filter)
+        except Exception as e:
+            print(f"Failed to prepare {repo_name}: {e}")
+            work_queue.fail_repo(repo_name, owner, str(e))
+            continue
+        queue_plan(work_queue, owner, plan_queue, repo_name, plan, commit_ids, chunk_size, stop)
+
+
+def send_heartbeats(work_queue: WorkQueue, owner: str, stop: threading.Event) -> None:
+    while not stop.wait(work_queue.lease_seconds / 3):
+        try:
+            work_queue.heartbeat(owner)
+        except Exception as e:
+            print(f"Failed to extend the leases: {e}")
+
+
+def mine_repos_pipeline(repos: Optional[Iterable[Repository]], max_repos: int, repos_path: str,
+                        options: MiningOptions, work_queue: WorkQueue, io_workers: int = IO_WORKERS,
+                        cpu_workers: int = CPU_WORKERS, chunk_size: int = 0,
+                        queue_size: int = PIPELINE_QUEUE_SIZE, search: dict = None) -> Counter:
+    """
+    Clone and mine the repos of a work queue in a staged pipeline. A discovery thread adds the repos
+    from the lazy search to the work queue, I/O threads claim, clone and plan them, worker processes mine them.
+    Whole repos go to the worker processes through a bounded queue, chunks are claimed from the work queue,
+    so any number of pipelines on one or several machines can share a crawl and resume the work of a stopped one.
+    The pipeline runs until every repo of the work queue is done or failed.
+
+    :param repos: Repos to add to the work queue, usually iter_repos, or None to only mine the queued repos.
+    :param max_repos: Number of repos of the search to stop the discovery at.
+    :param repos_path: Path to the clones.
+    :param options: Mining options.
+    :param work_queue: The work queue.
+    :param io_workers: Number of threads cloning repos.
+    :param cpu_workers: Number of processes mining repos.
+    :param chunk_size: Number of commits in a mining task, 0 to mine every repo in one task.
+    :param queue_size: Capacity of the queue between the planning and the mining.
+    :param search: Parameters of the search the repos are found by, a finished search isn't walked again.
+    :return: Counters of the file classifier summed over the repos mined by this pipeline.
+    """
+    owner = WorkQueue.get_owner()
+    plan_queue = Queue(maxsize=queue_size)
+    errors = []
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=send_heartbeats, args=(work_queue, owner, stop), daemon=True)
+    discovery = None
+    if repos is not None:
+        work_queue.start_discovery(owner)
+        discovery = threading.Thread(
+            target=discover_repos, args=(repos, work_queue, owner, max_repos, errors, stop, search), daemon=True)
+    preparers = [threading.Thread(
+        target=prepare_repos, args=(work_queue, owner, plan_queue, repos_path, options, chunk_size, stop, discovery),
+        daemon=True) for _ in range(io_workers)]
+    # the workers are spawned, forking a process with running threads may copy their locks in a locked state
+    with ProcessPoolExecutor(max_workers=cpu_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        scheduler = MiningScheduler(pool, work_queue, owner, options, cpu_workers * 2)
+        for thread in [heartbeat, discovery] + preparers:
+            if thread is not None:
+                thread.start()
+        try:
+            while not errors:
+                scheduler.fill(plan_queue)
+                if (not scheduler.tasks and plan_queue.empty() and not any(t.is_alive() for t in preparers) and
+                        work_queue.is_finished()):
+                    break
+                scheduler.wait(QUEUE_POLL_SECONDS)
+        finally:
+            stop.set()
+            for thread in preparers:
+                thread.join()
+            while not plan_queue.empty():
+                plan = plan_queue.get()
+                work_queue.fail_repo(plan.repo_name, owner, "stopped")
+    heartbeat.join()
+    if discovery is not None:
+        discovery.join()
+    if errors:
+        raise errors[0]
+    return scheduler.counters
 
 
 def get_top_starred_repos(stars: Repository) -> [Repository]:
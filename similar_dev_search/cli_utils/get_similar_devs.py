@@ -1,20 +1,199 @@
-from pandas import DataFrame
+from pathlib import Path
+from typing import Optional
 
+import numpy
+
+from similar_dev_search.data.constants import ANN_N_BITS, ANN_N_TABLES, HASHING_N_FEATURES, KNN_BLOCK_SIZE, N_JOBS, \
+    VOCABULARY_PATH
+from similar_dev_search.services.ann import LshIndex
+from similar_dev_search.services.columnar import ColumnarService, decode_strings, encode_strings
 from similar_dev_search.services.file_system import JsonService
-from similar_dev_search.services.user_vectors import UserVectorService
+from similar_dev_search.services.user_vectors import UserVectors, UserVectorService
+from similar_dev_search.services.vector_index import VectorIndexService
+from similar_dev_search.services.vocabulary import get_vocabulary
+
+
+def get_repository_paths(jsons_path: str, columnar_path: str = None) -> [str]:
+    """
+    Get paths to the mined repositories.
+
+    :param jsons_path: Path to json files, used if columnar_path is not set.
+    :param columnar_path: Path to columnar repositories.
+    :return: Paths to json files or columnar repositories.
+    """
+    if columnar_path:
+        return list(ColumnarService.get_repository_paths(columnar_path))
+    return list(JsonService.get_json_paths(jsons_path))
+
+
+def get_user_vectors(jsons_path: str, columnar_path: str = None, n_jobs: int = N_JOBS, hashing: bool = False,
+                     n_features: int = HASHING_N_FEATURES, vocabulary_path: str = VOCABULARY_PATH) -> UserVectors:
+    """
+    Calculate sparse user vectors for all users.
+
+    :param jsons_path: Path to json files.
+    :param columnar_path: Path to columnar repositories, used instead of json files if set.
+    :param n_jobs: Number of worker processes.
+    :param hashing: Hash features into a fixed number of columns.
+    :param n_features: Number of columns in the hashing mode.
+    :param vocabulary_path: Path to the feature vocabulary of the repositories.
+    :return: User vectors.
+    """
+    paths = get_repository_paths(jsons_path, columnar_path)
+    counts = UserVectorService.get_counts_from_files(paths, vocabulary_path, n_jobs)
+    names = get_vocabulary(vocabulary_path).get_names()
+    return UserVectorService.get_counts_vectors(counts, names, hashing, n_features)
+
+
+def build_index(jsons_path: str, index_path: str, columnar_path: str = None, n_jobs: int = N_JOBS,
+                hashing: bool = False, n_features: int = HASHING_N_FEATURES, hash_sources: bool = False,
+                ann_index: LshIndex = None, vocabulary_path: str = VOCABULARY_PATH, update: bool = False) -> None:
+    """
+    Calculate user vectors for all users and write them to an index. With update, only the repositories added
+    since the index was built are counted and added to the index, if the other repositories are unchanged.
+
+    :param jsons_path: Path to json files.
+    :param index_path: Path to the index directory.
+    :param columnar_path: Path to columnar repositories, used instead of json files if set.
+    :param n_jobs: Number of worker processes.
+    :param hashing: Hash features into a fixed number of columns.
+    :param n_features: Number of columns in the hashing mode.
+    :param hash_sources: Record sha1 of the source files to detect stale index.
+    :param ann_index: Empty approximate nearest neighbour index to fit and store with the vectors. With update,
+                      the stored one is kept by default.
+    :param vocabulary_path: Path to the feature vocabulary of the repositories.
+    :param update: Update the existing index instead of rebuilding it.
+    """
+    paths = get_repository_paths(jsons_path, columnar_path)
+    sources = VectorIndexService.get_sources(paths, hash_sources)
+    with VectorIndexService.lock(index_path):
+        if update and VectorIndexService.exists(index_path):
+            added = update_index(index_path, sources, n_jobs, hashing, n_features, ann_index, vocabulary_path)
+            if added is not None:
+                if not added:
+                    print("Index is up to date")
+                return
+            print("Index can't be updated, rebuilding it...")
+            if ann_index is None:
+                ann_index = VectorIndexService.get_stored_ann_index(index_path)
+        counts = UserVectorService.get_counts_from_files(paths, vocabulary_path, n_jobs)
+        vectors = UserVectorService.get_counts_vectors(counts, get_vocabulary(vocabulary_path).get_names(), hashing,
+                                                       n_features)
+        del counts
+        print("Writing index...")
+        VectorIndexService.build(vectors, sources, index_path, ann_index)
+
+
+def update_index(index_path: str, sources: [dict], n_jobs: int = N_JOBS, hashing: bool = False,
+                 n_features: int = HASHING_N_FEATURES, ann_index: LshIndex = None,
+                 vocabulary_path: str = VOCABULARY_PATH) -> Optional[int]:
+    """
+    Add the repositories mined since the index was built to the index, counting only their commits.
+    The caller holds VectorIndexService.lock of the index.
+
+    :param index_path: Path to the index directory.
+    :param sources: Descriptions of all current repositories from get_sources.
+    :param n_jobs: Number of worker processes.
+    :param hashing: Features of the index are hashed into a fixed number of columns.
+    :param n_features: Number of columns in the hashing mode.
+    :param ann_index: Empty approximate nearest neighbour index to update or fit and store with the vectors,
+                      the stored one is updated by default.
+    :param vocabulary_path: Path to the feature vocabulary of the repositories.
+    :return: Number of the added repositories or None if the index can't be updated and has to be rebuilt.
+    """
+    added = VectorIndexService.get_added_sources(index_path, sources, hashing, n_features)
+    if added:
+        counts = UserVectorService.get_counts_from_files([source["path"] for source in added], vocabulary_path, n_jobs)
+        print(f"Updating index with {len(added)} repositories...")
+        VectorIndexService.update(index_path, counts, get_vocabulary(vocabulary_path).get_names(), sources, ann_index)
+    return None if added is None else len(added)
 
 
-def get_user_vectors_dataframe(jsons_path: str) -> DataFrame:
+def load_user_vectors(jsons_path: str, index_path: str, columnar_path: str = None, n_jobs: int = N_JOBS,
+                      hashing: bool = False, n_features: int = HASHING_N_FEATURES,
+                      vocabulary_path: str = VOCABULARY_PATH) -> UserVectors:
     """
-    Calculate user vectors for all users and return DataFrame with user vectors.
+    Load user vectors from the index if it is up to date, otherwise calculate them from the repositories.
 
     :param jsons_path: Path to json files.
-    :return: Dataframe.
-    """
-    paths = JsonService.absolute_file_paths(jsons_path)
-    repositories = JsonService.get_from_json(paths)
-    user_vector_service = UserVectorService()
-    users_dict = user_vector_service.get_users_dict(repositories)
-    dataframe = user_vector_service.get_users_pandas(users_dict)
-    del users_dict
-    return dataframe
+    :param index_path: Path to the index directory.
+    :param columnar_path: Path to columnar repositories, used instead of json files if set.
+    :param n_jobs: Number of worker processes.
+    :param hashing: Hash features into a fixed number of columns.
+    :param n_features: Number of columns in the hashing mode.
+    :param vocabulary_path: Path to the feature vocabulary of the repositories.
+    :return: User vectors.
+    """
+    if VectorIndexService.exists(index_path):
+        if not VectorIndexService.is_stale(index_path, get_repository_paths(jsons_path, columnar_path)):
+            return VectorIndexService.load(index_path)
+        print("Index is stale, run build-index to update it. Calculating user vectors...")
+    return get_user_vectors(jsons_path, columnar_path, n_jobs, hashing, n_features, vocabulary_path)
+
+
+def load_ann_index(vectors: UserVectors, index_path: str, n_tables: int = ANN_N_TABLES,
+                   n_bits: int = ANN_N_BITS) -> LshIndex:
+    """
+    Load the approximate nearest neighbour index stored with the vectors or fit a new one.
+    The stored index is used only for the vectors loaded from the same index, vectors calculated
+    from the repositories may have changed without changing the number of rows.
+
+    :param vectors: User vectors.
+    :param index_path: Path to the index directory.
+    :param n_tables: Number of hash tables of a new index.
+    :param n_bits: Number of bits per table of a new index.
+    :return: The index fitted on the normalized vectors.
+    """
+    ann_path = VectorIndexService.get_ann_path(index_path)
+    from_index = vectors.index_path is not None and Path(vectors.index_path) == Path(index_path).resolve()
+    if from_index and LshIndex.exists(ann_path):
+        ann_index = LshIndex.load(ann_path)
+        if ann_index.order.shape[1] == vectors.matrix.shape[0]:
+            return ann_index
+    print("Building ANN index...")
+    return LshIndex(n_tables, n_bits).fit(UserVectorService.get_normalized(vectors).matrix)
+
+
+def get_knn_graph(vectors: UserVectors, output_path: str, dev_names: [str] = None, k: int = 20,
+                  block_size: int = KNN_BLOCK_SIZE, n_jobs: int = N_JOBS) -> int:
+    """
+    Find similar developers for many developers and save them as a kNN graph.
+
+    The graph is a .npz file with the "authors" strings, the "queries" rows, "neighbours" rows padded with -1
+    and "scores" of the neighbours, the most similar first. Rows point into "authors".
+
+    :param vectors: User vectors.
+    :param output_path: Path to the output file.
+    :param dev_names: Developers to search similar developers for, all developers by default.
+    :param k: Number of similar developers.
+    :param block_size: Number of developers in a block.
+    :param n_jobs: Number of jobs.
+    :return: Number of developers in the graph.
+    """
+    if dev_names is None:
+        rows = numpy.arange(len(vectors.authors))
+    else:
+        missing = [name for name in dev_names if name not in vectors.author_index]
+        if missing:
+            print(f"Skipping {len(missing)} unknown developers: {', '.join(missing[:10])}")
+        rows = numpy.array([vectors.author_index[name] for name in dev_names if name in vectors.author_index],
+                           dtype=numpy.int64)
+    neighbours, scores = UserVectorService.get_knn_graph(vectors, rows, k, block_size, n_jobs=n_jobs)
+    authors_offsets, authors_data = encode_strings(vectors.authors)
+    Path(output_path).resolve().parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "wb") as f:
+        numpy.savez(f, authors_offsets=authors_offsets, authors_data=authors_data, queries=rows.astype(numpy.int32),
+                    neighbours=neighbours, scores=scores)
+    return len(rows)
+
+
+def load_knn_graph(path: str) -> ([str], numpy.ndarray, numpy.ndarray, numpy.ndarray):
+    """
+    Load a kNN graph saved by get_knn_graph.
+
+    :param path: Path to the graph file.
+    :return: Authors, query rows, neighbour rows and scores.
+    """
+    with numpy.load(path) as graph:
+        authors = decode_strings(graph["authors_offsets"], graph["authors_data"])
+        return authors, graph["queries"], graph["neighbours"], graph["scores"]
@@ -0,0 +1,391 @@
+from bisect import bisect_left
+from collections import deque, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+import numpy
+
+from similar_dev_search.cli_utils.get_similar_devs import get_repository_paths, load_ann_index, load_user_vectors, \
+    update_index
+from similar_dev_search.data.constants import ANN_N_BITS, ANN_N_PROBES, ANN_N_TABLES, N_JOBS, SERVE_CACHE_SIZE, \
+    SERVE_LATENCY_WINDOW, SERVE_MAX_BATCH, SERVE_RELOAD_SECONDS, VOCABULARY_PATH
+from similar_dev_search.services.ann import LshIndex
+from similar_dev_search.services.user_vectors import UserVectors, UserVectorService
+from similar_dev_search.services.vector_index import VectorIndexService
+
+
+class LruCache:
+    """
+    Thread-safe in-memory cache evicting the least recently used entries.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[list]:
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def set(self, key: tuple, value: list) -> None:
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+class SearchState:
+    """
+    Loaded user vectors with the search structures built from them. A reload replaces the whole state,
+    so a query always runs against one consistent version.
+    """
+
+    def __init__(self, vectors: UserVectors, ann_index: Optional[LshIndex], signature: list) -> None:
+        self.vectors = UserVectorService.get_normalized(vectors)
+        self.ann_index = ann_index
+        self.signature = signature
+        self.loaded = time.time()
+        self.language_columns = {}
+        if self.vectors.features is not None:
+            features = self.vectors.features
+            for column in range(bisect_left(features, "a__"), len(features)):
+                if not features[column].startswith("a__"):
+                    break
+                self.language_columns[features[column][3:].lower()] = column
+        self.language_rows = {}
+        self.lock = threading.Lock()
+
+    def get_language_rows(self, language: str) -> numpy.ndarray:
+        """
+        Get rows of the developers who added code in a language.
+
+        :param language: The language, case-insensitive.
+        :return: Sorted rows.
+        """
+        key = language.lower()
+        if key not in self.language_columns:
+            if self.vectors.features is None:
+                raise ValueError("Language filters are not supported by hashed vectors")
+            return numpy.empty(0, dtype=numpy.int64)
+        with self.lock:
+            if key not in self.language_rows:
+                matrix = self.vectors.matrix
+                positions = numpy.flatnonzero(numpy.asarray(matrix.indices) == self.language_columns[key])
+                self.language_rows[key] = numpy.searchsorted(matrix.indptr, positions, side="right") - 1
+            return self.language_rows[key]
+
+
+class SearchEngine:
+    """
+    Answers similar developer queries against user vectors loaded once, with an LRU cache of the results
+    and latency statistics. With an index, the repositories mined since the last check are added to the index
+    and the vectors are reloaded when the index changes. Without an index, the vectors are calculated again
+    when the mined repositories change.
+    """
+
+    def __init__(self, jsons_path: str, index_path: str, columnar_path: str = None, n_jobs: int = N_JOBS,
+                 ann: bool = False, ann_tables: int = ANN_N_TABLES, ann_bits: int = ANN_N_BITS,
+                 n_probes: int = ANN_N_PROBES, cache_size: int = SERVE_CACHE_SIZE,
+                 latency_window: int = SERVE_LATENCY_WINDOW, vocabulary_path: str = VOCABULARY_PATH) -> None:
+        self.jsons_path = jsons_path
+        self.index_path = index_path
+        self.columnar_path = columnar_path
+        self.vocabulary_path = vocabulary_path
+        self.n_jobs = n_jobs
+        self.ann = ann
+        self.ann_tables = ann_tables
+        self.ann_bits = ann_bits
+        self.n_probes = n_probes
+        self.cache = LruCache(cache_size)
+        self.latencies = deque(maxlen=latency_window)
+        self.batch_latencies = deque(maxlen=latency_window)
+        self.queries = 0
+        self.batches = 0
+        self.reloads = 0
+        self.repositories = None
+        self.reload_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.update_index()
+        self.state = self.load()
+
+    def get_signature(self) -> list:
+        """
+        Describe the data the vectors are loaded from: the index version if there is an index,
+        otherwise the mined repositories.
+
+        :return: Signature changing with the data.
+        """
+        if VectorIndexService.exists(self.index_path):
+            return ["index", VectorIndexService.get_sources([self.index_path])[0]["mtime"]]
+        return ["repositories", VectorIndexService.get_sources(get_repository_paths(self.jsons_path, self.columnar_path))]
+
+    def update_index(self) -> bool:
+        """
+        Add the repositories mined since the last check to the index. An index that can't be updated,
+        e.g. because a repository was mined again, is served as is until build-index rebuilds it.
+
+        :return: True if the index was updated.
+        """
+        if not VectorIndexService.exists(self.index_path):
+            return False
+        paths = get_repository_paths(self.jsons_path, self.columnar_path)
+        repositories = VectorIndexService.get_sources(paths)
+        if repositories == self.repositories:
+            return False
+        self.repositories = repositories
+        with VectorIndexService.lock(self.index_path):
+            meta = VectorIndexService.get_meta(self.index_path)
+            if any("sha1" in source for source in meta["sources"]):
+                repositories = VectorIndexService.get_sources(paths, with_hashes=True)
+            ann_index = LshIndex(self.ann_tables, self.ann_bits) if self.ann else None
+            added = update_index(self.index_path, repositories, self.n_jobs, meta["hashing"], meta["shape"][1],
+                                 ann_index, self.vocabulary_path)
+        if added is None:
+            print("Index can't be updated with the mined repositories, serving it until build-index rebuilds it")
+        return bool(added)
+
+    def load(self) -> SearchState:
+        signature = self.get_signature()
+        if VectorIndexService.exists(self.index_path):
+            vectors = VectorIndexService.load(self.index_path)
+        else:
+            vectors = load_user_vectors(self.jsons_path, self.index_path, self.columnar_path, self.n_jobs,
+                                        vocabulary_path=self.vocabulary_path)
+        ann_index = load_ann_index(vectors, self.index_path, self.ann_tables, self.ann_bits) if self.ann else None
+        return SearchState(vectors, ann_index, signature)
+
+    def reload(self, force: bool = False) -> bool:
+        """
+        Update the index with new repositories and load the vectors again if the data changed.
+        Queries are answered by the old state meanwhile.
+
+        :param force: Reload even if the data didn't change.
+        :return: True if the vectors were reloaded.
+        """
+        with self.reload_lock:
+            self.update_index()
+            if not force and self.get_signature() == self.state.signature:
+                return False
+            self.state = self.load()
+            self.cache.clear()
+            self.reloads += 1
+            return True
+
+    def watch(self, interval: float, stop: threading.Event) -> None:
+        while not stop.wait(interval):
+            try:
+                if self.reload():
+                    print(f"Reloaded {len(self.state.vectors.authors)} developers")
+            except Exception as e:
+                print(f"Reload failed, serving the previous vectors: {e}")
+
+    def find(self, state: SearchState, row: int, k: int, language: str = None) -> [(int, float)]:
+        """
+        Find the most similar developers to the one in the row among all developers or the developers of a language.
+
+        :param state: Search state.
+        :param row: Row of the developer.
+        :param k: Number of similar developers.
+        :param language: Language the similar developers added code in.
+        :return: Rows and scores, the most similar first.
+        """
+        matrix = state.vectors.matrix
+        candidates = None
+        if state.ann_index is not None:
+            candidates = state.ann_index.get_candidates(matrix[row], self.n_probes)
+        if language:
+            rows = state.get_language_rows(language)
+            candidates = rows if candidates is None else numpy.intersect1d(candidates, rows, assume_unique=True)
+        query = matrix[row].toarray().ravel()
+        if candidates is None:
+            return UserVectorService.top_k(matrix, query, k, row)
+        exclude = numpy.flatnonzero(candidates == row)
+        found = UserVectorService.top_k(matrix[candidates], query, k, int(exclude[0]) if len(exclude) else None)
+        return [(int(candidates[i]), score) for i, score in found]
+
+    def search(self, names: [str], k: int, language: str = None) -> [dict]:
+        """
+        Answer a batch of queries sharing k and the language filter. Cached results are reused, the exact search
+        without filters scores all uncached developers of the batch at once.
+
+        :param names: Names of the developers.
+        :param k: Number of similar developers.
+        :param language: Language the similar developers added code in.
+        :return: Result of every query in the order of names.
+        """
+        start = time.perf_counter()
+        state = self.state
+        results = [None] * len(names)
+        missing = []
+        for i, name in enumerate(names):
+            if name not in state.vectors.author_index:
+                results[i] = {"name": name, "error": "Unknown developer"}
+                continue
+            similar = self.cache.get((name, k, language and language.lower()))
+            if similar is None:
+                missing.append(i)
+            else:
+                results[i] = {"name": name, "similar": similar}
+        if missing and state.ann_index is None and not language:
+            rows = numpy.array([state.vectors.author_index[names[i]] for i in missing], dtype=numpy.int64)
+            neighbours, scores = UserVectorService.get_knn_block(state.vectors.matrix, rows, k)
+            found = [[(int(r), float(s)) for r, s in zip(n, c) if r >= 0] for n, c in zip(neighbours, scores)]
+        else:
+            found = [self.find(state, state.vectors.author_index[names[i]], k, language) for i in missing]
+        for i, rows in zip(missing, found):
+            similar = [{"name": state.vectors.authors[r], "score": score} for r, score in rows]
+            self.cache.set((names[i], k, language and language.lower()), similar)
+            results[i] = {"name": names[i], "similar": similar}
+        latency = time.perf_counter() - start
+        with self.stats_lock:
+            self.queries += len(names)
+            if len(names) == 1:
+                self.latencies.append(latency)
+            else:
+                self.batches += 1
+                self.batch_latencies.append(latency)
+        return results
+
+    @staticmethod
+    def get_percentile(latencies: numpy.ndarray, percentile: float) -> Optional[float]:
+        return float(numpy.percentile(latencies, percentile)) if len(latencies) else None
+
+    def get_stats(self) -> dict:
+        """
+        Get the statistics of the engine. The latency percentiles of single queries and of batches
+        are reported separately, a batch is timed as a whole.
+
+        :return: Dict of the statistics.
+        """
+        with self.stats_lock:
+            latencies = numpy.array(self.latencies) * 1000
+            batch_latencies = numpy.array(self.batch_latencies) * 1000
+        state = self.state
+        return {
+            "developers": len(state.vectors.authors),
+            "features": state.vectors.matrix.shape[1],
+            "ann": state.ann_index is not None,
+            "loaded": state.loaded,
+            "reloads": self.reloads,
+            "queries": self.queries,
+            "batches": self.batches,
+            "cache_size": len(self.cache.entries),
+            "cache_hits": self.cache.hits,
+            "cache_misses": self.cache.misses,
+            "p50_ms": SearchEngine.get_percentile(latencies, 50),
+            "p99_ms": SearchEngine.get_percentile(latencies, 99),
+            "batch_p50_ms": SearchEngine.get_percentile(batch_latencies, 50),
+            "batch_p99_ms": SearchEngine.get_percentile(batch_latencies, 99),
+        }
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON API of the search engine:
+
+    GET /similar?name=...&k=20&language=Python answers one query.
+    POST /similar with {"names": [...], "k": 20, "language": "Python"} answers a batch.
+    GET /stats reports the latency percentiles of queries and batches, the cache and the loaded data.
+    POST /reload reloads the vectors.
+    """
+
+    engine: SearchEngine = None
+    max_batch: int = SERVE_MAX_BATCH
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def send_json(self, status: int, body) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def answer(self, names: [str], k, language: Optional[str], batch: bool) -> None:
+        try:
+            k = int(k)
+        except (TypeError, ValueError):
+            return self.send_json(400, {"error": "k must be an integer"})
+        if k <= 0 or not names or len(names) > self.max_batch or not all(isinstance(n, str) for n in names):
+            return self.send_json(400, {"error": f"Expected 1 to {self.max_batch} names and a positive k"})
+        try:
+            results = self.engine.search(names, k, language or None)
+        except ValueError as e:
+            return self.send_json(400, {"error": str(e)})
+        if batch:
+            return self.send_json(200, {"results": results})
+        return self.send_json(404 if "error" in results[0] else 200, results[0])
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path == "/similar":
+            return self.answer([params["name"]] if "name" in params else [], params.get("k", 20),
+                               params.get("language"), batch=False)
+        if url.path == "/stats":
+            return self.send_json(200, self.engine.get_stats())
+        self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self) -> None:
+        url = urlparse(self.path)
+        if url.path == "/reload":
+            return self.send_json(200, {"reloaded": self.engine.reload(force=True)})
+        if url.path != "/similar":
+            return self.send_json(404, {"error": "Not found"})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except json.JSONDecodeError:
+            return self.send_json(400, {"error": "Invalid json"})
+        if not isinstance(body, dict) or not isinstance(body.get("names", []), list):
+            return self.send_json(400, {"error": "Expected an object with a list of names"})
+        self.answer(body.get("names", []), body.get("k", 20), body.get("language"), batch=True)
+
+
+def serve(engine: SearchEngine, host: str, port: int, reload_seconds: float = SERVE_RELOAD_SECONDS,
+          max_batch: int = SERVE_MAX_BATCH) -> None:
+    """
+    Serve the search engine over HTTP until interrupted. The data is checked for changes in the background.
+
+    :param engine: The search engine.
+    :param host: Host to listen on.
+    :param port: Port to listen on.
+    :param reload_seconds: Interval of the checks for new data, 0 disables them.
+    :param max_batch: Max number of developers in a batch.
+    """
+    handler = type("Handler", (SearchRequestHandler,), {"engine": engine, "max_batch": max_batch})
+    server = ThreadingHTTPServer((host, port), handler)
+    stop = threading.Event()
+    if reload_seconds > 0:
+        threading.Thread(target=engine.watch, args=(reload_seconds, stop), daemon=True).start()
+    print(f"Serving {len(engine.state.vectors.authors)} developers on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        stats = engine.get_stats()
+        print(f"Answered {stats['queries']} queries, p50 {stats['p50_ms']} ms, p99 {stats['p99_ms']} ms, "
+              f"{stats['batches']} batches, p50 {stats['batch_p50_ms']} ms, p99 {stats['batch_p99_ms']} ms")
@@ -1,13 +1,69 @@
+import os
 from pathlib import Path
 
 N_JOBS = 4
+IO_WORKERS = 8
+CPU_WORKERS = os.cpu_count() or N_JOBS
+PIPELINE_QUEUE_SIZE = 16
+QUEUE_LEASE_SECONDS = 300
+QUEUE_MAX_ATTEMPTS = 3
+QUEUE_POLL_SECONDS = 2
 
 BUILD_PATH = str(Path(__file__).parent.parent.parent / "build") + "/"
 VENDOR_PATH = str(Path(__file__).parent.parent.parent / "vendor") + "/"
 TEMP_PATH = str(Path(__file__).parent.parent.parent / "temp") + "/"
+TREE_SITTER_LIBRARY = "my-languages.so"
+GRAMMARS_LOCK = "grammars.lock.json"
 
 REPOS_PATH = str(Path(TEMP_PATH) / "repos") + "/"
 JSONS_PATH = str(Path(TEMP_PATH) / "jsons") + "/"
+COLUMNAR_PATH = str(Path(TEMP_PATH) / "columnar") + "/"
+CACHE_PATH = str(Path(TEMP_PATH) / "cache") + "/"
+STATE_PATH = str(Path(TEMP_PATH) / "state") + "/"
+INDEX_PATH = str(Path(TEMP_PATH) / "index") + "/"
+KNN_GRAPH_PATH = str(Path(TEMP_PATH) / "knn_graph.npz")
+VOCABULARY_PATH = str(Path(TEMP_PATH) / "vocabulary.sqlite")
+QUEUE_PATH = str(Path(TEMP_PATH) / "queue.sqlite")
+
+GITHUB_BASE_URL = "https://api.github.com"
+GITHUB_N_THREADS = 8
+GITHUB_PER_PAGE = 100
+GITHUB_MAX_RETRIES = 5
+GITHUB_BACKOFF_SECONDS = 2
+GITHUB_CACHE_PATH = str(Path(CACHE_PATH) / "github_cache.sqlite")
+GITHUB_CACHE_TTL = 24 * 60 * 60
+GITHUB_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+BLOB_PREFETCH_COMMITS = 64
+MAX_FILE_BYTES = 1024 * 1024
+
+PARSE_CACHE_PATH = str(Path(CACHE_PATH) / "parse_cache.sqlite")
+PARSE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+PARSE_CACHE_VERSION = 2
+
+COLUMNAR_PART_ROWS = 65536
+COLUMNAR_VERSION = 2
+JSON_BLOCK_SIZE = 1024 * 1024
+
+OUTPUT_FORMATS = ["json", "columnar"]
+
+HASHING_N_FEATURES = 2 ** 20
+FEATURE_COUNTS_REDUCE_SIZE = 2 ** 22
+
+INDEX_VERSION = 2
+SEARCH_CHUNK_ROWS = 65536
+KNN_BLOCK_SIZE = 256
+
+ANN_N_TABLES = 16
+ANN_N_BITS = 8
+ANN_N_PROBES = 2
+
+SERVE_HOST = "127.0.0.1"
+SERVE_PORT = 8080
+SERVE_CACHE_SIZE = 10000
+SERVE_RELOAD_SECONDS = 60
+SERVE_LATENCY_WINDOW = 10000
+SERVE_MAX_BATCH = 1000
 
 language_names = [
     "python",
@@ -1,5 +1,7 @@
 from pathlib import Path
 
+from similar_dev_search.data.constants import MAX_FILE_BYTES
+
 
 class LineOfCode:
     def __init__(self, number: int, author: str, text: str) -> None:
@@ -17,6 +19,17 @@ class File:
         self.line_authors = line_authors
 
 
+class FileDiff:
+    def __init__(self, path: str, old_blob_id: bytes, new_blob_id: bytes, additions: int, deletions: int,
+                 new_content: bytes = None) -> None:
+        self.path = path
+        self.old_blob_id = old_blob_id
+        self.new_blob_id = new_blob_id
+        self.additions = additions
+        self.deletions = deletions
+        self.new_content = new_content
+
+
 class Change:
     def __init__(self, file_name: str, language: str, deletions: [int], additions: [int], variable_names: [str],
                  import_names: [str]) -> None:
@@ -28,11 +41,125 @@ class Change:
         self.import_names = import_names
 
 
+class EncodedChange:
+    """
+    Change with the language, variable and import names replaced by their ids in the feature vocabulary.
+    """
+
+    def __init__(self, file_name: str, language_id: int, deletions: [int], additions: [int], variable_ids: [int],
+                 import_ids: [int]) -> None:
+        self.file_name = file_name
+        self.language_id = language_id
+        self.deletions = deletions
+        self.additions = additions
+        self.variable_ids = variable_ids
+        self.import_ids = import_ids
+
+
 class Commit:
-    def __init__(self, author: bytes, parent: bytes, changes: [Change]) -> None:
+    def __init__(self, author: bytes, parent: bytes, changes: [Change], commit_id: bytes = None) -> None:
         self.author = author.decode()
         self.parent = str(parent)
         self.changes = changes
+        self.id = commit_id.decode() if commit_id is not None else None
+
+
+class CommitFilter:
+    def __init__(self, since: int = None, until: int = None, max_commits: int = None, branches: [str] = None,
+                 exclude: [bytes] = None) -> None:
+        self.since = since
+        self.until = until
+        self.max_commits = max_commits
+        self.branches = branches or []
+        self.exclude = exclude or []
+
+
+class Watermark:
+    def __init__(self, ref_tips: {str: str}, commits: int = 0) -> None:
+        self.ref_tips = ref_tips
+        self.commits = commits
+
+
+class Grammar:
+    def __init__(self, url: str, revision: str = None) -> None:
+        self.url = url
+        self.revision = revision
+
+
+class CloneOptions:
+    def __init__(self, bare: bool = False, blobless: bool = False, shallow: bool = False) -> None:
+        self.bare = bare
+        self.blobless = blobless
+        self.shallow = shallow
+
+
+class CloneStats:
+    def __init__(self, repo_path: str, action: str, mode: str, seconds: float, size: int) -> None:
+        self.repo_path = repo_path
+        self.action = action
+        self.mode = mode
+        self.seconds = seconds
+        self.size = size
+
+    def __str__(self) -> str:
+        return f"{self.repo_path}: {self.action} ({self.mode}) in {self.seconds:.1f} s, {self.size / 2 ** 20:.1f} MB on disk"
+
+
+class MiningOptions:
+    def __init__(self, tree_sitter_build_path: str, jsons_path: str, parse_cache_path: str, parse_cache_max_bytes: int,
+                 commit_filter: CommitFilter = None, state_path: str = None, refresh: bool = False,
+                 output_format: str = "json", columnar_path: str = None, clone_options: CloneOptions = None,
+                 max_file_bytes: int = MAX_FILE_BYTES, vocabulary_path: str = None) -> None:
+        self.tree_sitter_build_path = tree_sitter_build_path
+        self.jsons_path = jsons_path
+        self.parse_cache_path = parse_cache_path
+        self.parse_cache_max_bytes = parse_cache_max_bytes
+        self.commit_filter = commit_filter or CommitFilter()
+        self.state_path = state_path
+        self.refresh = refresh
+        self.output_format = output_format
+        self.columnar_path = columnar_path
+        self.clone_options = clone_options or CloneOptions()
+        self.max_file_bytes = max_file_bytes
+        self.vocabulary_path = vocabulary_path
+
+
+class StageStats:
+    """
+    Totals of one instrumented stage. Wall and CPU times include the nested stages, self times don't.
+    """
+
+    def __init__(self, calls: int = 0, items: int = 0, size: int = 0, wall: float = 0.0, cpu: float = 0.0,
+                 self_wall: float = 0.0, self_cpu: float = 0.0) -> None:
+        self.calls = calls
+        self.items = items
+        self.size = size
+        self.wall = wall
+        self.cpu = cpu
+        self.self_wall = self_wall
+        self.self_cpu = self_cpu
+
+    def add(self, other: "StageStats") -> None:
+        for name, value in vars(other).items():
+            setattr(self, name, getattr(self, name) + value)
+
+
+class MiningPlan:
+    def __init__(self, repo_name: str, repo_path: str, commit_filter: CommitFilter, ref_tips: {str: str},
+                 watermark: Watermark = None) -> None:
+        self.repo_name = repo_name
+        self.repo_path = repo_path
+        self.commit_filter = commit_filter
+        self.ref_tips = ref_tips
+        self.watermark = watermark
+
+
+class QueueChunk:
+    def __init__(self, repo: str, number: int, plan: MiningPlan, commit_ids: [bytes]) -> None:
+        self.repo = repo
+        self.number = number
+        self.plan = plan
+        self.commit_ids = commit_ids
 
 
 class Repository:
@@ -0,0 +1,194 @@
+import json
+from pathlib import Path
+import time
+
+import numpy
+from scipy.sparse import csr_matrix
+
+from similar_dev_search.data.constants import ANN_N_BITS, ANN_N_PROBES, ANN_N_TABLES, SEARCH_CHUNK_ROWS
+from similar_dev_search.services.user_vectors import UserVectors, UserVectorService
+
+
+class LshIndex:
+    """
+    Random hyperplane LSH index for the cosine similarity of sparse user vectors.
+
+    Every table hashes a vector to n_bits signs of its projections to random hyperplanes. The ±1 hyperplane
+    coordinates are derived from the feature index by multiply-shift hashing, so no projection matrix is stored.
+    A query probes its own bucket and the buckets that differ in the n_probes least confident bits in every table,
+    then the candidates are re-ranked by the exact similarity.
+
+    More tables and probes increase the recall and the latency, more bits make buckets smaller and faster to scan.
+    """
+
+    def __init__(self, n_tables: int = ANN_N_TABLES, n_bits: int = ANN_N_BITS, seed: int = 0) -> None:
+        if n_bits > 63:
+            raise ValueError("n_bits must be at most 63")
+        rng = numpy.random.default_rng(seed)
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.seed = seed
+        self.multipliers = rng.integers(0, 2 ** 62, size=n_tables * n_bits, dtype=numpy.uint64) * 2 + 1
+        self.increments = rng.integers(0, 2 ** 62, size=n_tables * n_bits, dtype=numpy.uint64)
+        self.sorted_codes = numpy.empty((n_tables, 0), dtype=numpy.uint64)
+        self.order = numpy.empty((n_tables, 0), dtype=numpy.int64)
+
+    def project(self, matrix: csr_matrix) -> numpy.ndarray:
+        """
+        Project rows of a matrix to the random hyperplanes of all tables.
+
+        :param matrix: The matrix.
+        :return: Projections, one column per hyperplane.
+        """
+        result = numpy.empty((matrix.shape[0], self.n_tables * self.n_bits), dtype=numpy.float32)
+        for start in range(0, matrix.shape[0], SEARCH_CHUNK_ROWS):
+            chunk = matrix[start:start + SEARCH_CHUNK_ROWS]
+            rows = numpy.repeat(numpy.arange(chunk.shape[0]), numpy.diff(chunk.indptr))
+            indices = chunk.indices.astype(numpy.uint64)
+            for bit in range(self.n_tables * self.n_bits):
+                signs = ((indices * self.multipliers[bit] + self.increments[bit]) >> numpy.uint64(63)).astype(
+                    numpy.float32)
+                weights = chunk.data * (1 - 2 * signs)
+                result[start:start + chunk.shape[0], bit] = numpy.bincount(rows, weights, minlength=chunk.shape[0])
+        return result
+
+    def get_codes(self, projections: numpy.ndarray) -> numpy.ndarray:
+        bits = (projections > 0).reshape(len(projections), self.n_tables, self.n_bits).astype(numpy.uint64)
+        weights = numpy.left_shift(numpy.uint64(1), numpy.arange(self.n_bits, dtype=numpy.uint64))
+        return (bits * weights).sum(axis=2, dtype=numpy.uint64)
+
+    def fit(self, matrix: csr_matrix) -> "LshIndex":
+        """
+        Hash all rows of a matrix into the tables.
+
+        :param matrix: Matrix of user vectors.
+        :return: The index.
+        """
+        return self.set_codes(self.get_codes(self.project(matrix)).T)
+
+    def set_codes(self, codes: numpy.ndarray) -> "LshIndex":
+        self.order = numpy.argsort(codes, axis=1, kind="stable")
+        self.sorted_codes = numpy.take_along_axis(codes, self.order, axis=1)
+        return self
+
+    def get_row_codes(self) -> numpy.ndarray:
+        """
+        Get the codes of the fitted rows.
+
+        :return: Codes, one row per table and one column per fitted row.
+        """
+        codes = numpy.empty(self.sorted_codes.shape, dtype=numpy.uint64)
+        numpy.put_along_axis(codes, numpy.asarray(self.order), self.sorted_codes, axis=1)
+        return codes
+
+    def update(self, matrix: csr_matrix, old_rows: numpy.ndarray, changed: numpy.ndarray) -> "LshIndex":
+        """
+        Hash the rows of an updated matrix, the unchanged rows keep their codes. The tables are the same
+        fit gives for the whole matrix.
+
+        :param matrix: The updated matrix.
+        :param old_rows: Fitted row of every row of the matrix, -1 for new rows.
+        :param changed: Rows of the matrix whose vectors changed, including the new rows.
+        :return: The index.
+        """
+        old_codes = self.get_row_codes()
+        codes = numpy.empty((self.n_tables, matrix.shape[0]), dtype=numpy.uint64)
+        kept = numpy.setdiff1d(numpy.arange(matrix.shape[0]), changed)
+        codes[:, kept] = old_codes[:, old_rows[kept]]
+        if len(changed):
+            codes[:, changed] = self.get_codes(self.project(matrix[changed])).T
+        return self.set_codes(codes)
+
+    def get_candidates(self, query: csr_matrix, n_probes: int = ANN_N_PROBES) -> numpy.ndarray:
+        """
+        Get rows sharing a probed bucket with the query in any table.
+
+        :param query: The query row.
+        :param n_probes: Number of the least confident bits flipped one at a time.
+        :return: Candidate rows.
+        """
+        projections = self.project(query)
+        codes = self.get_codes(projections)[0]
+        confidence = numpy.abs(projections[0]).reshape(self.n_tables, self.n_bits)
+        candidates = []
+        for table in range(self.n_tables):
+            probes = [codes[table]]
+            for bit in numpy.argsort(confidence[table])[:n_probes]:
+                probes.append(codes[table] ^ numpy.left_shift(numpy.uint64(1), numpy.uint64(bit)))
+            for code in probes:
+                left = numpy.searchsorted(self.sorted_codes[table], code, side="left")
+                right = numpy.searchsorted(self.sorted_codes[table], code, side="right")
+                candidates.append(self.order[table, left:right])
+        return numpy.unique(numpy.concatenate(candidates))
+
+    def search(self, vectors: UserVectors, row: int, k: int, n_probes: int = ANN_N_PROBES) -> [(int, float)]:
+        """
+        Find approximately the most similar rows to the given one.
+
+        :param vectors: L2-normalized user vectors the index was fitted on.
+        :param row: The query row.
+        :param k: Number of rows to return.
+        :param n_probes: Number of the least confident bits flipped one at a time.
+        :return: Row numbers and scores, the most similar first.
+        """
+        candidates = self.get_candidates(vectors.matrix[row], n_probes)
+        query = vectors.matrix[row].toarray().ravel()
+        exclude = numpy.flatnonzero(candidates == row)
+        found = UserVectorService.top_k(
+            vectors.matrix[candidates], query, k, int(exclude[0]) if len(exclude) else None)
+        return [(int(candidates[i]), score) for i, score in found]
+
+    def save(self, path: str) -> None:
+        directory = Path(path)
+        directory.mkdir(parents=True, exist_ok=True)
+        numpy.save(directory / "sorted_codes.npy", self.sorted_codes)
+        numpy.save(directory / "order.npy", self.order)
+        with open(directory / "meta.json", "w") as f:
+            f.write(json.dumps({"n_tables": self.n_tables, "n_bits": self.n_bits, "seed": self.seed}, indent=2))
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return (Path(path) / "meta.json").is_file()
+
+    @staticmethod
+    def load(path: str) -> "LshIndex":
+        directory = Path(path)
+        with open(directory / "meta.json", "r") as f:
+            meta = json.loads(f.read())
+        index = LshIndex(meta["n_tables"], meta["n_bits"], meta["seed"])
+        index.sorted_codes = numpy.load(directory / "sorted_codes.npy", mmap_mode="r")
+        index.order = numpy.load(directory / "order.npy", mmap_mode="r")
+        return index
+
+    def evaluate_recall(self, vectors: UserVectors, k: int, n_queries: int, n_probes: int = ANN_N_PROBES,
+                        seed: int = 0) -> dict:
+        """
+        Compare the index with the exact search on random developers.
+
+        :param vectors: L2-normalized user vectors the index was fitted on.
+        :param k: Number of similar developers.
+        :param n_queries: Number of random queries.
+        :param n_probes: Number of the least confident bits flipped one at a time.
+        :param seed: Seed of the query sampling.
+        :return: Mean recall@k, mean latencies of both searches in milliseconds and mean number of candidates.
+        """
+        rows = numpy.random.default_rng(seed).choice(
+            vectors.matrix.shape[0], min(n_queries, vectors.matrix.shape[0]), replace=False)
+        recalls, exact_times, ann_times, candidates = [], [], [], []
+        for row in rows:
+            start = time.perf_counter()
+            exact = UserVectorService.top_k(vectors.matrix, vectors.matrix[row].toarray().ravel(), k, int(row))
+            exact_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            approximate = self.search(vectors, int(row), k, n_probes)
+            ann_times.append(time.perf_counter() - start)
+            candidates.append(len(self.get_candidates(vectors.matrix[row], n_probes)))
+            expected = {r for r, score in exact if score > 0}
+            if expected:
+                recalls.append(len(expected & {r for r, _ in approximate}) / len(expected))
+        return {
+            "recall": float(numpy.mean(recalls)) if recalls else 1.0,
+            "exact_ms": float(numpy.mean(exact_times) * 1000),
+            "ann_ms": float(numpy.mean(ann_times) * 1000),
+            "candidates": float(numpy.mean(candidates)),
+        }
@@ -0,0 +1,172 @@
+import json
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from similar_dev_search.data.constants import GITHUB_CACHE_MAX_BYTES, GITHUB_CACHE_PATH, GITHUB_CACHE_TTL, \
+    PARSE_CACHE_MAX_BYTES, PARSE_CACHE_PATH, PARSE_CACHE_VERSION
+
+
+class SqliteCache:
+    """
+    Key-value store on top of SQLite with size-bounded LRU eviction.
+
+    The database is safe to share between processes: every process opens its own connection
+    and SQLite serializes the writers.
+    """
+
+    def __init__(self, path: str, table: str, max_bytes: int) -> None:
+        Path(path).resolve().parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.table = table
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)")
+        self.connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table} (accessed)")
+        self.size = self.get_size()
+
+    def get_size(self) -> int:
+        """
+        Get the total size of the stored values.
+
+        :return: Size in bytes.
+        """
+        return self.connection.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()[0]
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Get a value by a key and mark it as recently used.
+
+        :param key: The key.
+        :return: The value or None if the key is missing.
+        """
+        row = self.connection.execute(f"SELECT value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.connection.execute(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def set(self, key: str, value: bytes) -> None:
+        """
+        Store a value and evict the least recently used values if the cache is full.
+
+        :param key: The key.
+        :param value: The value.
+        """
+        self.connection.execute(
+            f"INSERT OR REPLACE INTO {self.table} (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+            (key, value, len(value), time.time()))
+        self.size += len(value)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used values until the cache takes at most 90% of its size limit.
+        """
+        self.size = self.get_size()
+        while self.size > self.max_bytes * 0.9:
+            rows = self.connection.execute(
+                f"SELECT key, size FROM {self.table} ORDER BY accessed LIMIT 256").fetchall()
+            if not rows:
+                break
+            self.connection.executemany(f"DELETE FROM {self.table} WHERE key = ?", [(row[0],) for row in rows])
+            self.size -= sum(row[1] for row in rows)
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class ParseCache:
+    """
+    Cache of parsed files keyed by a git blob id.
+
+    The file name is a part of the key, because the language detection depends on it.
+    Identical blobs in different commits, branches and forks are parsed only once.
+    """
+
+    def __init__(self, path: str = PARSE_CACHE_PATH, max_bytes: int = PARSE_CACHE_MAX_BYTES) -> None:
+        self.cache = SqliteCache(path, "parsed_blobs", max_bytes)
+
+    @staticmethod
+    def get_key(blob_id: bytes, file_name: str) -> str:
+        return f"{PARSE_CACHE_VERSION}:{blob_id.decode()}:{Path(file_name).name}"
+
+    def get(self, blob_id: bytes, file_name: str) -> Optional[Tuple[str, Dict[str, List[str]]]]:
+        """
+        Get a parsed blob.
+
+        :param blob_id: Id of the blob.
+        :param file_name: The file name with an extension.
+        :return: The language and the dict with imports and names or None if the blob wasn't parsed yet.
+        """
+        value = self.cache.get(ParseCache.get_key(blob_id, file_name))
+        if value is None:
+            return None
+        entry = json.loads(value)
+        return entry["language"], {"imports": entry["imports"], "names": entry["names"]}
+
+    def set(self, blob_id: bytes, file_name: str, language: str, code_entities: Dict[str, List[str]]) -> None:
+        """
+        Store a parsed blob.
+
+        :param blob_id: Id of the blob.
+        :param file_name: The file name with an extension.
+        :param language: The language of the blob.
+        :param code_entities: The dict with imports and names.
+        """
+        value = json.dumps({"language": language, "imports": code_entities["imports"], "names": code_entities["names"]})
+        self.cache.set(ParseCache.get_key(blob_id, file_name), value.encode())
+
+
+class HttpCache:
+    """
+    Cache of HTTP responses keyed by the url and the credentials.
+
+    A response younger than the ttl is used without a request. An older response is revalidated
+    with a conditional request using its ETag or Last-Modified. The cache can be shared between threads,
+    every thread uses its own database connection.
+    """
+
+    def __init__(self, path: str = GITHUB_CACHE_PATH, ttl: float = GITHUB_CACHE_TTL,
+                 max_bytes: int = GITHUB_CACHE_MAX_BYTES) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+
+    def get_cache(self) -> SqliteCache:
+        if not hasattr(self.local, "cache"):
+            self.local.cache = SqliteCache(self.path, "http_responses", self.max_bytes)
+        return self.local.cache
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Get a stored response.
+
+        :param key: The key of the request.
+        :return: Dict with the status, headers, body and the time of the last validation or None.
+        """
+        value = self.get_cache().get(key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key: str, status: int, headers: Dict[str, str], body: str) -> None:
+        """
+        Store a response validated now.
+
+        :param key: The key of the request.
+        :param status: Status of the response.
+        :param headers: Headers of the response.
+        :param body: Body of the response.
+        """
+        value = json.dumps({"status": status, "headers": headers, "body": body, "validated": time.time()})
+        self.get_cache().set(key, value.encode())
+
+    def is_fresh(self, entry: dict) -> bool:
+        return time.time() - entry["validated"] < self.ttl
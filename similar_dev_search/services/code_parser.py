@@ -1,8 +1,15 @@
-from typing import Dict, List
+from collections import Counter
+from pathlib import Path
+import re
+from typing import Dict, List, Optional, Tuple
 
 import enry
 from tree_sitter import Language, Parser, Tree
 from tree_sitter import Node
+from tree_sitter.binding import Query
+
+from similar_dev_search.data.constants import MAX_FILE_BYTES, TREE_SITTER_LIBRARY
+from similar_dev_search.services.profiler import profiler
 
 java_imports_used_methods_query_string = """
 (import_declaration (scoped_identifier (identifier)) @name)
@@ -62,21 +69,84 @@ property_identifier)) (arguments (arrow_function (formal_parameters (identifier)
 expression_statement (member_expression) @name) (class_declaration name: (identifier) @name) (function_declaration
     name: (identifier) @name) """
 
+# imports and names queries of the supported languages
+queries = {
+    "java": [java_imports_used_methods_query_string, java_names_query],
+    "python": [python_imports_used_methods_query_string, python_names_query_string],
+    "javascript": [js_imports_used_methods_query_string, js_names_query_string]
+}
+
+
+class TreeSitterRegistry:
+    """
+    Process-wide registry of tree-sitter languages, parsers and compiled queries.
+
+    Each grammar is loaded, each parser is created and each query is compiled once per process.
+    """
+    languages: Dict[Tuple[str, str], Language] = {}
+    parsers: Dict[Tuple[str, str], Parser] = {}
+    queries: Dict[Tuple[str, str], Query] = {}
+
+    @staticmethod
+    def get_language(language: str, tree_sitter_build_path: str) -> Language:
+        key = (tree_sitter_build_path, language)
+        if key not in TreeSitterRegistry.languages:
+            TreeSitterRegistry.languages[key] = Language(tree_sitter_build_path + TREE_SITTER_LIBRARY, language)
+        return TreeSitterRegistry.languages[key]
+
+    @staticmethod
+    def get_parser(language: str, tree_sitter_build_path: str) -> Parser:
+        key = (tree_sitter_build_path, language)
+        if key not in TreeSitterRegistry.parsers:
+            parser = Parser()
+            parser.set_language(TreeSitterRegistry.get_language(language, tree_sitter_build_path))
+            TreeSitterRegistry.parsers[key] = parser
+        return TreeSitterRegistry.parsers[key]
+
+    @staticmethod
+    def get_query(language: str, tree_sitter_build_path: str) -> Query:
+        """
+        Get the combined imports and names query. Its capture names are prefixed with "imports." or "names.".
+
+        :param language: Lowercase language name.
+        :param tree_sitter_build_path: Path to tree_sitter build folder.
+        :return: Compiled query.
+        """
+        key = (tree_sitter_build_path, language)
+        if key not in TreeSitterRegistry.queries:
+            query_str = TreeSitterRegistry.combine_queries(dict(zip(["imports", "names"], queries[language])))
+            TreeSitterRegistry.queries[key] = TreeSitterRegistry.get_language(
+                language, tree_sitter_build_path).query(query_str)
+        return TreeSitterRegistry.queries[key]
+
+    @staticmethod
+    def combine_queries(query_strings: Dict[str, str]) -> str:
+        """
+        Combine several queries into one, prefixing capture names with the query key.
+
+        :param query_strings: Dict of query key and query string.
+        :return: Combined query string.
+        """
+        return "\n".join(
+            re.sub(r"@([\w.]+)", lambda match, k=key: "@" + k + "." + match.group(1), query_str)
+            for key, query_str in query_strings.items())
+
 
 class CodeEntitiesParser:
     @staticmethod
-    def process_query(query_str, language: Language, code: bytes, root_node: Node) -> List[str]:
+    def process_query(query: Query, code: bytes, root_node: Node) -> Dict[str, List[str]]:
         """
-        Processes query using query_str for LANGUAGE.
+        Processes a combined query routing captures by the capture name prefix.
 
-        :param query_str: query string to extract info.
-        :param language: Language instance.
+        :param query: Compiled query from TreeSitterRegistry.
         :param code: Part of code represented in bytes(str) utf8 encoding.
         :param root_node: Root of the parsed tree.
-        :return: Returns list of queried results.
+        :return: Returns dict with list of queried results for each capture name prefix.
         """
-        query = language.query(query_str)
-        return list(set([code[x[0].start_byte: x[0].end_byte].decode() for x in query.captures(root_node)]))
+        result = {"imports": set(), "names": set()}
+        for node, capture_name in query.captures(root_node):
+            result[capture_name.split(".", 1)[0]].add(code[node.start_byte: node.end_byte].decode())
+        return {key: list(values) for key, values in result.items()}
 
     @staticmethod
     def process_tree_sitter(language: str, code: bytes, tree, tree_sitter_build_path: str) -> Dict:
@@ -91,17 +161,8 @@ class CodeEntitiesParser:
         """
         if language == "unknown":
             return {"imports": [], "names": []}
-        parse_lang = Language(tree_sitter_build_path + "my-languages.so", language.lower())
-        choice = {
-            "java": [java_imports_used_methods_query_string, java_names_query],
-            "python": [python_imports_used_methods_query_string, python_names_query_string],
-            "javascript": [js_imports_used_methods_query_string, js_names_query_string]
-        }
-        imports_and_names = {
-            "imports": CodeEntitiesParser.process_query(choice[parse_lang.name][0], parse_lang, code, tree.root_node),
-            "names": CodeEntitiesParser.process_query(choice[parse_lang.name][1], parse_lang, code, tree.root_node)
-        }
-        return imports_and_names
+        query = TreeSitterRegistry.get_query(language.lower(), tree_sitter_build_path)
+        return CodeEntitiesParser.process_query(query, code, tree.root_node)
 
     @staticmethod
     def parse_code(code: bytes, parser: Parser) -> Tree:
@@ -116,8 +177,7 @@ class CodeEntitiesParser:
 
     @staticmethod
     def go_parse(language: str, code: bytes, tree_sitter_build_path: str):
-        parser = Parser()
-        parser.set_language(Language(tree_sitter_build_path + "my-languages.so", language.lower()))
+        parser = TreeSitterRegistry.get_parser(language.lower(), tree_sitter_build_path)
         tree = CodeEntitiesParser.parse_code(code, parser)
         return CodeEntitiesParser.process_tree_sitter(language, code, tree, tree_sitter_build_path)
 
@@ -130,39 +190,122 @@ class CodeEntitiesParser:
         :return: Returns dictionary with used imports and named fields, variables and methods.
         """
         code = bytes(code_str, "utf8")
-        language = list({"java", "javascript", "python"} & set([x.lower() for x in languages]))
+        language = list(queries.keys() & set([x.lower() for x in languages]))
         language = language[0] if len(language) > 0 else "unknown"
         if language != "unknown":
-            return CodeEntitiesParser.go_parse(language, code, tree_sitter_build_path)
+            with profiler.stage("tree_sitter", items=1, size=len(code)):
+                return CodeEntitiesParser.go_parse(language, code, tree_sitter_build_path)
         return {"imports": [], "names": []}
 
 
-class LanguagesProvider:
+class FileClassifier:
+    """
+    Decides which changed files are mined and detects their languages, running the cheap rules first.
+
+    Vendored files are skipped by the path before any content is read. Oversized files are skipped by the size,
+    which is taken from the object header when possible, binary and generated files by the raw content before
+    it is diffed, decoded or parsed. The language is taken from the file name
+    or the extension when enry is sure about it, the content-based detection runs only for ambiguous names.
+    Counters record how many files every rule eliminated or classified and how many files failed.
+    """
+
+    def __init__(self, max_file_bytes: int = MAX_FILE_BYTES) -> None:
+        self.max_file_bytes = max_file_bytes
+        self.counters = Counter()
+
     @staticmethod
-    def get_language_by_name_and_content(file_name: str, content: str) -> str:
+    def is_vendor(path: str) -> bool:
+        return enry.is_vendor(path)
+
+    def get_skip_reason_by_path(self, path: str) -> Optional[str]:
         """
-        Get language name by a file name and a file content.
+        Check the path rules.
 
-        :param file_name: The file name with an extension.
-        :param content: The content of the file.
-        :return: The language name.
+        :param path: The path of the file in the repository.
+        :return: The rule that eliminated the file or None if the file passed.
         """
-        language = enry.get_language(file_name, str.encode(content))
-        if language == "":
-            return "Other"
-        return language
+        self.counters["files"] += 1
+        with profiler.stage("enry"):
+            vendor = FileClassifier.is_vendor(path)
+        if vendor:
+            self.counters["skipped_vendor"] += 1
+            return "vendor"
+        return None
 
-    @staticmethod
-    def get_language(filename: str, file_path: str) -> str:
+    def get_skip_reason_by_size(self, size: int) -> Optional[str]:
+        """
+        Check the size rule, the size can be taken from the object header before the content is read.
+
+        :param size: The size of the file in bytes.
+        :return: The rule that eliminated the file or None if the file passed.
+        """
+        if size > self.max_file_bytes:
+            self.counters["skipped_oversized"] += 1
+            return "oversized"
+        return None
+
+    def get_skip_reason_by_content(self, path: str, content: bytes) -> Optional[str]:
+        """
+        Check the raw content rules.
+
+        :param path: The path of the file in the repository.
+        :param content: The raw content of the file.
+        :return: The rule that eliminated the file or None if the file passed.
+        """
+        reason = self.get_skip_reason_by_size(len(content))
+        if reason is not None:
+            return reason
+        with profiler.stage("enry", size=len(content)):
+            if enry.is_binary(content):
+                reason = "binary"
+            elif enry.is_generated(path, content):
+                reason = "generated"
+        if reason is not None:
+            self.counters["skipped_" + reason] += 1
+        return reason
+
+    def record_error(self, path: str, error: Exception) -> None:
         """
-        Get language by a file name and a file path.
+        Count and report a file that was skipped because it can't be read or parsed.
 
-        :param filename: The file name with an extencion.
-        :param file_path: The path to the file.
+        :param path: The path of the file in the repository.
+        :param error: The error.
+        """
+        self.counters["skipped_error"] += 1
+        print(f"Skipped {path}: {type(error).__name__}: {error}")
+
+    def get_language_by_name(self, path: str) -> Optional[str]:
+        """
+        Detect the language by the file name or the extension.
+
+        :param path: The path of the file.
+        :return: The language or None if the name is ambiguous.
+        """
+        name = Path(path).name
+        for stage, guess in [("filename", enry.get_language_by_filename), ("extension", enry.get_language_by_extension)]:
+            with profiler.stage("enry"):
+                result = guess(name)
+            if result.safe and result.language:
+                self.counters["language_by_" + stage] += 1
+                return result.language
+        return None
+
+    def get_language_by_content(self, path: str, content: bytes) -> str:
+        self.counters["language_by_content"] += 1
+        with profiler.stage("enry", size=len(content)):
+            return enry.get_language(Path(path).name, content) or "Other"
+
+    def get_language(self, path: str, content: bytes) -> str:
+        """
+        Detect the language by the name and fall back to the content if the name is ambiguous.
+
+        :param path: The path of the file.
+        :param content: The raw content of the file.
         :return: The language name.
         """
-        with open(file_path) as f:
-            try:
-                return LanguagesProvider.get_language_by_name_and_content(filename, f.read())
-            except UnicodeDecodeError:
-                return "Other"
+        language = self.get_language_by_name(path)
+        return language if language is not None else self.get_language_by_content(path, content)
+
+    @staticmethod
+    def is_parsed(language: str) -> bool:
+        return language.lower() in queries
@@ -0,0 +1,300 @@
+import json
+import os
+from pathlib import Path
+import shutil
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy
+
+from similar_dev_search.data.constants import COLUMNAR_PART_ROWS, COLUMNAR_VERSION
+from similar_dev_search.data.models import Commit, Watermark
+from similar_dev_search.services.file_system import JsonService
+
+STRING_COLUMNS = ["author", "commit", "language"]
+NUMBER_COLUMNS = ["additions", "deletions"]
+LIST_COLUMNS = ["names", "imports"]
+COLUMNS = ["author", "repo", "commit", "language", "additions", "deletions", "names", "imports"]
+
+
+def encode_strings(strings: List[str]) -> (numpy.ndarray, numpy.ndarray):
+    """
+    Encode strings to utf8 bytes concatenated into one array.
+
+    :param strings: The strings.
+    :return: Offsets of the strings and the bytes.
+    """
+    encoded = [s.encode("utf8", "surrogateescape") for s in strings]
+    offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return offsets, numpy.frombuffer(b"".join(encoded), dtype=numpy.uint8)
+
+
+def decode_strings(offsets: numpy.ndarray, data: numpy.ndarray) -> List[str]:
+    raw = data.tobytes()
+    return [raw[offsets[i]:offsets[i + 1]].decode("utf8", "surrogateescape") for i in range(len(offsets) - 1)]
+
+
+class StringColumn:
+    """
+    Dictionary-encoded string column: row i holds dictionary[codes[i]].
+    A column of encoded changes has no dictionary, its codes are ids in the feature vocabulary.
+    """
+
+    def __init__(self, codes: numpy.ndarray, dictionary: Optional[List[str]]) -> None:
+        self.codes = codes
+        self.dictionary = dictionary
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, i: int) -> str:
+        return self.dictionary[self.codes[i]]
+
+
+class ListColumn:
+    """
+    Dictionary-encoded column of string lists: row i holds the codes[offsets[i]:offsets[i + 1]] strings.
+    A column of encoded changes has no dictionary, its codes are ids in the feature vocabulary.
+    """
+
+    def __init__(self, offsets: numpy.ndarray, codes: numpy.ndarray, dictionary: Optional[List[str]]) -> None:
+        self.offsets = offsets
+        self.codes = codes
+        self.dictionary = dictionary
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> List[str]:
+        return [self.dictionary[code] for code in self.codes[self.offsets[i]:self.offsets[i + 1]]]
+
+
+class ColumnarWriter:
+    """
+    Writes mined commits of a repository as one row per change into parts of numpy columns.
+
+    Commits with encoded changes are written to parts of their own, where the language, names and imports
+    columns hold the vocabulary ids and have no dictionaries.
+
+    A new repository is written to a directory with the ".part" suffix which is renamed when the writer is closed.
+    In the append mode new parts are added to the existing directory and become visible when the metadata is
+    replaced, so an interrupted export never leaves broken data. A watermark set before the writer is closed
+    is saved in the metadata, so it is replaced together with the parts it describes.
+    """
+
+    def __init__(self, path: str, repository_name: str, append: bool = False,
+                 part_rows: int = COLUMNAR_PART_ROWS) -> None:
+        directory = Path(path).resolve()
+        directory.mkdir(parents=True, exist_ok=True)
+        self.repository_name = repository_name
+        self.path = directory / repository_name
+        self.append = append and (self.path / "meta.json").is_file()
+        if self.append:
+            self.directory = self.path
+            self.meta = ColumnarReader(str(self.path)).meta
+        else:
+            self.directory = directory / (repository_name + ".part")
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory.mkdir()
+            self.meta = {"version": COLUMNAR_VERSION, "repo": repository_name, "parts": [], "rows": 0, "commits": 0}
+        self.part_rows = part_rows
+        self.new_parts = []
+        self.rows = {column: [] for column in STRING_COLUMNS + NUMBER_COLUMNS + LIST_COLUMNS}
+        self.encoded = False
+        self.watermark: Optional[Watermark] = None
+        self.count = 0
+
+    def write(self, commit: Commit) -> None:
+        commit = commit if isinstance(commit, dict) else vars(commit)
+        for change in commit["changes"]:
+            change = change if isinstance(change, dict) else vars(change)
+            encoded = "language_id" in change
+            if encoded != self.encoded:
+                self.flush()
+                self.encoded = encoded
+            self.rows["author"].append(commit["author"])
+            self.rows["commit"].append(commit.get("id") or "")
+            self.rows["additions"].append(change["additions"])
+            self.rows["deletions"].append(change["deletions"])
+            if encoded:
+                self.rows["language"].append(change["language_id"])
+                self.rows["names"].append(change["variable_ids"])
+                self.rows["imports"].append(change["import_ids"])
+            else:
+                self.rows["language"].append(change["language"])
+                self.rows["names"].append(change["variable_names"])
+                self.rows["imports"].append(change["import_names"])
+        self.count += 1
+        if len(self.rows["author"]) >= self.part_rows:
+            self.flush()
+
+    @staticmethod
+    def save_dictionary(path: Path, column: str, dictionary: Dict[str, int]) -> None:
+        offsets, data = encode_strings(list(dictionary.keys()))
+        numpy.save(path / (column + ".dict.offsets.npy"), offsets)
+        numpy.save(path / (column + ".dict.data.npy"), data)
+
+    def flush(self) -> None:
+        """
+        Write the buffered rows as a new part.
+        """
+        row_count = len(self.rows["author"])
+        if row_count == 0:
+            return
+        name = "part-%05d" % (len(self.meta["parts"]) + len(self.new_parts))
+        part = self.directory / name
+        part.mkdir()
+        for column in STRING_COLUMNS:
+            if self.encoded and column == "language":
+                numpy.save(part / "language.ids.npy", numpy.array(self.rows[column], dtype=numpy.int32))
+                continue
+            dictionary = {}
+            codes = numpy.array([dictionary.setdefault(v, len(dictionary)) for v in self.rows[column]], dtype=numpy.int32)
+            numpy.save(part / (column + ".codes.npy"), codes)
+            ColumnarWriter.save_dictionary(part, column, dictionary)
+        for column in NUMBER_COLUMNS:
+            numpy.save(part / (column + ".npy"), numpy.array(self.rows[column], dtype=numpy.int32))
+        for column in LIST_COLUMNS:
+            dictionary = {}
+            offsets = numpy.zeros(row_count + 1, dtype=numpy.int64)
+            numpy.cumsum([len(values) for values in self.rows[column]], out=offsets[1:])
+            numpy.save(part / (column + ".offsets.npy"), offsets)
+            if self.encoded:
+                ids = numpy.array([v for values in self.rows[column] for v in values], dtype=numpy.int32)
+                numpy.save(part / (column + ".ids.npy"), ids)
+                continue
+            codes = numpy.array(
+                [dictionary.setdefault(v, len(dictionary)) for values in self.rows[column] for v in values],
+                dtype=numpy.int32)
+            numpy.save(part / (column + ".codes.npy"), codes)
+            ColumnarWriter.save_dictionary(part, column, dictionary)
+        self.new_parts.append((name, row_count))
+        self.rows = {column: [] for column in self.rows}
+
+    def close(self) -> None:
+        self.flush()
+        self.meta["version"] = COLUMNAR_VERSION
+        self.meta["parts"] += [name for name, _ in self.new_parts]
+        self.meta["rows"] += sum(rows for _, rows in self.new_parts)
+        self.meta["commits"] += self.count
+        if self.watermark is not None:
+            self.meta["watermark"] = vars(self.watermark)
+        with open(self.directory / "meta.json.part", "w") as f:
+            f.write(json.dumps(self.meta, indent=2))
+        os.replace(self.directory / "meta.json.part", self.directory / "meta.json")
+        if not self.append:
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.replace(self.directory, self.path)
+
+    def abort(self) -> None:
+        if self.append:
+            for name, _ in self.new_parts:
+                shutil.rmtree(self.directory / name, ignore_errors=True)
+        else:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self) -> "ColumnarWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ColumnarReader:
+    """
+    Reads parts of a columnar repository. Only the requested columns are loaded and numeric arrays are memory-mapped.
+    Repositories of the older versions are readable, their parts have no encoded changes.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = Path(path).resolve()
+        with open(self.path / "meta.json", "r") as f:
+            self.meta = json.loads(f.read())
+        if self.meta["version"] > COLUMNAR_VERSION:
+            raise ValueError(f"Unsupported columnar format version {self.meta['version']} in {self.path}")
+
+    @staticmethod
+    def load_dictionary(path: Path, column: str) -> List[str]:
+        return decode_strings(
+            numpy.load(path / (column + ".dict.offsets.npy"), mmap_mode="r"),
+            numpy.load(path / (column + ".dict.data.npy"), mmap_mode="r"))
+
+    def read_part(self, name: str, columns: Iterable[str] = None) -> dict:
+        """
+        Read one part.
+
+        :param name: Name of the part.
+        :param columns: Columns to read, all columns by default.
+        :return: Dict of the column name and the column.
+        """
+        part = self.path / name
+        result = {}
+        for column in columns or COLUMNS:
+            if column == "repo":
+                rows = len(numpy.load(part / "additions.npy", mmap_mode="r"))
+                result[column] = StringColumn(numpy.zeros(rows, dtype=numpy.int32), [self.meta["repo"]])
+            elif column == "language" and (part / "language.ids.npy").is_file():
+                result[column] = StringColumn(numpy.load(part / "language.ids.npy", mmap_mode="r"), None)
+            elif column in STRING_COLUMNS:
+                result[column] = StringColumn(
+                    numpy.load(part / (column + ".codes.npy"), mmap_mode="r"),
+                    ColumnarReader.load_dictionary(part, column))
+            elif column in NUMBER_COLUMNS:
+                result[column] = numpy.load(part / (column + ".npy"), mmap_mode="r")
+            elif column in LIST_COLUMNS and (part / (column + ".ids.npy")).is_file():
+                result[column] = ListColumn(
+                    numpy.load(part / (column + ".offsets.npy"), mmap_mode="r"),
+                    numpy.load(part / (column + ".ids.npy"), mmap_mode="r"),
+                    None)
+            elif column in LIST_COLUMNS:
+                result[column] = ListColumn(
+                    numpy.load(part / (column + ".offsets.npy"), mmap_mode="r"),
+                    numpy.load(part / (column + ".codes.npy"), mmap_mode="r"),
+                    ColumnarReader.load_dictionary(part, column))
+            else:
+                raise KeyError(column)
+        return result
+
+    def read(self, columns: Iterable[str] = None) -> Iterator[dict]:
+        """
+        Read all parts one by one.
+
+        :param columns: Columns to read, all columns by default.
+        :return: Dicts of the column name and the column, one per part.
+        """
+        for name in self.meta["parts"]:
+            yield self.read_part(name, columns)
+
+
+class ColumnarService:
+    @staticmethod
+    def get_repository_paths(directory: str) -> Iterator[str]:
+        """
+        Get absolute paths of the columnar repositories in a directory.
+
+        :param directory: The directory with columnar repositories.
+        :return: Absolute paths.
+        """
+        if not os.path.isdir(directory):
+            return
+        for name in sorted(os.listdir(directory)):
+            path = os.path.abspath(os.path.join(directory, name))
+            if os.path.isfile(os.path.join(path, "meta.json")) and not name.endswith(".part"):
+                yield path
+
+    @staticmethod
+    def convert_json(json_path: str, columnar_path: str) -> int:
+        """
+        Convert a repository json file to the columnar format streaming its commits.
+
+        :param json_path: Path to the json file.
+        :param columnar_path: The directory with columnar repositories.
+        :return: Number of converted commits.
+        """
+        with ColumnarWriter(columnar_path, Path(json_path).stem) as writer:
+            for commit in JsonService.iter_commits(json_path):
+                writer.write(commit)
+            return writer.count
@@ -0,0 +1,246 @@
+from difflib import SequenceMatcher
+from typing import Iterator, List, Optional
+import zlib
+
+from dulwich.diff_tree import TreeChange, tree_changes
+from dulwich.errors import ApplyDeltaError, ChecksumMismatch, FileFormatException
+from dulwich.object_store import BaseObjectStore, DiskObjectStore
+from dulwich.objects import S_ISGITLINK, hex_to_filename
+from dulwich.pack import OFS_DELTA, Pack, REF_DELTA, take_msb_bytes
+from dulwich.patch import is_binary
+
+from similar_dev_search.data.models import FileDiff
+from similar_dev_search.services.code_parser import FileClassifier
+from similar_dev_search.services.profiler import profiler
+
+# Errors of reading a missing or broken object
+OBJECT_ERRORS = (KeyError, OSError, zlib.error, ApplyDeltaError, ChecksumMismatch, FileFormatException)
+
+
+class TreeDiffService:
+    @staticmethod
+    def count_non_blank(lines: List[bytes]) -> int:
+        return sum(1 for line in lines if line.strip() != b"")
+
+    @staticmethod
+    def count_changed_lines(old_content: bytes, new_content: bytes) -> (int, int):
+        """
+        Count added and removed non-blank lines between two versions of a file.
+        The common prefix and suffix are skipped before running the line diff.
+
+        :param old_content: The old version of the file.
+        :param new_content: The new version of the file.
+        :return: Number of added and removed lines.
+        """
+        old_lines = old_content.splitlines()
+        new_lines = new_content.splitlines()
+        start = 0
+        while start < len(old_lines) and start < len(new_lines) and old_lines[start] == new_lines[start]:
+            start += 1
+        old_end, new_end = len(old_lines), len(new_lines)
+        while old_end > start and new_end > start and old_lines[old_end - 1] == new_lines[new_end - 1]:
+            old_end -= 1
+            new_end -= 1
+        old_lines = old_lines[start:old_end]
+        new_lines = new_lines[start:new_end]
+        if not old_lines or not new_lines:
+            return TreeDiffService.count_non_blank(new_lines), TreeDiffService.count_non_blank(old_lines)
+        additions, deletions = 0, 0
+        for tag, i1, i2, j1, j2 in SequenceMatcher(None, old_lines, new_lines).get_opcodes():
+            if tag != "equal":
+                deletions += TreeDiffService.count_non_blank(old_lines[i1:i2])
+                additions += TreeDiffService.count_non_blank(new_lines[j1:j2])
+        return additions, deletions
+
+    @staticmethod
+    def get_path(change: TreeChange) -> str:
+        return (change.new.path if change.new.path is not None else change.old.path).decode("utf-8", "replace")
+
+    @staticmethod
+    def read_varints(data: bytes, count: int) -> [int]:
+        """
+        Read little-endian base-128 varints of a delta header.
+
+        :param data: Start of the inflated delta.
+        :param count: Number of the varints.
+        :return: The values.
+        """
+        values, value, shift = [], 0, 0
+        for byte in data:
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                values.append(value)
+                if len(values) == count:
+                    return values
+                value, shift = 0, 0
+        raise ValueError("Truncated delta header")
+
+    @staticmethod
+    def get_packed_size(pack: Pack, sha: bytes) -> Optional[int]:
+        """
+        Get the size of a packed object from its entry header. The size of a delta is taken from the header
+        of the delta, only its first bytes are inflated.
+
+        :param pack: The pack.
+        :param sha: Hex id of the object.
+        :return: The size or None if the object isn't in the pack.
+        """
+        try:
+            offset = pack.index.object_index(sha)
+        except KeyError:
+            return None
+        pack_file = pack.data._file
+        pack_file.seek(offset)
+        header, _ = take_msb_bytes(pack_file.read)
+        type_num = (header[0] >> 4) & 0x07
+        size = header[0] & 0x0F
+        for i, byte in enumerate(header[1:]):
+            size += (byte & 0x7F) << (i * 7 + 4)
+        if type_num == OFS_DELTA:
+            take_msb_bytes(pack_file.read)
+        elif type_num == REF_DELTA:
+            pack_file.read(20)
+        else:
+            return size
+        # a delta starts with the sizes of its base and of the object, at most 10 bytes each
+        decompressor = zlib.decompressobj()
+        delta = b""
+        while len(delta) < 20 and not decompressor.eof:
+            chunk = pack_file.read(64)
+            if not chunk:
+                break
+            delta += decompressor.decompress(chunk)
+        return TreeDiffService.read_varints(delta, 2)[1]
+
+    @staticmethod
+    def get_loose_size(object_store: DiskObjectStore, sha: bytes) -> Optional[int]:
+        """
+        Get the size of a loose object from its "<type> <size>" header, inflating only the header.
+
+        :param object_store: The object store of the repository.
+        :param sha: Hex id of the object.
+        :return: The size or None if the object isn't loose.
+        """
+        try:
+            with open(hex_to_filename(object_store.path, sha), "rb") as f:
+                decompressor = zlib.decompressobj()
+                header = b""
+                while b"\0" not in header and len(header) < 64:
+                    chunk = f.read(64)
+                    if not chunk:
+                        return None
+                    header += decompressor.decompress(chunk)
+        except FileNotFoundError:
+            return None
+        _, _, size = header.partition(b"\0")[0].partition(b" ")
+        return int(size) if size.isdigit() else None
+
+    @staticmethod
+    def get_object_size(object_store: BaseObjectStore, sha: bytes) -> Optional[int]:
+        """
+        Get the size of an object of a repository on disk without inflating it.
+
+        :param object_store: The object store of the repository.
+        :param sha: Hex id of the object.
+        :return: The size or None if the object store isn't on disk or the object is missing.
+        """
+        if not isinstance(object_store, DiskObjectStore):
+            return None
+        for pack in object_store.packs:
+            size = TreeDiffService.get_packed_size(pack, sha)
+            if size is not None:
+                return size
+        return TreeDiffService.get_loose_size(object_store, sha)
+
+    @staticmethod
+    def read_blob(object_store: BaseObjectStore, sha: Optional[bytes]) -> bytes:
+        if sha is None:
+            return b""
+        with profiler.stage("blob_read", items=1) as measurement:
+            content = object_store[sha].as_raw_string()
+            measurement.size = len(content)
+        return content
+
+    @staticmethod
+    def get_file_diff(object_store: BaseObjectStore, change: TreeChange,
+                      classifier: FileClassifier = None) -> Optional[FileDiff]:
+        """
+        Get a diff of one file. Submodules and mode-only changes are skipped, binary files have no line diff.
+        The classifier rules run on the new version of the file, or the old one if the file was deleted:
+        the size is taken from the object header before anything is inflated, the old version is read only
+        if the file passed the binary and generated rules. The new version is kept in the diff for parsing.
+
+        :param object_store: The object store of the repository.
+        :param change: The change of the file between two trees.
+        :param classifier: Classifier skipping vendored, oversized, binary and generated files.
+        :return: The file diff or None if the file should be skipped.
+        """
+        old, new = change.old, change.new
+        if old.sha == new.sha or any(entry.mode is not None and S_ISGITLINK(entry.mode) for entry in (old, new)):
+            return None
+        path = TreeDiffService.get_path(change)
+        checked = new if new.sha is not None else old
+        if classifier is not None:
+            if classifier.get_skip_reason_by_path(path) is not None:
+                return None
+            size = TreeDiffService.get_object_size(object_store, checked.sha)
+            if size is not None and classifier.get_skip_reason_by_size(size) is not None:
+                return None
+        checked_content = TreeDiffService.read_blob(object_store, checked.sha)
+        if classifier is not None and classifier.get_skip_reason_by_content(path, checked_content) is not None:
+            return None
+        old_content = TreeDiffService.read_blob(object_store, old.sha) if checked is new else checked_content
+        new_content = checked_content if checked is new else b""
+        if is_binary(old_content) or is_binary(new_content):
+            return FileDiff(path, old.sha, new.sha, 0, 0, new_content)
+        additions, deletions = TreeDiffService.count_changed_lines(old_content, new_content)
+        return FileDiff(path, old.sha, new.sha, additions, deletions, new_content)
+
+    @staticmethod
+    def get_blob_ids(object_store: BaseObjectStore, old_tree_id: bytes, new_tree_id: bytes,
+                     classifier: FileClassifier = None) -> [bytes]:
+        """
+        Get ids of the blobs needed to diff two trees. Only trees are read, so missing blobs can be fetched first.
+
+        :param object_store: The object store of the repository.
+        :param old_tree_id: Id of the old tree.
+        :param new_tree_id: Id of the new tree.
+        :param classifier: Classifier whose path rules exclude blobs that won't be read.
+        :return: Blob ids.
+        """
+        blob_ids = []
+        for change in tree_changes(object_store, old_tree_id, new_tree_id):
+            old, new = change.old, change.new
+            if old.sha == new.sha or any(entry.mode is not None and S_ISGITLINK(entry.mode) for entry in (old, new)):
+                continue
+            if classifier is not None and FileClassifier.is_vendor(TreeDiffService.get_path(change)):
+                continue
+            blob_ids += [entry.sha for entry in (old, new) if entry.sha is not None]
+        return blob_ids
+
+    @staticmethod
+    def get_tree_diff(object_store: BaseObjectStore, old_tree_id: bytes, new_tree_id: bytes,
+                      classifier: FileClassifier = None) -> Iterator[FileDiff]:
+        """
+        Get diffs of all files changed between two trees. A file with a missing or broken object is skipped
+        without affecting the others and counted by the classifier.
+
+        :param object_store: The object store of the repository.
+        :param old_tree_id: Id of the old tree.
+        :param new_tree_id: Id of the new tree.
+        :param classifier: Classifier skipping vendored, oversized, binary and generated files.
+        :return: File diffs.
+        """
+        for change in tree_changes(object_store, old_tree_id, new_tree_id):
+            try:
+                file_diff = TreeDiffService.get_file_diff(object_store, change, classifier)
+            except OBJECT_ERRORS as e:
+                path = TreeDiffService.get_path(change)
+                if classifier is not None:
+                    classifier.record_error(path, e)
+                else:
+                    print(f"Skipped {path}: {type(e).__name__}: {e}")
+                continue
+            if file_diff is not None:
+                yield file_diff
@@ -1,44 +1,79 @@
 import json
 import os
 from pathlib import Path
-from typing import Iterator
+import re
+import shutil
+from typing import Iterator, Optional, TextIO
 
-from github import Repository
+from similar_dev_search.data.constants import JSON_BLOCK_SIZE
+from similar_dev_search.data.models import Commit, File, Watermark
 
-from similar_dev_search.data.models import File
+ARRAY_SEPARATORS = re.compile(r"[\s,]*")
 
 
 class JsonService:
     @staticmethod
-    def export_to_json(path: str, repository_name: str, repository: Repository) -> None:
+    def iter_commits(path: str) -> Iterator[dict]:
         """
-        Export a repository object to a file with json format.
+        Read commits of a repository json file one by one.
+        Files written by JsonStreamWriter hold a commit per line and are streamed line by line,
+        commits of other files are decoded one by one from blocks of the file.
 
-        :param path: The path to the file.
-        :param repository_name: The name of the repository.
-        :param repository: The repository object.
+        :param path: The path to the json file.
+        :return: Commits.
         """
-        directory = Path(path).resolve()
-        directory.mkdir(parents=True, exist_ok=True)
-        with open((directory / repository_name).__str__() + ".json", "w") as f:
-            json_data = json.dumps(repository, indent=2, default=lambda x: x.__dict__)
-            f.write(json_data)
+        with open(path, "r") as f:
+            if f.readline().strip() != '{"commits": [':
+                f.seek(0)
+                yield from JsonService.iter_array_items(f)
+                return
+            for line in f:
+                line = line.strip().rstrip(",")
+                if line == "]}":
+                    return
+                if line != "":
+                    yield json.loads(line)
+
+    @staticmethod
+    def iter_array_items(f: TextIO, block_size: int = JSON_BLOCK_SIZE) -> Iterator[dict]:
+        """
+        Decode the items of the first array of a json file one by one, so only a block of the file
+        and one item are held in memory. The array is the commits array of a repository file.
+
+        :param f: The file.
+        :param block_size: Number of characters read at once.
+        :return: Items of the array.
+        """
+        decoder = json.JSONDecoder()
+        buffer = ""
+        while "[" not in buffer:
+            buffer = f.read(block_size)
+            if not buffer:
+                return
+        position = buffer.index("[") + 1
+        while True:
+            position = ARRAY_SEPARATORS.match(buffer, position).end()
+            if position < len(buffer) and buffer[position] == "]":
+                return
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                block = f.read(block_size)
+                if not block:
+                    raise
+                buffer, position = buffer[position:] + block, 0
+                continue
+            yield item
 
     @staticmethod
-    def get_from_json(paths: [str]) -> list:
+    def get_json_paths(directory: str) -> Iterator[str]:
         """
-        Extract all json data from a file list.
+        Get absolute paths of the repository json files in a directory.
 
-        :param paths: The json file list.
-        :return: Extracted json data.
+        :param directory: The directory to search json files.
+        :return: Absolute file paths.
         """
-        repositories = []
-        for p in paths:
-            path = Path(p).resolve().__str__()
-            with open(path, "r") as f:
-                repository = json.loads(f.read())
-                repositories.append(repository)
-        return repositories
+        return (p for p in JsonService.absolute_file_paths(directory) if p.endswith(".json"))
 
     @staticmethod
     def absolute_file_paths(directory: str):
@@ -53,6 +88,122 @@ class JsonService:
                 yield os.path.abspath(os.path.join(dirpath, f))
 
 
+class JsonStreamWriter:
+    """
+    Writes a repository json file commit by commit, so the repository is never held in memory.
+
+    The commits are written next to the target with the ".part" suffix and moved to the target when the writer
+    is closed, so an interrupted export never leaves a truncated json file. In the append mode the new commits
+    are written to the part file and then merged with the existing commits into a new file which replaces
+    the target, so the file stays newest first. The commits of an append interrupted before its watermark
+    was saved are at the head of the existing file, they are dropped if they were mined again.
+    """
+
+    def __init__(self, path: str, repository_name: str, append: bool = False) -> None:
+        directory = Path(path).resolve()
+        directory.mkdir(parents=True, exist_ok=True)
+        self.path = (directory / repository_name).__str__() + ".json"
+        self.part_path = self.path + ".part"
+        self.append = append and Path(self.path).is_file()
+        self.file = open(self.part_path, "w")
+        if not self.append:
+            self.file.write('{"commits": [')
+        self.ids = set()
+        self.count = 0
+
+    def write(self, commit: Commit) -> None:
+        if self.append:
+            self.ids.add(commit["id"] if isinstance(commit, dict) else commit.id)
+        self.file.write(",\n" if self.count > 0 else "\n")
+        self.file.write(json.dumps(commit, default=lambda x: x.__dict__))
+        self.count += 1
+
+    def write_previous(self, f: TextIO) -> None:
+        """
+        Write the commits of the existing file after the new ones, skipping the leading commits mined again.
+
+        :param f: The merged file.
+        """
+        with open(self.path, "r") as previous:
+            if previous.readline().strip() != '{"commits": [':
+                for commit in JsonService.iter_commits(self.path):
+                    if commit.get("id") not in self.ids:
+                        f.write(",\n" + json.dumps(commit))
+                return
+            head = True
+            for line in previous:
+                line = line.strip().rstrip(",")
+                if line == "]}":
+                    return
+                if line == "" or head and json.loads(line).get("id") in self.ids:
+                    continue
+                head = False
+                f.write(",\n" + line)
+
+    def close(self) -> None:
+        if not self.append:
+            self.file.write("\n]}\n")
+            self.file.close()
+            os.replace(self.part_path, self.path)
+            return
+        self.file.close()
+        if self.count > 0:
+            merged_path = self.path + ".merged"
+            with open(self.part_path, "r") as part, open(merged_path, "w") as f:
+                f.write('{"commits": [')
+                shutil.copyfileobj(part, f)
+                self.write_previous(f)
+                f.write("\n]}\n")
+            os.replace(merged_path, self.path)
+        os.remove(self.part_path)
+
+    def abort(self) -> None:
+        self.file.close()
+        os.remove(self.part_path)
+
+    def __enter__(self) -> "JsonStreamWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class StateService:
+    @staticmethod
+    def get_watermark(path: str, repository_name: str) -> Optional[Watermark]:
+        """
+        Get the watermark of the last mining of a repository.
+
+        :param path: The path to the state files.
+        :param repository_name: The name of the repository.
+        :return: The watermark or None if the repository wasn't mined yet.
+        """
+        file_path = Path(path).resolve() / (repository_name + ".json")
+        if not file_path.is_file():
+            return None
+        with open(file_path, "r") as f:
+            return Watermark(**json.loads(f.read()))
+
+    @staticmethod
+    def save_watermark(path: str, repository_name: str, watermark: Watermark) -> None:
+        """
+        Save the watermark of a repository.
+
+        :param path: The path to the state files.
+        :param repository_name: The name of the repository.
+        :param watermark: The watermark.
+        """
+        directory = Path(path).resolve()
+        directory.mkdir(parents=True, exist_ok=True)
+        file_path = (directory / repository_name).__str__() + ".json"
+        with open(file_path + ".part", "w") as f:
+            f.write(json.dumps(watermark, indent=2, default=lambda x: x.__dict__))
+        os.replace(file_path + ".part", file_path)
+
+
 class FileSystemService:
     @staticmethod
     def get_files(path: str) -> Iterator[File]:
@@ -1,37 +1,350 @@
-from io import BytesIO, StringIO
+import functools
+import hashlib
 import os
 import pathlib
+import subprocess
+import time
+from typing import Callable, Dict, Iterator, Optional, TypeVar
 
-from dulwich import patch, repo
-from git import GitCommandError, Repo
+from dulwich import repo
+from dulwich.objects import Commit as DulwichCommit
+from git import GitCommandError, InvalidGitRepositoryError, NoSuchPathError, Repo
 import github
-from github import Github, NamedUser
-from unidiff import PatchSet, PatchedFile, UnidiffParseError
+from github import Github, GithubException, NamedUser, RateLimitExceededException
+from github.Requester import Requester
+import requests
 
-from similar_dev_search.data.models import Change, Commit, Repository
+from similar_dev_search.data.constants import BLOB_PREFETCH_COMMITS, GITHUB_BACKOFF_SECONDS, GITHUB_BASE_URL, \
+    GITHUB_MAX_RETRIES, GITHUB_N_THREADS, GITHUB_PER_PAGE
+from similar_dev_search.data.models import Change, CloneOptions, CloneStats, Commit, CommitFilter, FileDiff, Repository
 from similar_dev_search.services import code_parser
-from similar_dev_search.services.code_parser import LanguagesProvider
-from similar_dev_search.services.file_system import FileSystemService
+from similar_dev_search.services.cache import HttpCache, ParseCache
+from similar_dev_search.services.code_parser import FileClassifier
+from similar_dev_search.services.diff import TreeDiffService
+from similar_dev_search.services.profiler import profiler
+
+T = TypeVar("T")
 
 
 class GitService:
     @staticmethod
-    def clone_repo(clone_url: str, path: str, verbose: bool = False) -> None:
+    def is_repo(path: str) -> bool:
         try:
+            Repo(path)
+            return True
+        except (InvalidGitRepositoryError, NoSuchPathError):
+            return False
+
+    @staticmethod
+    def get_size(path: str) -> int:
+        return sum(f.stat().st_size for f in pathlib.Path(path).rglob("*") if f.is_file() and not f.is_symlink())
+
+    @staticmethod
+    def get_clone_args(clone_options: CloneOptions, commit_filter: CommitFilter = None) -> [str]:
+        """
+        Get arguments of git clone for the clone options.
+        A shallow clone keeps the max_commits window (and the parent of its oldest commit) or the commits made
+        after since.
+
+        :param clone_options: Clone options.
+        :param commit_filter: Filter of the mined commits.
+        :return: The arguments.
+        """
+        commit_filter = commit_filter or CommitFilter()
+        args = []
+        if clone_options.bare:
+            args.append("--bare")
+        if clone_options.blobless:
+            args.append("--filter=blob:none")
+        if clone_options.shallow:
+            if commit_filter.max_commits:
+                args.append(f"--depth={commit_filter.max_commits + 1}")
+            if commit_filter.since:
+                args.append(f"--shallow-since={commit_filter.since}")
+            if commit_filter.branches:
+                args.append("--no-single-branch")
+        return args
+
+    @staticmethod
+    def clone_repo(clone_url: str, path: str, verbose: bool = False, clone_options: CloneOptions = None,
+                   commit_filter: CommitFilter = None) -> CloneStats:
+        """
+        Clone a repo or fetch new commits if the clone already exists.
+
+        :param clone_url: Url of the repo.
+        :param path: Path to the clone.
+        :param verbose: Print progress.
+        :param clone_options: Bare, blob-less and shallow mode of a new clone.
+        :param commit_filter: Filter of the mined commits used to size a shallow clone.
+        :return: Time and size of the clone.
+        """
+        clone_options = clone_options or CloneOptions()
+        start = time.perf_counter()
+        if GitService.is_repo(path):
+            if verbose:
+                print("Repository already exists, fetching")
+            GitService.fetch_repo(path, verbose)
+            action = "fetched"
+            mode = "bare" if Repo(path).bare else "full"
+            seconds = time.perf_counter() - start
+            size = GitService.get_size(path)
+        else:
+            args = GitService.get_clone_args(clone_options, commit_filter)
             if verbose:
                 print("Starting repository cloning")
-            Repo.clone_from(clone_url, path)
+            with profiler.stage("clone", items=1) as measurement:
+                repository = Repo.clone_from(clone_url, path, multi_options=args)
+                if clone_options.blobless:
+                    # git marks partial clones as format version 1, dulwich opens only version 0 and the promisor
+                    # remote works in both
+                    repository.git.config("core.repositoryformatversion", "0")
+                seconds = time.perf_counter() - start
+                size = measurement.size = GitService.get_size(path)
             if verbose:
                 print("Repository cloning done")
-        except GitCommandError:
+            action = "cloned"
+            mode = " ".join(args) or "full"
+        return CloneStats(path, action, mode, seconds, size)
+
+    @staticmethod
+    def fetch_repo(path: str, verbose: bool = False) -> bool:
+        """
+        Fetch new commits of an existing clone. A bare clone updates its branches, a clone with a working tree
+        fast-forwards its checked out branch. Partial and shallow clones keep their filter and depth.
+
+        :param path: Path to the repo.
+        :param verbose: Print progress.
+        :return: True if the repo was updated.
+        """
+        try:
+            with profiler.stage("fetch", items=1):
+                repository = Repo(path)
+                if repository.bare:
+                    repository.git.fetch("--prune", "origin", "+refs/heads/*:refs/heads/*")
+                else:
+                    repository.git.pull("--ff-only")
+            return True
+        except GitCommandError as e:
             if verbose:
-                print("Repository already exists")
+                print("Repository fetching failed:", e)
+            return False
+
+    @staticmethod
+    def checkout_revision(path: str, clone_url: str, revision: str) -> str:
+        """
+        Check out a commit or a tag of a clone detached, fetching it from clone_url if the clone lacks it.
+
+        :param path: Path to the repo.
+        :param clone_url: Url of the repo, set as the origin remote.
+        :param revision: Commit hash or tag.
+        :return: Hash of the checked out commit.
+        """
+        repository = Repo(path)
+        if repository.remotes.origin.url != clone_url:
+            repository.git.remote("set-url", "origin", clone_url)
+        try:
+            commit = repository.git.rev_parse("--verify", revision + "^{commit}")
+        except GitCommandError:
+            with profiler.stage("fetch", items=1):
+                repository.git.fetch("--tags", "origin", revision)
+            commit = repository.git.rev_parse("--verify", "FETCH_HEAD^{commit}")
+        if repository.head.commit.hexsha != commit:
+            repository.git.checkout("--detach", "--force", commit)
+        return commit
+
+    @staticmethod
+    def fetch_objects(path: str, object_ids: [bytes]) -> None:
+        """
+        Fetch missing objects of a partial clone in one request, the same way git fetches them on demand.
+
+        :param path: Path to the repo.
+        :param object_ids: Ids of the objects.
+        """
+        with profiler.stage("blob_fetch", items=len(object_ids)):
+            subprocess.run(
+                ["git", "-C", path, "-c", "fetch.negotiationAlgorithm=noop", "fetch", "origin", "--no-tags",
+                 "--no-write-fetch-head", "--recurse-submodules=no", "--filter=blob:none", "--stdin"],
+                input=b"\n".join(object_ids) + b"\n", check=True, capture_output=True)
+
+
+class GithubResponse:
+    """
+    Response in the form expected by the PyGithub requester.
+    """
+
+    def __init__(self, status: int, headers: Dict[str, str], body: str) -> None:
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def getheaders(self) -> [(str, str)]:
+        return list(self.headers.items())
+
+    def read(self) -> str:
+        return self.body
+
+
+class GithubConnection:
+    """
+    Connection for the PyGithub requester sending requests through a shared requests session.
+
+    The requester of a client creates a new connection for every request once the connection classes are set,
+    so threads sharing a client don't overwrite each other's requests. GET responses are cached if the cache is set.
+    """
+
+    def __init__(self, host: str, port: int = None, strict: bool = False, timeout: float = None, retry=None,
+                 pool_size: int = None, protocol: str = "https", session: requests.Session = None,
+                 cache: HttpCache = None, **kwargs) -> None:
+        self.host = host
+        self.port = port or (443 if protocol == "https" else 80)
+        self.protocol = protocol
+        self.timeout = timeout
+        self.verify = kwargs.get("verify", True)
+        self.session = session or requests.Session()
+        self.cache = cache
+        self.verb, self.url, self.input, self.headers = None, None, None, None
+
+    def request(self, verb: str, url: str, input, headers: Dict[str, str]) -> None:
+        self.verb, self.url, self.input, self.headers = verb, url, input, headers
+
+    def send(self, headers: Dict[str, str]) -> requests.Response:
+        with profiler.stage("github_request", items=1) as measurement:
+            response = self.session.request(
+                self.verb,
+                f"{self.protocol}://{self.host}:{self.port}{self.url}",
+                headers=headers,
+                data=self.input,
+                timeout=self.timeout,
+                verify=self.verify,
+                allow_redirects=False)
+            measurement.size = len(response.content)
+        return response
+
+    def get_cache_key(self) -> str:
+        credentials = hashlib.sha1(self.headers.get("Authorization", "").encode()).hexdigest()[:16]
+        return f"{self.protocol}://{self.host}:{self.port}{self.url} {credentials}"
+
+    @staticmethod
+    def get_rate_headers(headers: Dict[str, str]) -> Dict[str, str]:
+        return {key: value for key, value in headers.items() if key.lower().startswith("x-ratelimit-")}
+
+    def getresponse(self) -> GithubResponse:
+        """
+        Send the request or answer it from the cache.
+
+        :return: The response.
+        """
+        if self.verb != "GET" or self.cache is None:
+            response = self.send(self.headers)
+            return GithubResponse(response.status_code, dict(response.headers), response.text)
+        key = self.get_cache_key()
+        entry = self.cache.get(key)
+        if entry is not None and self.cache.is_fresh(entry):
+            return GithubResponse(entry["status"], entry["headers"], entry["body"])
+        headers = dict(self.headers)
+        if entry is not None:
+            stored_headers = {k.lower(): v for k, v in entry["headers"].items()}
+            if "etag" in stored_headers:
+                headers["If-None-Match"] = stored_headers["etag"]
+            if "last-modified" in stored_headers:
+                headers["If-Modified-Since"] = stored_headers["last-modified"]
+        response = self.send(headers)
+        if response.status_code == 304 and entry is not None:
+            self.cache.set(key, entry["status"], entry["headers"], entry["body"])
+            return GithubResponse(
+                entry["status"], {**entry["headers"], **GithubConnection.get_rate_headers(response.headers)}, entry["body"])
+        response_headers = dict(response.headers)
+        if response.status_code == 200:
+            rate_headers = GithubConnection.get_rate_headers(response_headers)
+            stored_headers = {k: v for k, v in response_headers.items() if k not in rate_headers}
+            self.cache.set(key, response.status_code, stored_headers, response.text)
+        return GithubResponse(response.status_code, response_headers, response.text)
+
+    def close(self) -> None:
+        pass
 
 
 class GithubService:
-    def __init__(self) -> None:
-        self.token = os.environ["GITHUB_API_KEY"]
-        self.github = Github(self.token)
+    """
+    GitHub API client. The service is safe to share between threads: calls made through call are retried
+    after a rate limit or a server error, waiting until the limit is reset or with an exponential backoff.
+    Responses are cached on disk if the cache is set, so repeated runs spend almost no rate limit.
+    """
+
+    def __init__(self, base_url: str = GITHUB_BASE_URL, token: str = None, pool_size: int = GITHUB_N_THREADS,
+                 max_retries: int = GITHUB_MAX_RETRIES, cache: HttpCache = None) -> None:
+        self.token = token or os.environ.get("GITHUB_API_KEY")
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.github = Github(self.token, base_url=base_url, per_page=GITHUB_PER_PAGE, pool_size=pool_size)
+        GithubService.set_connection_classes(
+            self.github._Github__requester,
+            functools.partial(GithubConnection, protocol="http", session=self.session, cache=cache),
+            functools.partial(GithubConnection, protocol="https", session=self.session, cache=cache))
+        self.max_retries = max_retries
+
+    @staticmethod
+    def set_connection_classes(requester: Requester, http_class: Callable[..., GithubConnection],
+                               https_class: Callable[..., GithubConnection]) -> None:
+        """
+        Make a requester create a new connection of the given classes for every request.
+        Requester.injectConnectionClasses changes the classes of every requester in the process,
+        so the classes are set on the requester of one client, which is shared by the objects it returns.
+
+        :param requester: The requester of a client.
+        :param http_class: Connection class of the http urls.
+        :param https_class: Connection class of the https urls.
+        """
+        requester._Requester__persist = False
+        requester._Requester__connection = None
+        requester._Requester__httpConnectionClass = http_class
+        requester._Requester__httpsConnectionClass = https_class
+        requester._Requester__connectionClass = https_class if requester._Requester__scheme == "https" else http_class
+
+    @staticmethod
+    def get_retry_delay(error: GithubException, attempt: int) -> Optional[float]:
+        """
+        Get the time to wait before retrying a failed call.
+
+        :param error: The error of the call.
+        :param attempt: Number of the failed attempt starting from 0.
+        :return: Delay in seconds or None if the call can't be retried.
+        """
+        headers = error.headers or {}
+        if error.status in (403, 429):
+            if "retry-after" in headers:
+                return float(headers["retry-after"])
+            if headers.get("x-ratelimit-remaining") == "0" and "x-ratelimit-reset" in headers:
+                return max(0.0, int(headers["x-ratelimit-reset"]) - time.time()) + 1
+            if isinstance(error, RateLimitExceededException) or error.status == 429:
+                return GITHUB_BACKOFF_SECONDS * 2 ** attempt
+            return None
+        if error.status >= 500:
+            return GITHUB_BACKOFF_SECONDS * 2 ** attempt
+        return None
+
+    def call(self, function: Callable[..., T], *args) -> T:
+        """
+        Call a function making API requests, retrying it after rate limits and server errors.
+        Lazy lists must be materialized inside the function to be retried.
+
+        :param function: The function.
+        :param args: Arguments of the function.
+        :return: The result of the function.
+        """
+        with profiler.stage("github_api") as measurement:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    result = function(*args)
+                    measurement.items = len(result) if isinstance(result, list) else 1
+                    return result
+                except GithubException as e:
+                    delay = GithubService.get_retry_delay(e, attempt)
+                    if delay is None or attempt == self.max_retries:
+                        raise
+                    time.sleep(delay)
 
     def get_user(self, username: str) -> NamedUser:
         return self.github.get_user(username)
@@ -40,90 +353,224 @@ class GithubService:
         return self.github.get_user(username).get_repos()
 
     def get_repo(self, username: str, repo_name: str) -> github.Repository:
-        return self.github.get_user(username).get_repo(repo_name)
+        return self.call(self.github.get_repo, f"{username}/{repo_name}")
+
+    def get_contributors(self, repo: github.Repository, max_contributors: int) -> [NamedUser]:
+        return self.call(lambda: list(repo.get_contributors()[:max_contributors]))
+
+    def get_starred(self, user: NamedUser) -> [github.Repository]:
+        return self.call(lambda: list(user.get_starred()))
 
 
 class RepositoryProvider:
-    def __init__(self, path: str) -> None:
+    def __init__(self, path: str, parse_cache: ParseCache = None, classifier: FileClassifier = None) -> None:
         self.path = path
         self.r = repo.Repo(self.path)
-        self.commits = {}
-        self.result_commits = []
-        for entry in self.r.get_walker():
-            self.commits[entry.commit.id] = entry.commit
+        self.parse_cache = parse_cache
+        self.classifier = classifier or FileClassifier()
+        try:
+            self.partial = self.r.get_config().get((b"remote", b"origin"), b"promisor") == b"true"
+        except KeyError:
+            self.partial = False
 
-    def get_commit_raw_diff(self, commit_id: bytes) -> str:
+    def resolve_branch(self, branch: str) -> bytes:
         """
-        Get a raw diff of a commit.
+        Get the commit id of a branch tip.
 
-        :param commit_id: Id of the commit.
-        :return: The raw diff.
+        :param branch: A full ref name or a local, remote-tracking or tag short name.
+        :return: The commit id.
+        """
+        for prefix in [b"", b"refs/heads/", b"refs/remotes/", b"refs/tags/"]:
+            ref = prefix + branch.encode()
+            if ref in self.r.refs:
+                return self.r.refs[ref]
+        raise KeyError(branch)
+
+    def get_ref_tips(self, commit_filter: CommitFilter = None) -> {str: str}:
+        """
+        Get tips of the selected branches.
+
+        :param commit_filter: Filter with the selected branches.
+        :return: Dict of branch name and commit id, HEAD if no branches are selected.
+        """
+        branches = commit_filter.branches if commit_filter is not None else []
+        if not branches:
+            return {"HEAD": self.r.head().decode()}
+        return {branch: self.resolve_branch(branch).decode() for branch in branches}
+
+    def walk_commits(self, commit_filter: CommitFilter = None) -> Iterator[DulwichCommit]:
+        """
+        Lazily walk the history from the selected branches.
+
+        :param commit_filter: Branches, excluded commits, time range and max number of commits to walk.
+        :return: Dulwich commits, the newest first.
+        """
+        commit_filter = commit_filter or CommitFilter()
+        include = [tip.encode() for tip in self.get_ref_tips(commit_filter).values()]
+        exclude = [commit_id for commit_id in commit_filter.exclude if commit_id in self.r.object_store]
+        walker = self.r.get_walker(
+            include=include,
+            exclude=exclude,
+            since=commit_filter.since,
+            until=commit_filter.until,
+            max_entries=commit_filter.max_commits)
+        for entry in profiler.iterate("walk", walker):
+            yield entry.commit
+
+    def parse_blob(self, blob_id: bytes, file_path: str, tree_sitter_build_path: str,
+                   raw_content: bytes = None) -> (str, dict):
         """
-        out = BytesIO()
-        patch.write_tree_diff(
-            out,
-            self.r.object_store,
-            self.commits[self.commits[commit_id].parents[0]].tree,
-            self.commits[commit_id].tree)
-        return out.getvalue().decode("utf-8")
+        Detect a language of a blob and parse it. A blob of a language that isn't parsed is not read
+        if the language is known by the file name. The result is memoized in the parse cache.
 
-    def get_file(self, patched_file: PatchedFile, tree_sitter_build_path: str) -> Change:
+        :param blob_id: Id of the blob.
+        :param file_path: The path of the blob in the commit tree.
+        :param tree_sitter_build_path: Path to the tree-sitter build library.
+        :param raw_content: Content of the blob if it was already read, e.g. for the diff.
+        :return: The language and the dict with imports and names.
+        """
+        language = self.classifier.get_language_by_name(file_path)
+        if language is not None and not FileClassifier.is_parsed(language):
+            return language, {"imports": [], "names": []}
+        if self.parse_cache is not None:
+            with profiler.stage("parse_cache"):
+                cached = self.parse_cache.get(blob_id, file_path)
+            if cached is not None:
+                return cached
+        if raw_content is None:
+            raw_content = TreeDiffService.read_blob(self.r.object_store, blob_id)
+        if language is None:
+            language = self.classifier.get_language_by_content(file_path, raw_content)
+        code_entities = {"imports": [], "names": []}
+        if FileClassifier.is_parsed(language):
+            try:
+                content = raw_content.decode("utf-8")
+                code_entities = code_parser.CodeEntitiesParser.parse_file([language], content, tree_sitter_build_path)
+            except UnicodeDecodeError:
+                language = "Other"
+        if self.parse_cache is not None:
+            with profiler.stage("parse_cache"):
+                self.parse_cache.set(blob_id, file_path, language, code_entities)
+        return language, code_entities
+
+    def get_file(self, file_diff: FileDiff, tree_sitter_build_path: str) -> Change:
         """
         Get a changes block of the commit.
 
-        :param patched_file: The file to search changes.
+        :param file_diff: The diff of the changed file.
         :return: The changes block.
         """
-        file_path = patched_file.path  # file name
-        del_line_no = [
-            line.target_line_no
-            for hunk in patched_file for line in hunk
-            if line.is_added and line.value.strip() != ""]  # the row number of deleted lines
-        ad_line_no = [
-            line.source_line_no
-            for hunk in patched_file for line in hunk
-            if line.is_removed and line.value.strip() != ""]  # the row number of added liens
-        file_content = FileSystemService.get_file_content(
-            str(pathlib.Path().resolve() / self.path / patched_file.path))
-        language = LanguagesProvider().get_language(
-            patched_file.path, str(pathlib.Path().resolve() / self.path / patched_file.path)
-        )
-        code_entities = code_parser.CodeEntitiesParser.parse_file([language], file_content, tree_sitter_build_path)
-        return Change(file_path, language, len(del_line_no), len(ad_line_no), code_entities["names"],
+        if file_diff.new_blob_id is not None:
+            language, code_entities = self.parse_blob(file_diff.new_blob_id, file_diff.path, tree_sitter_build_path,
+                                                      file_diff.new_content)
+        else:  # the file was deleted in the commit
+            language = self.classifier.get_language(file_diff.path, b"")
+            code_entities = {"imports": [], "names": []}
+        return Change(file_diff.path, language, file_diff.deletions, file_diff.additions, code_entities["names"],
                       code_entities["imports"])
 
     def get_commit_diff_object(self, commit_id: bytes, tree_sitter_build_path: str) -> [Change]:
         """
-        Get all differences in the commit.
+        Get all differences in the commit. A file that can't be diffed or parsed is skipped and counted
+        by the classifier.
 
         :param commit_id: Id of the commit.
         :return: All differences.
         """
+        commit = self.r[commit_id]
+        change_list = []
+        for file_diff in profiler.iterate("diff", TreeDiffService.get_tree_diff(
+                self.r.object_store, self.r[commit.parents[0]].tree, commit.tree, self.classifier)):
+            try:
+                change_list.append(self.get_file(file_diff, tree_sitter_build_path))
+            except Exception as e:  # the parsers may fail on any content
+                self.classifier.record_error(file_diff.path, e)
+        return change_list
+
+    def get_commit_ids(self, commit_filter: CommitFilter = None) -> [bytes]:
+        """
+        Get ids of the commits to mine in the walk order.
+
+        :param commit_filter: Branches, time range and max number of commits to walk.
+        :return: Ids of the commits with a single parent.
+        """
+        return [commit.id for commit in self.walk_commits(commit_filter) if len(commit.parents) == 1]
+
+    def mine_commit(self, commit: DulwichCommit, tree_sitter_build_path: str) -> Optional[Commit]:
+        """
+        Mine changes of a commit with a single parent.
+
+        :param commit: The commit.
+        :param tree_sitter_build_path: Path to the tree-sitter build library.
+        :return: Mined commit or None if the commit can't be mined.
+        """
+        if len(commit.parents) != 1:
+            return None
         try:
-            s = self.get_commit_raw_diff(commit_id)
-            patch_set = PatchSet(StringIO(s))
-            change_list = []
-            for patched_file in patch_set:
-                change_list.append(self.get_file(patched_file, tree_sitter_build_path))
-            return change_list
-        except (UnicodeDecodeError, UnidiffParseError):
-            return []
-        except Exception:
-            return []
-
-    def get_repository(self, tree_sitter_build_path: str) -> Repository:
+            changes = self.get_commit_diff_object(commit.id, tree_sitter_build_path)
+        except KeyError:  # the parent is missing in a shallow clone
+            return None
+        return Commit(commit.author, commit.parents[0], changes, commit.id)
+
+    def prefetch_blobs(self, commits: [DulwichCommit]) -> int:
+        """
+        Fetch the blobs missing in a partial clone that are needed to mine the commits.
+
+        :param commits: The commits.
+        :return: Number of fetched blobs.
+        """
+        if not self.partial:
+            return 0
+        missing = set()
+        for commit in commits:
+            if len(commit.parents) != 1 or commit.parents[0] not in self.r.object_store:
+                continue
+            blob_ids = TreeDiffService.get_blob_ids(
+                self.r.object_store, self.r[commit.parents[0]].tree, commit.tree, self.classifier)
+            missing.update(blob_id for blob_id in blob_ids if blob_id not in self.r.object_store)
+        if missing:
+            GitService.fetch_objects(self.path, sorted(missing))
+        return len(missing)
+
+    def mine_commit_batch(self, commits: [DulwichCommit], tree_sitter_build_path: str) -> Iterator[Commit]:
+        self.prefetch_blobs(commits)
+        for commit in commits:
+            result = self.mine_commit(commit, tree_sitter_build_path)
+            if result is not None:
+                yield result
+
+    def mine_commits(self, commit_ids: [bytes], tree_sitter_build_path: str) -> Iterator[Commit]:
+        """
+        Lazily mine commits by ids.
+
+        :param commit_ids: Ids of the commits.
+        :param tree_sitter_build_path: Path to the tree-sitter build library.
+        :return: Mined commits.
+        """
+        for start in range(0, len(commit_ids), BLOB_PREFETCH_COMMITS):
+            commits = [self.r[commit_id] for commit_id in commit_ids[start:start + BLOB_PREFETCH_COMMITS]]
+            yield from self.mine_commit_batch(commits, tree_sitter_build_path)
+
+    def iter_commits(self, tree_sitter_build_path: str, commit_filter: CommitFilter = None) -> Iterator[Commit]:
+        """
+        Lazily mine commits with a single parent.
+
+        :param tree_sitter_build_path: Path to the tree-sitter build library.
+        :param commit_filter: Branches, time range and max number of commits to walk.
+        :return: Mined commits.
+        """
+        commits = []
+        for commit in self.walk_commits(commit_filter):
+            commits.append(commit)
+            if len(commits) == BLOB_PREFETCH_COMMITS:
+                yield from self.mine_commit_batch(commits, tree_sitter_build_path)
+                commits = []
+        yield from self.mine_commit_batch(commits, tree_sitter_build_path)
+
+    def get_repository(self, tree_sitter_build_path: str, commit_filter: CommitFilter = None) -> Repository:
         """
         Get a repository object.
 
         :return: The repository object.
         """
-        result_commits = []
-        for key in self.commits.keys():
-            try:
-                if len(self.commits[key].parents) == 1:
-                    changes = self.get_commit_diff_object(key, tree_sitter_build_path)
-                    commit = Commit(self.commits[key].author, self.commits[key].parents[0], changes)
-                    result_commits.append(commit)
-            except IndexError:
-                pass
-        return Repository(result_commits)
+        return Repository(list(self.iter_commits(tree_sitter_build_path, commit_filter)))
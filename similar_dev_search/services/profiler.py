@@ -0,0 +1,247 @@
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+from pathlib import Path
+import pstats
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, Optional, TypeVar
+
+from similar_dev_search.data.models import StageStats
+
+T = TypeVar("T")
+
+
+class Measurement:
+    """
+    Items and bytes handled by one call of a stage, the caller sets them inside the stage.
+    """
+
+    def __init__(self, items: int = 0, size: int = 0) -> None:
+        self.items = items
+        self.size = size
+
+
+class Frame:
+    def __init__(self, measurement: Measurement) -> None:
+        self.measurement = measurement
+        self.profile = None
+        self.child_wall = 0.0
+        self.child_cpu = 0.0
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+
+
+class Profiler:
+    """
+    Per-process totals of the pipeline stages: calls, items, bytes, wall and CPU time.
+
+    Stages are always recorded, a call costs a few clock reads. Nested stages are tracked per thread,
+    so besides the inclusive times every stage has self times without its nested stages.
+    Worker processes run their tasks through task(), which returns the stages recorded by the task
+    to be merged into the profiler of the parent process. Wall times of parallel workers add up.
+
+    If pstats_path is set, every stage also runs under its own cProfile profiler, paused while a nested stage runs.
+    """
+
+    def __init__(self, pstats_path: str = None) -> None:
+        self.pstats_path = pstats_path
+        self.stages: Dict[str, StageStats] = {}
+        self.profiles: Dict[tuple, cProfile.Profile] = {}
+        self.dumps = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def configure(self, pstats_path: Optional[str]) -> None:
+        """
+        Enable or disable the cProfile dumps, removing the dumps left by an interrupted run.
+
+        :param pstats_path: Path to the pstats files or None to disable them.
+        """
+        self.pstats_path = pstats_path
+        if pstats_path is not None:
+            for path in Path(pstats_path).glob("*.prof"):
+                path.unlink()
+
+    def get_stack(self) -> [Frame]:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def get_profile(self, name: str) -> Optional[cProfile.Profile]:
+        if self.pstats_path is None:
+            return None
+        key = (name, threading.get_ident())
+        with self.lock:
+            if key not in self.profiles:
+                self.profiles[key] = cProfile.Profile()
+            profile = self.profiles[key]
+        try:
+            profile.enable()
+        except ValueError:  # another profiler is active in the thread
+            return None
+        return profile
+
+    @contextmanager
+    def stage(self, name: str, items: int = 0, size: int = 0) -> Iterator[Measurement]:
+        """
+        Measure a stage.
+
+        :param name: Name of the stage.
+        :param items: Number of handled items, if it is known in advance.
+        :param size: Number of handled bytes, if it is known in advance.
+        :return: Measurement of the call to update the items and the bytes.
+        """
+        stack = self.get_stack()
+        parent = stack[-1] if stack else None
+        if parent is not None and parent.profile is not None:
+            parent.profile.disable()
+        frame = Frame(Measurement(items, size))
+        frame.profile = self.get_profile(name)
+        stack.append(frame)
+        try:
+            yield frame.measurement
+        finally:
+            if frame.profile is not None:
+                frame.profile.disable()
+            wall = time.perf_counter() - frame.wall
+            cpu = time.thread_time() - frame.cpu
+            stack.pop()
+            if parent is not None:
+                parent.child_wall += wall
+                parent.child_cpu += cpu
+                if parent.profile is not None:
+                    parent.profile.enable()
+            self.record(name, StageStats(1, frame.measurement.items, frame.measurement.size, wall, cpu,
+                                         wall - frame.child_wall, cpu - frame.child_cpu))
+
+    def iterate(self, name: str, iterable: Iterable[T]) -> Iterator[T]:
+        """
+        Measure every step of a lazy iterable as a call of a stage handling one item.
+
+        :param name: Name of the stage.
+        :param iterable: The iterable.
+        :return: Items of the iterable.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name) as measurement:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                measurement.items = 1
+            yield item
+
+    def record(self, name: str, stats: StageStats) -> None:
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = StageStats()
+            self.stages[name].add(stats)
+
+    def merge(self, stages: Dict[str, StageStats]) -> None:
+        for name, stats in stages.items():
+            self.record(name, stats)
+
+    def pop(self) -> Dict[str, StageStats]:
+        with self.lock:
+            stages, self.stages = self.stages, {}
+        return stages
+
+    def task(self, function: Callable[..., T]) -> "ProfiledTask":
+        return ProfiledTask(function, self.pstats_path)
+
+    def run_task(self, pstats_path: Optional[str], function: Callable[..., T], *args) -> (T, Dict[str, StageStats]):
+        """
+        Run a function recording its stages apart from the stages recorded before, e.g. inherited by a forked worker.
+
+        :param pstats_path: Path to the cProfile dumps of the parent process.
+        :param function: The function.
+        :return: Result of the function and the stages it recorded.
+        """
+        with self.lock:
+            stages, profiles, path = self.stages, self.profiles, self.pstats_path
+            self.stages, self.profiles, self.pstats_path = {}, {}, pstats_path
+        stack, self.local.stack = self.get_stack(), []
+        try:
+            result = function(*args)
+        finally:
+            self.dump_profiles()
+            task_stages = self.pop()
+            with self.lock:
+                self.stages, self.profiles, self.pstats_path = stages, profiles, path
+            self.local.stack = stack
+        return result, task_stages
+
+    def dump_profiles(self) -> None:
+        """
+        Write the cProfile data of the stages to numbered files merged later by save_pstats.
+        """
+        with self.lock:
+            profiles, self.profiles = self.profiles, {}
+        if self.pstats_path is None or not profiles:
+            return
+        Path(self.pstats_path).mkdir(parents=True, exist_ok=True)
+        for (name, _), profile in profiles.items():
+            profile.create_stats()
+            if profile.stats:
+                self.dumps += 1
+                profile.dump_stats(Path(self.pstats_path) / f"{name}.{os.getpid()}.{self.dumps}.prof")
+
+    def save_pstats(self) -> [str]:
+        """
+        Merge the cProfile dumps of all processes into one <stage>.pstats file per stage.
+
+        :return: Paths to the pstats files.
+        """
+        self.dump_profiles()
+        parts = {}
+        for path in sorted(Path(self.pstats_path).glob("*.prof")):
+            parts.setdefault(path.name.split(".", 1)[0], []).append(path)
+        result = []
+        for name, paths in sorted(parts.items()):
+            output_path = Path(self.pstats_path) / (name + ".pstats")
+            pstats.Stats(*map(str, paths)).dump_stats(output_path)
+            for path in paths:
+                path.unlink()
+            result.append(str(output_path))
+        return result
+
+    def get_report(self) -> dict:
+        """
+        Get the totals of the stages with throughputs per second of the inclusive wall time.
+
+        :return: Dict of the stage name and its totals.
+        """
+        with self.lock:
+            stages = dict(self.stages)
+        report = {}
+        for name, stats in sorted(stages.items()):
+            report[name] = dict(vars(stats))
+            report[name]["items_per_second"] = stats.items / stats.wall if stats.wall > 0 else 0.0
+            report[name]["bytes_per_second"] = stats.size / stats.wall if stats.wall > 0 else 0.0
+        return report
+
+    def save_report(self, path: str) -> None:
+        Path(path).resolve().parent.mkdir(parents=True, exist_ok=True)
+        report = {"created": time.time(), "stages": self.get_report()}
+        with open(path, "w") as f:
+            f.write(json.dumps(report, indent=2))
+
+
+class ProfiledTask:
+    """
+    Picklable function of a worker returning its result together with the stages recorded by the call.
+    """
+
+    def __init__(self, function: Callable[..., T], pstats_path: Optional[str]) -> None:
+        self.function = function
+        self.pstats_path = pstats_path
+
+    def __call__(self, *args) -> (T, Dict[str, StageStats]):
+        return profiler.run_task(self.pstats_path, self.function, *args)
+
+
+# Profiler of the current process
+profiler = Profiler()
@@ -1,28 +1,170 @@
+import fcntl
+import hashlib
+from importlib import metadata
+import json
+import os
+from pathlib import Path
+import platform
+import sys
+import sysconfig
+
+from git import Repo
 from joblib import Parallel, delayed
 from tree_sitter import Language
 
-from similar_dev_search.data.constants import BUILD_PATH, N_JOBS, VENDOR_PATH, language_names
+from similar_dev_search.data.constants import BUILD_PATH, GRAMMARS_LOCK, N_JOBS, TREE_SITTER_LIBRARY, VENDOR_PATH, \
+    language_names
+from similar_dev_search.data.models import Grammar
+from similar_dev_search.services.code_parser import queries
 from similar_dev_search.services.git import GitService
+from similar_dev_search.services.profiler import profiler
 
 languages = {}
 
 
-def clone_tree_sitter_repo(git_service: GitService, language_name: str) -> None:
-    git_service.clone_repo(
-        clone_url="https://github.com/tree-sitter/tree-sitter-" + language_name,
-        path=VENDOR_PATH + "tree-sitter/tree-sitter-" + language_name)
+def get_grammar_url(language_name: str) -> str:
+    return "https://github.com/tree-sitter/tree-sitter-" + language_name
+
+
+def get_grammar_path(language_name: str, vendor_path: str = VENDOR_PATH) -> str:
+    return vendor_path + "tree-sitter/tree-sitter-" + language_name
+
+
+def parse_grammars(grammars: [str]) -> {str: Grammar}:
+    """
+    Parse grammar specifications. Only the languages with imports and names queries in code_parser are accepted,
+    the parser has no use for other grammars.
+
+    :param grammars: Language names of the official tree-sitter grammars or "name=url" for other grammars,
+                     optionally followed by "#revision" to pin a commit or a tag.
+    :return: Dict of the language name and the grammar.
+    """
+    result = {}
+    for grammar in grammars:
+        spec, _, revision = grammar.partition("#")
+        name, _, url = spec.partition("=")
+        if name not in queries:
+            raise ValueError(f"No tree-sitter queries for the {name} grammar, supported languages: "
+                             f"{', '.join(sorted(queries))}")
+        result[name] = Grammar(url or get_grammar_url(name), revision or None)
+    return result
+
+
+def load_grammars_lock(lock_path: Path) -> {str: Grammar}:
+    if not lock_path.is_file():
+        return {}
+    with open(lock_path) as f:
+        return {name: Grammar(**grammar) for name, grammar in json.load(f).items()}
+
+
+def save_grammars_lock(lock_path: Path, grammars: {str: Grammar}) -> None:
+    temp_path = lock_path.with_name(lock_path.name + ".part")
+    with open(temp_path, "w") as f:
+        json.dump({name: vars(grammar) for name, grammar in sorted(grammars.items())}, f, indent=2)
+    os.replace(temp_path, lock_path)
+
+
+def checkout_tree_sitter_repo(git_service: GitService, language_name: str, grammar: Grammar,
+                              vendor_path: str = VENDOR_PATH) -> str:
+    """
+    Clone a grammar repo if it is missing and check out its pinned revision, fetching it if the clone lacks it.
+    Without a revision the clone stays at its current commit.
+
+    :param git_service: Git service.
+    :param language_name: Name of the language.
+    :param grammar: Url and revision of the grammar.
+    :param vendor_path: Path to the grammar repos.
+    :return: Hash of the checked out commit.
+    """
+    path = get_grammar_path(language_name, vendor_path)
+    if not GitService.is_repo(path):
+        git_service.clone_repo(clone_url=grammar.url, path=path)
+    if grammar.revision is None:
+        return Repo(path).head.commit.hexsha
+    return GitService.checkout_revision(path, grammar.url, grammar.revision)
+
+
+def get_compiler_flags() -> dict:
+    """
+    Get everything besides the grammar sources that affects the built library.
+
+    :return: Dict of the compiler settings.
+    """
+    return {
+        "tree_sitter": metadata.version("tree_sitter"),
+        "platform": sys.platform,
+        "machine": platform.machine(),
+        "cc": sysconfig.get_config_var("CC"),
+        "cflags": sysconfig.get_config_var("CFLAGS"),
+        "env": {name: os.environ.get(name) for name in ["CC", "CXX", "CFLAGS", "CXXFLAGS", "CPPFLAGS", "LDFLAGS"]},
+    }
+
+
+def get_build_key(commits: {str: str}) -> str:
+    """
+    Get a content address of the library built from the grammar repos.
+
+    :param commits: Dict of the language name and the checked out commit of the grammar repo.
+    :return: Hex digest of the grammar commits and the compiler flags.
+    """
+    key = json.dumps({"grammars": commits, "compiler": get_compiler_flags()}, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def link_library(library_path: Path, link_path: Path) -> None:
+    if link_path.is_symlink() and os.readlink(link_path) == library_path.name:
+        return
+    temp_path = link_path.with_name(link_path.name + ".part")
+    if temp_path.is_symlink() or temp_path.exists():
+        temp_path.unlink()
+    temp_path.symlink_to(library_path.name)
+    os.replace(temp_path, link_path)
+
+
+def build_tree_sitter(git_service: GitService, grammars: [str] = None, build_path: str = BUILD_PATH,
+                      vendor_path: str = VENDOR_PATH) -> bool:
+    """
+    Build the tree-sitter library of the grammars unless it is already built from the same grammar commits
+    with the same compiler flags. The library is stored under its content address and the TREE_SITTER_LIBRARY
+    link points to the current one. Concurrent invocations are serialized by a lock file.
 
+    The commit of every grammar is recorded in the GRAMMARS_LOCK file of the build path and the grammar repos
+    are checked out at the recorded commits, unless a specification pins another revision or changes the url.
 
-def build_tree_sitter(git_service: GitService) -> None:
-    Parallel(n_jobs=N_JOBS)(
-        delayed(clone_tree_sitter_repo)(git_service, language_name) for language_name in language_names
-    )
-    Language.build_library(
-        BUILD_PATH + "my-languages.so",
-        [VENDOR_PATH + "tree-sitter/tree-sitter-" + language for language in language_names])
-    for language in language_names:
-        languages[language] = Language(BUILD_PATH + "my-languages.so", language)
+    :param git_service: Git service.
+    :param grammars: Language names or "name=url#revision" specifications of the grammars, language_names by default.
+    :param build_path: Path to the tree-sitter build library.
+    :param vendor_path: Path to the grammar repos.
+    :return: True if the library was built.
+    """
+    grammar_specs = parse_grammars(grammars or language_names)
+    Path(build_path).mkdir(parents=True, exist_ok=True)
+    with open(Path(build_path) / ".build.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        lock_path = Path(build_path) / GRAMMARS_LOCK
+        recorded = load_grammars_lock(lock_path)
+        for name, grammar in grammar_specs.items():
+            if grammar.revision is None and name in recorded and recorded[name].url == grammar.url:
+                grammar.revision = recorded[name].revision
+        commits = dict(zip(grammar_specs, Parallel(n_jobs=N_JOBS, prefer="threads")(
+            delayed(checkout_tree_sitter_repo)(git_service, name, grammar, vendor_path)
+            for name, grammar in grammar_specs.items()
+        )))
+        recorded.update({name: Grammar(grammar.url, commits[name]) for name, grammar in grammar_specs.items()})
+        save_grammars_lock(lock_path, recorded)
+        grammar_paths = [get_grammar_path(name, vendor_path) for name in grammar_specs]
+        library_path = Path(build_path) / f"languages-{get_build_key(commits)[:16]}.so"
+        built = not library_path.is_file()
+        if built:
+            temp_path = library_path.with_name(library_path.name + ".part")
+            with profiler.stage("grammar_build", items=len(grammar_paths)):
+                Language.build_library(str(temp_path), grammar_paths)
+            os.replace(temp_path, library_path)
+        link_library(library_path, Path(build_path) / TREE_SITTER_LIBRARY)
+    for language in grammar_specs:
+        languages[language] = Language(build_path + TREE_SITTER_LIBRARY, language)
+    return built
 
 
-def setup(git_service: GitService):
-    build_tree_sitter(git_service)
+def setup(git_service: GitService, grammars: [str] = None, build_path: str = BUILD_PATH) -> bool:
+    return build_tree_sitter(git_service, grammars, build_path)
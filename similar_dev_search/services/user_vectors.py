@@ -1,12 +1,148 @@
+from bisect import bisect_left
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+from sys import intern
+from typing import Iterable, List, Optional, Union
+
+from joblib import Parallel, delayed
 import numpy
 from pandas import DataFrame
 import pandas as pd
-from sklearn.feature_extraction import DictVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy.sparse import csr_matrix, vstack
+from sklearn.feature_extraction import DictVectorizer, FeatureHasher
 import tqdm
 
+from similar_dev_search.data.constants import ANN_N_PROBES, FEATURE_COUNTS_REDUCE_SIZE, HASHING_N_FEATURES, \
+    KNN_BLOCK_SIZE, N_JOBS, SEARCH_CHUNK_ROWS, VOCABULARY_PATH
+from similar_dev_search.services.columnar import ColumnarReader, ListColumn, StringColumn
+from similar_dev_search.services.file_system import JsonService
+from similar_dev_search.services.profiler import profiler
+from similar_dev_search.services.vocabulary import FeatureVocabulary, get_vocabulary
+
+
+class VectorCounts:
+    """
+    Raw feature counts of user vectors kept to apply deltas to the vectors. The matrix has a row per author
+    of the vectors and the columns of FeatureCounts, the counted columns are sorted and feature_columns
+    has the column of the user-feature matrix for every counted column.
+    """
+
+    def __init__(self, matrix: csr_matrix, columns: numpy.ndarray, feature_columns: numpy.ndarray) -> None:
+        self.matrix = matrix
+        self.columns = columns
+        self.feature_columns = feature_columns
+
+
+class UserVectors:
+    """
+    Sparse user-feature matrix with the author and feature vocabularies.
+    In the hashing mode features are hashed into columns and there is no feature vocabulary.
+    Vectors loaded from an index are L2-normalized and know the index path. Vectors built from feature counts
+    keep the raw counts.
+    """
+
+    def __init__(self, matrix: csr_matrix, authors: [str], features: Optional[List[str]],
+                 normalized: bool = False, counts: VectorCounts = None, index_path: str = None) -> None:
+        self.matrix = matrix
+        self.authors = authors
+        self.features = features
+        self.normalized = normalized
+        self.counts = counts
+        self.index_path = index_path
+        self.author_index = {author: i for i, author in enumerate(authors)}
+
+
+class FeatureCounts:
+    """
+    Feature counts of developers as (row, column, count) triples, rows point into the authors.
+    Column 2 * id counts the feature of a vocabulary id, column 2 * id + 1 counts deleted lines
+    in the language of the id, so the deletions need no ids of their own.
+
+    Added triples are kept as they are and summed by reduce(), which runs when the added triples outgrow
+    the reduced ones, so merging many repositories takes memory proportional to the distinct triples.
+    """
+
+    def __init__(self) -> None:
+        self.authors = []
+        self.author_index = {}
+        self.parts = []
+        self.reduced_size = 0
+        self.pending_size = 0
+
+    def get_row(self, author: str) -> int:
+        if author not in self.author_index:
+            self.author_index[author] = len(self.authors)
+            self.authors.append(author)
+        return self.author_index[author]
+
+    def add(self, rows: numpy.ndarray, columns: numpy.ndarray, counts: numpy.ndarray) -> None:
+        self.parts.append((numpy.asarray(rows, dtype=numpy.int64), numpy.asarray(columns, dtype=numpy.int64),
+                           numpy.asarray(counts, dtype=numpy.float64)))
+        self.pending_size += len(rows)
+        if self.pending_size > self.reduced_size + FEATURE_COUNTS_REDUCE_SIZE:
+            self.reduce()
+
+    def merge(self, other: "FeatureCounts") -> None:
+        """
+        Add the counts of other developers, the same author in both gets the sum of the counts.
+
+        :param other: The other counts.
+        """
+        rows = numpy.array([self.get_row(author) for author in other.authors], dtype=numpy.int64)
+        for part_rows, columns, counts in other.parts:
+            self.add(rows[part_rows], columns, counts)
+
+    def reduce(self) -> (numpy.ndarray, numpy.ndarray, numpy.ndarray):
+        """
+        Sum the counts of the same row and column.
+
+        :return: Rows, columns and counts sorted by the row and the column.
+        """
+        if len(self.parts) != 1 or self.pending_size > 0:
+            rows = numpy.concatenate([part[0] for part in self.parts] + [numpy.empty(0, dtype=numpy.int64)])
+            columns = numpy.concatenate([part[1] for part in self.parts] + [numpy.empty(0, dtype=numpy.int64)])
+            counts = numpy.concatenate([part[2] for part in self.parts] + [numpy.empty(0, dtype=numpy.float64)])
+            n_columns = int(columns.max()) + 1 if len(columns) else 1
+            keys, inverse = numpy.unique(rows * n_columns + columns, return_inverse=True)
+            counts = numpy.bincount(inverse.ravel(), weights=counts, minlength=len(keys))
+            self.parts = [(keys // n_columns, keys % n_columns, counts)]
+            self.reduced_size = len(keys)
+            self.pending_size = 0
+        return self.parts[0]
+
 
 class UserVectorService:
+    @staticmethod
+    def add_change(user: Counter, language: str, additions: int, deletions: int, variable_names: [str],
+                   import_names: [str]) -> None:
+        """
+        Add features of a change to the user counters.
+
+        :param user: The user counters.
+        :param language: Language of the changed file.
+        :param additions: Number of added lines.
+        :param deletions: Number of deleted lines.
+        :param variable_names: Names declared in the file.
+        :param import_names: Imports and called functions of the file.
+        """
+        user[intern("a__" + language)] += additions
+        user[intern("d__" + language)] += deletions
+        for variable_name in variable_names:
+            user[intern("v__" + variable_name)] += 10
+        for import_name in import_names:
+            user[intern("i__" + import_name)] += 10
+
+    @staticmethod
+    def add_commits(ds: dict, commits: Iterable[dict]) -> None:
+        for commit in commits:
+            if commit["author"] not in ds:
+                ds[commit["author"]] = Counter()
+            user = ds[commit["author"]]
+            for change in commit["changes"]:
+                UserVectorService.add_change(user, change["language"], change["additions"], change["deletions"],
+                                             change["variable_names"], change["import_names"])
+
     @staticmethod
     def get_users_dict(repositories: list) -> dict:
         """
@@ -17,45 +153,477 @@ class UserVectorService:
         """
         print("Getting all devs from JSONs...")
         ds = dict()
-        for repository in tqdm.tqdm(repositories):
-            for commit in repository["commits"]:
-                if commit["author"] not in ds:
-                    ds[commit["author"]] = dict()
-                for change in commit["changes"]:
-                    if change["language"] not in ds[commit["author"]]:
-                        ds[commit["author"]]["a__" + change["language"]] = 0
-                        ds[commit["author"]]["d__" + change["language"]] = 0
-                    ds[commit["author"]]["a__" + change["language"]] += change["additions"]
-                    ds[commit["author"]]["d__" + change["language"]] += change["deletions"]
-                    for variable_name in change["variable_names"]:
-                        if variable_name not in ds[commit["author"]]:
-                            ds[commit["author"]]["v__" + variable_name] = 0
-                        ds[commit["author"]]["v__" + variable_name] += 10
-                    for import_name in change["import_names"]:
-                        if import_name not in ds[commit["author"]]:
-                            ds[commit["author"]]["i__" + import_name] = 0
-                        ds[commit["author"]]["i__" + import_name] += 10
+        with profiler.stage("aggregate", items=len(repositories)):
+            for repository in tqdm.tqdm(repositories):
+                UserVectorService.add_commits(ds, repository["commits"])
         return ds
 
     @staticmethod
-    def get_users_pandas(ds: dict) -> DataFrame:
+    def get_commits_counts(commits: Iterable[dict], vocabulary: FeatureVocabulary) -> FeatureCounts:
+        """
+        Count features of commits. Changes mined without the vocabulary are encoded while they are read.
+
+        :param commits: Commits of a repository.
+        :param vocabulary: Vocabulary of the corpus.
+        :return: Reduced feature counts.
+        """
+        counts = FeatureCounts()
+        rows, columns, values = [], [], []
+        name_rows, name_ids = [], []
+        for commit in commits:
+            row = counts.get_row(commit["author"])
+            for change in commit["changes"]:
+                if "language_id" in change:
+                    language_id, variable_ids, import_ids = \
+                        change["language_id"], change["variable_ids"], change["import_ids"]
+                else:
+                    language_id, variable_ids, import_ids = vocabulary.encode_names(
+                        change["language"], change["variable_names"], change["import_names"])
+                rows += [row, row]
+                columns += [2 * language_id, 2 * language_id + 1]
+                values += [change["additions"], change["deletions"]]
+                name_rows += [row] * (len(variable_ids) + len(import_ids))
+                name_ids += variable_ids
+                name_ids += import_ids
+        counts.add(numpy.array(rows), numpy.array(columns), numpy.array(values))
+        counts.add(numpy.array(name_rows), numpy.array(name_ids, dtype=numpy.int64) * 2, numpy.full(len(name_ids), 10))
+        counts.reduce()
+        return counts
+
+    @staticmethod
+    def get_column_ids(column: Union[StringColumn, ListColumn], prefix: str,
+                       vocabulary: FeatureVocabulary) -> numpy.ndarray:
+        """
+        Get vocabulary ids of the values of a columnar part. Values of the parts written without the vocabulary
+        are encoded once per dictionary entry.
+
+        :param column: The column.
+        :param prefix: Prefix of the feature names of the values.
+        :param vocabulary: Vocabulary of the corpus.
+        :return: Ids of the column codes.
+        """
+        codes = numpy.asarray(column.codes, dtype=numpy.int64)
+        if column.dictionary is None:
+            return codes
+        ids = numpy.array(vocabulary.get_ids([prefix + value for value in column.dictionary]), dtype=numpy.int64)
+        return ids[codes]
+
+    @staticmethod
+    def get_columnar_counts(path: str, vocabulary: FeatureVocabulary) -> FeatureCounts:
+        """
+        Count features of a columnar repository with array operations over whole parts.
+
+        :param path: Path to the columnar repository.
+        :param vocabulary: Vocabulary of the corpus.
+        :return: Reduced feature counts.
+        """
+        counts = FeatureCounts()
+        for part in ColumnarReader(path).read(["author", "language", "additions", "deletions", "names", "imports"]):
+            authors = part["author"]
+            author_rows = numpy.array([counts.get_row(author) for author in authors.dictionary], dtype=numpy.int64)
+            rows = author_rows[numpy.asarray(authors.codes, dtype=numpy.int64)]
+            languages = UserVectorService.get_column_ids(part["language"], "a__", vocabulary)
+            counts.add(rows, 2 * languages, part["additions"])
+            counts.add(rows, 2 * languages + 1, part["deletions"])
+            for column, prefix in [("names", "v__"), ("imports", "i__")]:
+                ids = UserVectorService.get_column_ids(part[column], prefix, vocabulary)
+                counts.add(numpy.repeat(rows, numpy.diff(part[column].offsets)), 2 * ids, numpy.full(len(ids), 10))
+        counts.reduce()
+        return counts
+
+    @staticmethod
+    def get_repository_counts(path: str, vocabulary_path: str) -> FeatureCounts:
+        """
+        Count features of one repository file streaming its commits.
+
+        :param path: Path to a json file or a columnar repository.
+        :param vocabulary_path: Path to the vocabulary of the corpus.
+        :return: Reduced feature counts.
+        """
+        vocabulary = get_vocabulary(vocabulary_path)
+        with profiler.stage("aggregate", items=1):
+            if os.path.isdir(path):
+                return UserVectorService.get_columnar_counts(path, vocabulary)
+            return UserVectorService.get_commits_counts(JsonService.iter_commits(path), vocabulary)
+
+    @staticmethod
+    def get_counts_from_files(paths: [str], vocabulary_path: str = VOCABULARY_PATH,
+                              n_jobs: int = N_JOBS) -> FeatureCounts:
+        """
+        Count features of developers aggregating repository files in worker processes.
+        Each worker streams one repository and reduces it to the feature counts, which are merged as they are ready.
+
+        :param paths: Paths to json files or columnar repositories.
+        :param vocabulary_path: Path to the vocabulary of the corpus.
+        :param n_jobs: Number of worker processes.
+        :return: Feature counts.
+        """
+        print("Getting all devs from repositories...")
+        counts = FeatureCounts()
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(profiler.task(UserVectorService.get_repository_counts), path, vocabulary_path)
+                       for path in paths]
+            for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+                partial, stages = future.result()
+                profiler.merge(stages)
+                with profiler.stage("merge", items=len(partial.authors)):
+                    counts.merge(partial)
+        return counts
+
+    @staticmethod
+    def get_feature_names(columns: numpy.ndarray, names: [str]) -> [str]:
+        """
+        Get feature names of the columns of the feature counts.
+
+        :param columns: The columns.
+        :param names: Names of the vocabulary indexed by the ids.
+        :return: The feature names.
+        """
+        return [names[c // 2] if c % 2 == 0 else "d__" + names[c // 2][3:] for c in columns.tolist()]
+
+    @staticmethod
+    def get_feature_columns(columns: numpy.ndarray, names: [str], hashing: bool = False,
+                            n_features: int = HASHING_N_FEATURES) -> (numpy.ndarray, Optional[List[str]]):
+        """
+        Get columns of the user-feature matrix for the columns of feature counts.
+
+        :param columns: Counted columns.
+        :param names: Names of the vocabulary indexed by the ids.
+        :param hashing: Hash features into a fixed number of columns instead of sorting their names.
+        :param n_features: Number of columns in the hashing mode.
+        :return: Matrix column of every counted column and the sorted feature names, None in the hashing mode.
+        """
+        feature_names = UserVectorService.get_feature_names(columns, names)
+        if hashing:
+            hasher = FeatureHasher(n_features=n_features, input_type="dict", alternate_sign=False, dtype=numpy.float32)
+            feature_columns = numpy.empty(0, dtype=numpy.int64)
+            if feature_names:
+                feature_columns = hasher.transform({name: 1} for name in feature_names).indices.astype(numpy.int64)
+            return feature_columns, None
+        order = sorted(range(len(feature_names)), key=feature_names.__getitem__)
+        feature_columns = numpy.empty(len(feature_names), dtype=numpy.int64)
+        feature_columns[order] = numpy.arange(len(order))
+        return feature_columns, [feature_names[i] for i in order]
+
+    @staticmethod
+    def get_counts_matrix(rows: numpy.ndarray, columns: numpy.ndarray, values: numpy.ndarray, n_rows: int,
+                          counted: numpy.ndarray, feature_columns: numpy.ndarray, n_columns: int) -> csr_matrix:
+        """
+        Build rows of the user-feature matrix from reduced feature counts.
+
+        :param rows: Rows of the counts.
+        :param columns: Columns of the counts.
+        :param values: The counts.
+        :param n_rows: Number of rows.
+        :param counted: Sorted counted columns including the columns of the counts.
+        :param feature_columns: Matrix column of every counted column.
+        :param n_columns: Number of matrix columns.
+        :return: The matrix.
+        """
+        matrix = csr_matrix((values.astype(numpy.float32), (rows, feature_columns[numpy.searchsorted(counted, columns)])),
+                            shape=(n_rows, n_columns), dtype=numpy.float32)
+        matrix.sum_duplicates()
+        matrix.eliminate_zeros()
+        return matrix
+
+    @staticmethod
+    def get_counts_vectors(counts: FeatureCounts, names: [str], hashing: bool = False,
+                           n_features: int = HASHING_N_FEATURES) -> UserVectors:
+        """
+        Build the sparse user-feature matrix from feature counts. The matrix is the same get_user_vectors builds
+        from the dict with the same counts: authors and features are sorted and only the seen features have columns.
+
+        :param counts: Feature counts.
+        :param names: Names of the vocabulary indexed by the ids.
+        :param hashing: Hash features into a fixed number of columns instead of building a vocabulary.
+        :param n_features: Number of columns in the hashing mode.
+        :return: User vectors with the raw counts.
+        """
+        print("Building vectorizer...")
+        with profiler.stage("vectorize", items=len(counts.authors)):
+            rows, columns, values = counts.reduce()
+            authors = sorted(counts.authors)
+            author_rows = numpy.empty(len(authors), dtype=numpy.int64)
+            author_rows[[counts.author_index[author] for author in authors]] = numpy.arange(len(authors))
+            rows = author_rows[rows]
+            counted = numpy.unique(columns)
+            feature_columns, features = UserVectorService.get_feature_columns(counted, names, hashing, n_features)
+            n_columns = n_features if hashing else len(features)
+            matrix = UserVectorService.get_counts_matrix(
+                rows, columns, values, len(authors), counted, feature_columns, n_columns)
+            raw = csr_matrix((values, (rows, columns)), shape=(len(authors), 2 * len(names)), dtype=numpy.float64)
+        return UserVectors(matrix, authors, features, counts=VectorCounts(raw, counted, feature_columns))
+
+    @staticmethod
+    def add_feature_columns(vectors: UserVectors, columns: numpy.ndarray, names: [str], hashing: bool = False) -> \
+            (numpy.ndarray, numpy.ndarray, Optional[List[str]], Optional[numpy.ndarray]):
+        """
+        Add matrix columns for new counted columns keeping the order of the features by name.
+
+        :param vectors: User vectors with raw counts.
+        :param columns: Counted columns of a delta.
+        :param names: Names of the vocabulary indexed by the ids.
+        :param hashing: The vectors are hashed.
+        :return: Counted columns, matrix column of every counted column, sorted feature names
+                 and new matrix column of every previous column, None in the hashing mode.
+        """
+        new_columns = numpy.setdiff1d(columns, vectors.counts.columns)
+        counted = numpy.concatenate([vectors.counts.columns, new_columns])
+        if hashing:
+            new_feature_columns, _ = UserVectorService.get_feature_columns(
+                new_columns, names, True, vectors.matrix.shape[1])
+            feature_columns = numpy.concatenate([vectors.counts.feature_columns, new_feature_columns])
+            order = numpy.argsort(counted)
+            return counted[order], feature_columns[order], None, None
+        new_names = UserVectorService.get_feature_names(new_columns, names)
+        new_order = sorted(range(len(new_names)), key=new_names.__getitem__)
+        positions = numpy.array([bisect_left(vectors.features, new_names[i]) for i in new_order], dtype=numpy.int64)
+        remap = numpy.arange(len(vectors.features)) + numpy.searchsorted(
+            positions, numpy.arange(len(vectors.features)), side="right")
+        new_feature_columns = numpy.empty(len(new_names), dtype=numpy.int64)
+        new_feature_columns[new_order] = positions + numpy.arange(len(positions))
+        features = [None] * (len(vectors.features) + len(new_names))
+        for column, name in zip(remap.tolist(), vectors.features):
+            features[column] = name
+        for column, name in zip(new_feature_columns.tolist(), new_names):
+            features[column] = name
+        feature_columns = numpy.concatenate([remap[vectors.counts.feature_columns], new_feature_columns])
+        order = numpy.argsort(counted)
+        return counted[order], feature_columns[order], features, remap
+
+    @staticmethod
+    def update_vectors(vectors: UserVectors, norms: numpy.ndarray, delta: FeatureCounts, names: [str],
+                       hashing: bool = False) -> (UserVectors, numpy.ndarray, numpy.ndarray, numpy.ndarray):
+        """
+        Add feature counts to normalized user vectors with raw counts. Only the rows of the authors of the delta
+        are counted and normalized again, other rows are copied with their norms and moved to the new columns,
+        so the result is the same get_counts_vectors and normalize_rows give for all counts.
+
+        :param vectors: Normalized user vectors with raw counts.
+        :param norms: Norms of the rows of the vectors.
+        :param delta: Feature counts to add.
+        :param names: Names of the vocabulary indexed by the ids.
+        :param hashing: The vectors are hashed.
+        :return: Updated normalized vectors with raw counts, norms of the rows, previous row of every row
+                 (-1 for new authors) and the rows whose vectors changed.
+        """
+        with profiler.stage("vectorize", items=len(delta.authors)):
+            delta_rows, delta_columns, delta_values = delta.reduce()
+            authors = sorted(set(vectors.authors).union(delta.authors))
+            author_index = {author: i for i, author in enumerate(authors)}
+            old_rows = numpy.full(len(authors), -1, dtype=numpy.int64)
+            old_rows[[author_index[author] for author in vectors.authors]] = numpy.arange(len(vectors.authors))
+            touched = numpy.unique(numpy.array([author_index[author] for author in delta.authors], dtype=numpy.int64))
+            kept = numpy.setdiff1d(numpy.arange(len(authors)), touched)
+            counted, feature_columns, features, remap = UserVectorService.add_feature_columns(
+                vectors, delta_columns, names, hashing)
+            n_columns = vectors.matrix.shape[1] if hashing else len(features)
+
+            merged = FeatureCounts()
+            for row in touched.tolist():
+                merged.get_row(authors[row])
+            existing = numpy.flatnonzero(old_rows[touched] >= 0)
+            previous = vectors.counts.matrix[old_rows[touched[existing]]].tocoo()
+            merged.add(existing[previous.row], previous.col, previous.data)
+            merged.add(numpy.array([merged.author_index[author] for author in delta.authors], dtype=numpy.int64)[
+                delta_rows], delta_columns, delta_values)
+            rows, columns, values = merged.reduce()
+            touched_matrix, touched_norms = UserVectorService.normalize_rows(UserVectorService.get_counts_matrix(
+                rows, columns, values, len(touched), counted, feature_columns, n_columns))
+            touched_counts = csr_matrix((values, (rows, columns)), shape=(len(touched), 2 * len(names)),
+                                        dtype=numpy.float64)
+
+            kept_matrix = vectors.matrix[old_rows[kept]]
+            changed = touched
+            if remap is not None:
+                indices = remap[kept_matrix.indices]
+                entry_rows = numpy.repeat(numpy.arange(len(kept)), numpy.diff(kept_matrix.indptr))
+                changed = numpy.union1d(touched, kept[numpy.unique(entry_rows[indices != kept_matrix.indices])])
+                kept_matrix = csr_matrix((kept_matrix.data, indices, kept_matrix.indptr), shape=(len(kept), n_columns))
+            kept_counts = vectors.counts.matrix[old_rows[kept]]
+            kept_counts = csr_matrix((kept_counts.data, kept_counts.indices, kept_counts.indptr),
+                                     shape=(len(kept), 2 * len(names)))
+
+            positions = numpy.empty(len(authors), dtype=numpy.int64)
+            positions[kept] = numpy.arange(len(kept))
+            positions[touched] = len(kept) + numpy.arange(len(touched))
+            matrix = csr_matrix(vstack([kept_matrix, touched_matrix], format="csr")[positions])
+            raw = csr_matrix(vstack([kept_counts, touched_counts], format="csr")[positions])
+            updated_norms = numpy.empty(len(authors), dtype=numpy.float32)
+            updated_norms[kept] = norms[old_rows[kept]]
+            updated_norms[touched] = touched_norms
+        counts = VectorCounts(raw, counted, feature_columns)
+        return UserVectors(matrix, authors, features, normalized=True, counts=counts), updated_norms, old_rows, changed
+
+    @staticmethod
+    def get_user_vectors(ds: dict, hashing: bool = False, n_features: int = HASHING_N_FEATURES) -> UserVectors:
+        """
+        Build the sparse user-feature matrix. Authors and features are sorted, so the same counters
+        always give the same matrix.
+
+        :param ds: Dict with users, languages, variables, imports.
+        :param hashing: Hash features into a fixed number of columns instead of building a vocabulary.
+        :param n_features: Number of columns in the hashing mode.
+        :return: User vectors.
+        """
         print("Building vectorizer...")
-        vectorizer = DictVectorizer(dtype=numpy.uint8, sparse=False)
-        matrix = vectorizer.fit_transform(ds.values())
-        column_labels = vectorizer.get_feature_names()
+        with profiler.stage("vectorize", items=len(ds)):
+            authors = sorted(ds.keys())
+            if hashing:
+                hasher = FeatureHasher(
+                    n_features=n_features, input_type="dict", alternate_sign=False, dtype=numpy.float32)
+                matrix = hasher.transform(ds[author] for author in authors)
+                features = None
+            else:
+                vectorizer = DictVectorizer(dtype=numpy.float32, sparse=True, sort=True)
+                matrix = vectorizer.fit_transform(ds[author] for author in authors)
+                features = list(vectorizer.feature_names_)
+            matrix = csr_matrix(matrix, dtype=numpy.float32)
+            matrix.eliminate_zeros()
+        return UserVectors(matrix, authors, features)
+
+    @staticmethod
+    def get_users_pandas(ds: dict) -> DataFrame:
+        vectors = UserVectorService.get_user_vectors(ds)
         print("Building DataFrame...")
-        df = pd.DataFrame(matrix, columns=column_labels, index=ds.keys())
-        df.fillna(0, inplace=True)
-        del ds
-        return df
+        return pd.DataFrame.sparse.from_spmatrix(vectors.matrix, index=vectors.authors, columns=vectors.features)
+
+    @staticmethod
+    def normalize_rows(matrix: csr_matrix) -> (csr_matrix, numpy.ndarray):
+        """
+        L2-normalize rows of a matrix.
+
+        :param matrix: The matrix.
+        :return: The normalized matrix and the norms of the rows.
+        """
+        squares = matrix.multiply(matrix).sum(axis=1, dtype=numpy.float64)
+        norms = numpy.sqrt(numpy.asarray(squares).ravel())
+        scale = numpy.divide(1.0, norms, out=numpy.zeros_like(norms), where=norms > 0)
+        data = (matrix.data * numpy.repeat(scale, numpy.diff(matrix.indptr))).astype(numpy.float32)
+        normalized = csr_matrix((data, matrix.indices.copy(), matrix.indptr.copy()), shape=matrix.shape)
+        return normalized, norms.astype(numpy.float32)
+
+    @staticmethod
+    def get_normalized(vectors: UserVectors) -> UserVectors:
+        if vectors.normalized:
+            return vectors
+        matrix, _ = UserVectorService.normalize_rows(vectors.matrix)
+        return UserVectors(matrix, vectors.authors, vectors.features, normalized=True)
+
+    @staticmethod
+    def top_k(matrix: csr_matrix, query: numpy.ndarray, k: int, exclude: int = None,
+              chunk_rows: int = SEARCH_CHUNK_ROWS) -> [(int, float)]:
+        """
+        Find the rows with the largest dot product with the query scoring the matrix chunk by chunk.
+        Only the current top k candidates are kept between chunks, so the scratch memory is bounded by the chunk size.
+
+        :param matrix: Matrix with L2-normalized rows.
+        :param query: Dense L2-normalized query vector.
+        :param k: Number of rows to return.
+        :param exclude: Row to skip, usually the query itself.
+        :param chunk_rows: Number of rows scored at once.
+        :return: Row numbers and scores, the most similar first.
+        """
+        best_rows = numpy.empty(0, dtype=numpy.int64)
+        best_scores = numpy.empty(0, dtype=numpy.float32)
+        for start in range(0, matrix.shape[0], chunk_rows):
+            scores = numpy.asarray(matrix[start:start + chunk_rows].dot(query), dtype=numpy.float32).ravel()
+            rows = numpy.arange(start, start + len(scores))
+            if exclude is not None and start <= exclude < start + len(scores):
+                scores[exclude - start] = -numpy.inf
+            best_rows = numpy.concatenate([best_rows, rows])
+            best_scores = numpy.concatenate([best_scores, scores])
+            if len(best_scores) > k:
+                selected = numpy.argpartition(-best_scores, k - 1)[:k]
+                best_rows, best_scores = best_rows[selected], best_scores[selected]
+        order = numpy.lexsort((best_rows, -best_scores))
+        return [(int(best_rows[i]), float(best_scores[i])) for i in order if best_scores[i] != -numpy.inf]
+
+    @staticmethod
+    def get_knn_block(matrix: csr_matrix, rows: numpy.ndarray, k: int,
+                      chunk_rows: int = SEARCH_CHUNK_ROWS) -> (numpy.ndarray, numpy.ndarray):
+        """
+        Find top k neighbours of a block of rows multiplying the block by the matrix chunk by chunk.
+        The scratch memory is bounded by the block size times the chunk size.
+
+        :param matrix: Matrix with L2-normalized rows.
+        :param rows: Rows of the block.
+        :param k: Number of neighbours.
+        :param chunk_rows: Number of rows scored at once.
+        :return: Neighbour rows and scores of every block row, the most similar first, padded with -1 and 0.
+        """
+        queries = matrix[rows].T.tocsc()
+        best_rows = numpy.empty((len(rows), 0), dtype=numpy.int64)
+        best_scores = numpy.empty((len(rows), 0), dtype=numpy.float32)
+        for start in range(0, matrix.shape[0], chunk_rows):
+            scores = numpy.asarray((matrix[start:start + chunk_rows] @ queries).toarray().T, dtype=numpy.float32)
+            chunk = numpy.arange(start, start + scores.shape[1])
+            inside = (rows >= start) & (rows < start + scores.shape[1])
+            scores[numpy.flatnonzero(inside), rows[inside] - start] = -numpy.inf
+            best_rows = numpy.concatenate([best_rows, numpy.broadcast_to(chunk, scores.shape)], axis=1)
+            best_scores = numpy.concatenate([best_scores, scores], axis=1)
+            if best_scores.shape[1] > k:
+                selected = numpy.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_rows = numpy.take_along_axis(best_rows, selected, axis=1)
+                best_scores = numpy.take_along_axis(best_scores, selected, axis=1)
+        by_row = numpy.argsort(best_rows, axis=1)
+        best_rows = numpy.take_along_axis(best_rows, by_row, axis=1)
+        best_scores = numpy.take_along_axis(best_scores, by_row, axis=1)
+        by_score = numpy.argsort(-best_scores, axis=1, kind="stable")
+        best_rows = numpy.take_along_axis(best_rows, by_score, axis=1)
+        best_scores = numpy.take_along_axis(best_scores, by_score, axis=1)
+        missing = best_scores == -numpy.inf
+        best_rows[missing], best_scores[missing] = -1, 0
+        padding = k - best_rows.shape[1]
+        if padding > 0:
+            best_rows = numpy.pad(best_rows, ((0, 0), (0, padding)), constant_values=-1)
+            best_scores = numpy.pad(best_scores, ((0, 0), (0, padding)))
+        return best_rows.astype(numpy.int32), best_scores
 
     @staticmethod
-    def get_similar_dev(dataframe: DataFrame, name: str, max_cosine_similarity_devs: int) -> list:
+    def get_knn_graph(vectors: UserVectors, rows: numpy.ndarray, k: int, block_size: int = KNN_BLOCK_SIZE,
+                      chunk_rows: int = SEARCH_CHUNK_ROWS, n_jobs: int = N_JOBS) -> (numpy.ndarray, numpy.ndarray):
+        """
+        Find top k neighbours of many developers. Blocks of rows are processed in parallel.
+
+        :param vectors: User vectors.
+        :param rows: Rows of the developers.
+        :param k: Number of neighbours.
+        :param block_size: Number of developers in a block.
+        :param chunk_rows: Number of rows scored at once.
+        :param n_jobs: Number of jobs.
+        :return: Neighbour rows and scores, one row per developer.
+        """
+        matrix = UserVectorService.get_normalized(vectors).matrix
+        with profiler.stage("knn", items=len(rows)):
+            blocks = Parallel(n_jobs=n_jobs)(
+                delayed(UserVectorService.get_knn_block)(matrix, rows[start:start + block_size], k, chunk_rows)
+                for start in tqdm.tqdm(range(0, len(rows), block_size)))
+        if not blocks:
+            return numpy.empty((0, k), dtype=numpy.int32), numpy.empty((0, k), dtype=numpy.float32)
+        return numpy.concatenate([b[0] for b in blocks]), numpy.concatenate([b[1] for b in blocks])
+
+    @staticmethod
+    def get_similar_dev(vectors: UserVectors, name: str, k: int = 20, chunk_rows: int = SEARCH_CHUNK_ROWS,
+                        ann_index=None, n_probes: int = ANN_N_PROBES) -> list:
+        """
+        Find the developers most similar to the given one by the cosine similarity over all developers.
+
+        :param vectors: User vectors.
+        :param name: Name of the developer.
+        :param k: Number of similar developers.
+        :param chunk_rows: Number of developers scored at once.
+        :param ann_index: LshIndex fitted on the normalized vectors to search approximately.
+        :param n_probes: Number of probed buckets per table of the approximate search.
+        :return: Names and similarities, the most similar first.
+        """
         print("Getting similar devs...")
-        vector = dataframe.loc[[name]]
-        cosine_matrix = cosine_similarity(dataframe.head(max_cosine_similarity_devs), vector)
-        result_items = list(dict(zip(list(dataframe.index.values), list(cosine_matrix))).items())
-        first_index = 0
-        if result_items[0][0] == name:
-            first_index = 1
-        return sorted(result_items, key=lambda x: x[1], reverse=True)[first_index:20]
+        with profiler.stage("search", items=1):
+            vectors = UserVectorService.get_normalized(vectors)
+            row = vectors.author_index[name]
+            if ann_index is not None:
+                found = ann_index.search(vectors, row, k, n_probes)
+            else:
+                found = UserVectorService.top_k(
+                    vectors.matrix, vectors.matrix[row].toarray().ravel(), k, row, chunk_rows)
+        return [(vectors.authors[i], score) for i, score in found]
@@ -0,0 +1,293 @@
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+import time
+from typing import Iterator, List, Optional
+
+import numpy
+from scipy.sparse import csr_matrix
+
+from similar_dev_search.data.constants import HASHING_N_FEATURES, INDEX_VERSION
+from similar_dev_search.services.ann import LshIndex
+from similar_dev_search.services.columnar import decode_strings, encode_strings
+from similar_dev_search.services.profiler import profiler
+from similar_dev_search.services.user_vectors import FeatureCounts, UserVectors, UserVectorService, VectorCounts
+
+
+class VectorIndexService:
+    """
+    On-disk index of L2-normalized user vectors. Arrays are stored as .npy files and memory-mapped on load.
+    The metadata records the source files, so an index built from other data is detected as stale.
+    The raw feature counts of the vectors are stored too, so new source files are added without a rebuild.
+    """
+
+    @staticmethod
+    def get_file_hash(path: str) -> str:
+        sha = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    @staticmethod
+    def get_sources(paths: List[str], with_hashes: bool = False) -> List[dict]:
+        """
+        Describe the source files of an index. A columnar repository is described by its metadata file.
+
+        :param paths: Paths to json files or columnar repositories.
+        :param with_hashes: Add sha1 of the files to detect changes that keep the mtime.
+        :return: Source descriptions sorted by path.
+        """
+        sources = []
+        for path in sorted(paths):
+            file_path = os.path.join(path, "meta.json") if os.path.isdir(path) else path
+            stat = os.stat(file_path)
+            source = {"path": path, "mtime": stat.st_mtime, "size": stat.st_size}
+            if with_hashes:
+                source["sha1"] = VectorIndexService.get_file_hash(file_path)
+            sources.append(source)
+        return sources
+
+    @staticmethod
+    def save_strings(directory: Path, name: str, strings: List[str]) -> None:
+        offsets, data = encode_strings(strings)
+        numpy.save(directory / (name + ".offsets.npy"), offsets)
+        numpy.save(directory / (name + ".data.npy"), data)
+
+    @staticmethod
+    def load_strings(directory: Path, name: str) -> List[str]:
+        return decode_strings(
+            numpy.load(directory / (name + ".offsets.npy"), mmap_mode="r"),
+            numpy.load(directory / (name + ".data.npy"), mmap_mode="r"))
+
+    @staticmethod
+    @contextmanager
+    def lock(index_path: str) -> Iterator[None]:
+        """
+        Hold the exclusive write lock of an index. The lock file is next to the index directory, which is replaced
+        on every write. Writers take the lock around reading and writing the index, readers don't need it.
+
+        :param index_path: Path to the index directory.
+        """
+        path = Path(index_path).resolve()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path.parent / (path.name + ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    @staticmethod
+    def build(vectors: UserVectors, sources: List[dict], index_path: str, ann_index: LshIndex = None) -> None:
+        """
+        Write user vectors to an index, replacing the existing one. The caller holds the lock of the index.
+
+        :param vectors: User vectors with raw counters, the raw feature counts are stored to update the index.
+        :param sources: Descriptions of the source files from get_sources.
+        :param index_path: Path to the index directory.
+        :param ann_index: Approximate nearest neighbour index to store with the vectors, fitted if it is empty.
+        """
+        matrix, norms = UserVectorService.normalize_rows(vectors.matrix)
+        normalized = UserVectors(matrix, vectors.authors, vectors.features, normalized=True, counts=vectors.counts)
+        VectorIndexService.save(normalized, norms, sources, index_path, ann_index)
+
+    @staticmethod
+    def save(vectors: UserVectors, norms: numpy.ndarray, sources: List[dict], index_path: str,
+             ann_index: LshIndex = None) -> None:
+        """
+        Write normalized user vectors to an index, replacing the existing one. The caller holds the lock of the index.
+
+        :param vectors: Normalized user vectors.
+        :param norms: Norms of the rows before the normalization.
+        :param sources: Descriptions of the source files from get_sources.
+        :param index_path: Path to the index directory.
+        :param ann_index: Approximate nearest neighbour index to store with the vectors, fitted if it is empty.
+        """
+        path = Path(index_path).resolve()
+        part = path.parent / (path.name + ".part")
+        shutil.rmtree(part, ignore_errors=True)
+        part.mkdir(parents=True)
+        matrix = vectors.matrix
+        numpy.save(part / "data.npy", matrix.data)
+        numpy.save(part / "indices.npy", matrix.indices.astype(numpy.int32))
+        numpy.save(part / "indptr.npy", matrix.indptr.astype(numpy.int64))
+        numpy.save(part / "norms.npy", norms)
+        VectorIndexService.save_strings(part, "authors", vectors.authors)
+        if vectors.features is not None:
+            VectorIndexService.save_strings(part, "features", vectors.features)
+        if vectors.counts is not None:
+            numpy.save(part / "counts.data.npy", vectors.counts.matrix.data)
+            numpy.save(part / "counts.indices.npy", vectors.counts.matrix.indices.astype(numpy.int64))
+            numpy.save(part / "counts.indptr.npy", vectors.counts.matrix.indptr.astype(numpy.int64))
+            numpy.save(part / "counts.columns.npy", vectors.counts.columns)
+            numpy.save(part / "counts.feature_columns.npy", vectors.counts.feature_columns)
+        if ann_index is not None:
+            if ann_index.order.shape[1] != matrix.shape[0]:
+                ann_index.fit(matrix)
+            ann_index.save(str(part / "ann"))
+        meta = {
+            "version": INDEX_VERSION,
+            "created": time.time(),
+            "shape": list(matrix.shape),
+            "hashing": vectors.features is None,
+            "counts_shape": list(vectors.counts.matrix.shape) if vectors.counts is not None else None,
+            "sources": sources,
+        }
+        with open(part / "meta.json", "w") as f:
+            f.write(json.dumps(meta, indent=2))
+        old = path.parent / (path.name + ".old")
+        shutil.rmtree(old, ignore_errors=True)
+        if path.exists():
+            os.replace(path, old)
+        os.replace(part, path)
+        shutil.rmtree(old, ignore_errors=True)
+
+    @staticmethod
+    def get_source_key(source: dict) -> tuple:
+        if "sha1" in source:
+            return source["path"], source["sha1"]
+        return source["path"], source["mtime"], source["size"]
+
+    @staticmethod
+    def get_added_sources(index_path: str, sources: List[dict], hashing: bool = False,
+                          n_features: int = HASHING_N_FEATURES) -> Optional[List[dict]]:
+        """
+        Find the source files added since the index was built, if the index can be updated with them:
+        it has the raw counts, the same vectorization and all its source files are unchanged.
+
+        :param index_path: Path to the index directory.
+        :param sources: Descriptions of the current source files from get_sources.
+        :param hashing: Features are hashed into a fixed number of columns.
+        :param n_features: Number of columns in the hashing mode.
+        :return: Descriptions of the added source files or None if the index has to be rebuilt.
+        """
+        meta = VectorIndexService.get_meta(index_path)
+        if meta["counts_shape"] is None or meta["hashing"] != hashing or (hashing and meta["shape"][1] != n_features):
+            return None
+        current = {source["path"]: source for source in sources}
+        for source in meta["sources"]:
+            if source["path"] not in current or \
+                    VectorIndexService.get_source_key(source) != VectorIndexService.get_source_key(current[source["path"]]):
+                return None
+        recorded = {source["path"] for source in meta["sources"]}
+        return [source for source in sources if source["path"] not in recorded]
+
+    @staticmethod
+    def update(index_path: str, delta: FeatureCounts, names: [str], sources: List[dict],
+               ann_index: LshIndex = None) -> None:
+        """
+        Add feature counts of new source files to an index with raw counts. Only the vectors of the authors
+        of the delta are normalized and hashed again, the index is the same build writes for all source files.
+        The caller holds the lock of the index from finding the added source files to the update.
+
+        :param index_path: Path to the index directory.
+        :param delta: Feature counts of the new source files.
+        :param names: Names of the vocabulary indexed by the ids.
+        :param sources: Descriptions of all source files from get_sources.
+        :param ann_index: Approximate nearest neighbour index to store with the vectors, the stored one
+                          is updated if it has the same parameters or none is given, otherwise the given one is fitted.
+        """
+        path = Path(index_path).resolve()
+        meta = VectorIndexService.get_meta(index_path)
+        vectors = VectorIndexService.load(index_path)
+        vectors.counts = VectorIndexService.load_counts(index_path)
+        norms = numpy.load(path / "norms.npy", mmap_mode="r")
+        vectors, norms, old_rows, changed = UserVectorService.update_vectors(
+            vectors, norms, delta, names, meta["hashing"])
+        ann_path = VectorIndexService.get_ann_path(index_path)
+        if ann_index is None:
+            ann_index = VectorIndexService.get_stored_ann_index(index_path)
+        if ann_index is not None and LshIndex.exists(ann_path):
+            stored = LshIndex.load(ann_path)
+            if (stored.n_tables, stored.n_bits, stored.seed) == (ann_index.n_tables, ann_index.n_bits, ann_index.seed):
+                with profiler.stage("ann_update", items=len(changed)):
+                    ann_index = stored.update(vectors.matrix, old_rows, changed)
+        VectorIndexService.save(vectors, norms, sources, index_path, ann_index)
+
+    @staticmethod
+    def exists(index_path: str) -> bool:
+        return (Path(index_path) / "meta.json").is_file()
+
+    @staticmethod
+    def get_meta(index_path: str) -> dict:
+        with open(Path(index_path) / "meta.json", "r") as f:
+            meta = json.loads(f.read())
+        if meta["version"] != INDEX_VERSION:
+            raise ValueError(f"Unsupported index version {meta['version']} in {index_path}, rebuild the index")
+        return meta
+
+    @staticmethod
+    def is_stale(index_path: str, paths: List[str]) -> bool:
+        """
+        Check whether the index was built from other source files than the given ones.
+
+        :param index_path: Path to the index directory.
+        :param paths: Current paths to json files or columnar repositories.
+        :return: True if the index is stale.
+        """
+        recorded = VectorIndexService.get_meta(index_path)["sources"]
+        with_hashes = any("sha1" in source for source in recorded)
+        current = VectorIndexService.get_sources(paths, with_hashes)
+        if with_hashes:
+            return [(s["path"], s["sha1"]) for s in recorded] != [(s["path"], s["sha1"]) for s in current]
+        return [(s["path"], s["mtime"], s["size"]) for s in recorded] != \
+            [(s["path"], s["mtime"], s["size"]) for s in current]
+
+    @staticmethod
+    def get_ann_path(index_path: str) -> str:
+        return str(Path(index_path) / "ann")
+
+    @staticmethod
+    def get_stored_ann_index(index_path: str) -> Optional[LshIndex]:
+        """
+        Create an empty approximate nearest neighbour index with the parameters of the one stored in an index.
+
+        :param index_path: Path to the index directory.
+        :return: Approximate nearest neighbour index or None if the index has none.
+        """
+        ann_path = VectorIndexService.get_ann_path(index_path)
+        if not LshIndex.exists(ann_path):
+            return None
+        stored = LshIndex.load(ann_path)
+        return LshIndex(stored.n_tables, stored.n_bits, stored.seed)
+
+    @staticmethod
+    def load_counts(index_path: str) -> Optional[VectorCounts]:
+        """
+        Load the raw feature counts of an index. The arrays are memory-mapped.
+
+        :param index_path: Path to the index directory.
+        :return: The counts or None if the index has no counts.
+        """
+        path = Path(index_path).resolve()
+        meta = VectorIndexService.get_meta(index_path)
+        if meta["counts_shape"] is None:
+            return None
+        matrix = csr_matrix((
+            numpy.load(path / "counts.data.npy", mmap_mode="r"),
+            numpy.load(path / "counts.indices.npy", mmap_mode="r"),
+            numpy.load(path / "counts.indptr.npy", mmap_mode="r")),
+            shape=tuple(meta["counts_shape"]), copy=False)
+        return VectorCounts(matrix, numpy.load(path / "counts.columns.npy"),
+                            numpy.load(path / "counts.feature_columns.npy"))
+
+    @staticmethod
+    def load(index_path: str) -> UserVectors:
+        """
+        Load normalized user vectors from an index. The matrix arrays are memory-mapped.
+
+        :param index_path: Path to the index directory.
+        :return: Normalized user vectors.
+        """
+        path = Path(index_path).resolve()
+        meta = VectorIndexService.get_meta(index_path)
+        matrix = csr_matrix((
+            numpy.load(path / "data.npy", mmap_mode="r"),
+            numpy.load(path / "indices.npy", mmap_mode="r"),
+            numpy.load(path / "indptr.npy", mmap_mode="r")),
+            shape=tuple(meta["shape"]), copy=False)
+        features = None if meta["hashing"] else VectorIndexService.load_strings(path, "features")
+        return UserVectors(matrix, VectorIndexService.load_strings(path, "authors"), features, normalized=True,
+                           index_path=str(path))
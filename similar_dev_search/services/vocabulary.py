@@ -0,0 +1,117 @@
+import os
+from pathlib import Path
+import sqlite3
+from typing import Dict, List
+
+from similar_dev_search.data.constants import VOCABULARY_PATH
+from similar_dev_search.data.models import Commit, EncodedChange
+
+
+class FeatureVocabulary:
+    """
+    Per-corpus vocabulary of the feature names and their integer ids.
+
+    The names are the feature keys of a developer: "v__" + variable name, "i__" + import name and
+    "a__" + language for a language. An id is assigned when a name is seen for the first time and never changes,
+    so mined repositories store ids instead of the names. The database is shared between the mining processes
+    like SqliteCache, every process keeps the ids it has seen in memory.
+    """
+
+    def __init__(self, path: str = VOCABULARY_PATH) -> None:
+        Path(path).resolve().parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS features (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)")
+        self.ids: Dict[str, int] = {}
+
+    def get_ids(self, names: List[str]) -> List[int]:
+        """
+        Get ids of feature names adding the new names to the vocabulary.
+
+        :param names: The feature names.
+        :return: Ids of the names starting from 0.
+        """
+        missing = list(dict.fromkeys(name for name in names if name not in self.ids))
+        if missing:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany("INSERT OR IGNORE INTO features (name) VALUES (?)", [(n,) for n in missing])
+                for start in range(0, len(missing), 500):
+                    batch = missing[start:start + 500]
+                    rows = self.connection.execute(
+                        f"SELECT name, id FROM features WHERE name IN ({','.join('?' * len(batch))})", batch)
+                    self.ids.update((name, i - 1) for name, i in rows)
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return [self.ids[name] for name in names]
+
+    def get_names(self) -> List[str]:
+        """
+        Get all feature names.
+
+        :return: Names indexed by the ids.
+        """
+        names = []
+        for name, i in self.connection.execute("SELECT name, id FROM features ORDER BY id"):
+            names.extend([""] * (i - 1 - len(names)))
+            names.append(name)
+        return names
+
+    @staticmethod
+    def get_change_names(language: str, variable_names: [str], import_names: [str]) -> [str]:
+        return ["a__" + language] + ["v__" + name for name in variable_names] + ["i__" + name for name in import_names]
+
+    def encode_names(self, language: str, variable_names: [str], import_names: [str]) -> (int, [int], [int]):
+        """
+        Get ids of the features of a change.
+
+        :param language: Language of the changed file.
+        :param variable_names: Names declared in the file.
+        :param import_names: Imports and called functions of the file.
+        :return: Id of the language, ids of the variable names and ids of the import names.
+        """
+        ids = self.get_ids(FeatureVocabulary.get_change_names(language, variable_names, import_names))
+        return ids[0], ids[1:len(variable_names) + 1], ids[len(variable_names) + 1:]
+
+    def encode_commit(self, commit: Commit) -> Commit:
+        """
+        Replace the names of the changes of a mined commit with their ids.
+        The new names of all changes are added to the vocabulary at once.
+
+        :param commit: The commit.
+        :return: The commit with encoded changes.
+        """
+        self.get_ids([name for change in commit.changes for name in FeatureVocabulary.get_change_names(
+            change.language, change.variable_names, change.import_names)])
+        changes = []
+        for change in commit.changes:
+            language_id, variable_ids, import_ids = self.encode_names(
+                change.language, change.variable_names, change.import_names)
+            changes.append(EncodedChange(
+                change.file_name, language_id, change.deletions, change.additions, variable_ids, import_ids))
+        commit.changes = changes
+        return commit
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+# Vocabularies opened by the current process, keyed by the process id and the path
+vocabularies = {}
+
+
+def get_vocabulary(path: str) -> FeatureVocabulary:
+    """
+    Get the vocabulary opened by the current process, a forked process opens its own connection.
+
+    :param path: Path to the vocabulary database.
+    :return: The vocabulary.
+    """
+    key = (os.getpid(), path)
+    if key not in vocabularies:
+        vocabularies[key] = FeatureVocabulary(path)
+    return vocabularies[key]
@@ -0,0 +1,377 @@
+from contextlib import contextmanager
+import os
+from pathlib import Path
+import pickle
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+import uuid
+
+from similar_dev_search.data.constants import QUEUE_LEASE_SECONDS, QUEUE_MAX_ATTEMPTS, QUEUE_PATH
+from similar_dev_search.data.models import Commit, MiningPlan, QueueChunk
+
+# Repo states: "pending" waits for a worker, "claimed" is cloned, planned or mined whole under a lease,
+# "chunked" has chunk tasks, "merging" has all chunks mined and is merged under a lease, "done" and "failed" are final
+REPO_STATES = ["pending", "claimed", "chunked", "merging", "done", "failed"]
+
+
+class WorkQueue:
+    """
+    Durable queue of the repos of a crawl and of the commit chunks of the repos, stored in SQLite.
+
+    A worker claims a task with a lease and its heartbeat extends the leases of all its tasks. A task of a worker
+    that stopped is claimed again when the lease expires, a task is failed after max_attempts claims.
+    The mined chunks are saved next to the database, so a repo is merged from the chunks mined by any worker.
+    Several processes and machines can share the queue, if the filesystem supports SQLite locks.
+    """
+
+    def __init__(self, path: str = QUEUE_PATH, lease_seconds: float = QUEUE_LEASE_SECONDS,
+                 max_attempts: int = QUEUE_MAX_ATTEMPTS) -> None:
+        Path(path).resolve().parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.chunks_path = Path(path).resolve().parent / (Path(path).stem + "_chunks")
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.local = threading.local()
+        connection = self.get_connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS repos (name TEXT PRIMARY KEY, clone_url TEXT NOT NULL, position INTEGER NOT NULL, "
+            "state TEXT NOT NULL, owner TEXT, expires REAL, attempts INTEGER NOT NULL DEFAULT 0, plan BLOB, "
+            "chunks INTEGER NOT NULL DEFAULT 0, error TEXT)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (repo TEXT NOT NULL, number INTEGER NOT NULL, commit_ids BLOB NOT NULL, "
+            "state TEXT NOT NULL, owner TEXT, expires REAL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (repo, number))")
+        connection.execute("CREATE TABLE IF NOT EXISTS discoveries (owner TEXT PRIMARY KEY, expires REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS repos_state ON repos (state, position)")
+        connection.execute("CREATE INDEX IF NOT EXISTS chunks_state ON chunks (state)")
+
+    @staticmethod
+    def get_owner() -> str:
+        """
+        Get a new owner name of the leases, unique across the machines.
+
+        :return: Host name, process id and a random suffix.
+        """
+        return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def get_connection(self) -> sqlite3.Connection:
+        if not hasattr(self.local, "connection"):
+            self.local.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        return self.local.connection
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        connection = self.get_connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def set_meta(self, key: str, value) -> None:
+        self.get_connection().execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, pickle.dumps(value)))
+
+    def get_meta(self, key: str, default=None):
+        row = self.get_connection().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return pickle.loads(row[0]) if row is not None else default
+
+    def add_repo(self, name: str, clone_url: str) -> bool:
+        """
+        Add a discovered repo, a repo already in the queue is left as is.
+
+        :param name: Name of the repo.
+        :param clone_url: Clone url of the repo.
+        :return: True if the repo is new.
+        """
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO repos (name, clone_url, position, state) "
+                "SELECT ?, ?, COALESCE(MAX(position), -1) + 1, 'pending' FROM repos", (name, clone_url))
+            return cursor.rowcount > 0
+
+    def count_repos(self) -> int:
+        return self.get_connection().execute("SELECT COUNT(*) FROM repos").fetchone()[0]
+
+    def get_counts(self) -> Dict[str, int]:
+        """
+        Count the repos in every state.
+
+        :return: Dict of the state and the number of repos.
+        """
+        counts = dict.fromkeys(REPO_STATES, 0)
+        counts.update(self.get_connection().execute("SELECT state, COUNT(*) FROM repos GROUP BY state"))
+        return counts
+
+    def requeue_done(self) -> int:
+        """
+        Return the mined repos to the queue to mine their new commits.
+
+        :return: Number of the returned repos.
+        """
+        with self.transaction() as connection:
+            return connection.execute(
+                "UPDATE repos SET state = 'pending', owner = NULL, expires = NULL, attempts = 0, plan = NULL, "
+                "chunks = 0, error = NULL WHERE state = 'done'").rowcount
+
+    def fail_expired(self, connection: sqlite3.Connection, now: float) -> None:
+        """
+        Fail the tasks whose last allowed lease expired.
+        """
+        connection.execute(
+            "UPDATE repos SET state = 'failed', owner = NULL, error = 'lease expired' "
+            "WHERE state IN ('claimed', 'merging') AND expires < ? AND attempts >= ?", (now, self.max_attempts))
+        failed = [row[0] for row in connection.execute(
+            "SELECT DISTINCT repo FROM chunks WHERE state = 'claimed' AND expires < ? AND attempts >= ?",
+            (now, self.max_attempts))]
+        for name in failed:
+            self.fail_chunked_repo(connection, name, "lease expired")
+
+    def fail_chunked_repo(self, connection: sqlite3.Connection, name: str, error: str) -> None:
+        connection.execute(
+            "UPDATE repos SET state = 'failed', owner = NULL, error = ? WHERE name = ?", (error, name))
+        connection.execute("DELETE FROM chunks WHERE repo = ?", (name,))
+        shutil.rmtree(self.chunks_path / name, ignore_errors=True)
+
+    def claim_repo(self, owner: str) -> Optional[tuple]:
+        """
+        Claim the first discovered repo that waits for a worker or whose lease expired.
+
+        :param owner: Owner of the lease.
+        :return: Name and clone url of the repo or None if there is no such repo.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            self.fail_expired(connection, now)
+            row = connection.execute(
+                "SELECT name, clone_url FROM repos WHERE state = 'pending' OR (state = 'claimed' AND expires < ?) "
+                "ORDER BY position LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE repos SET state = 'claimed', owner = ?, expires = ?, attempts = attempts + 1 WHERE name = ?",
+                    (owner, now + self.lease_seconds, row[0]))
+        return row
+
+    def complete_repo(self, name: str, owner: str) -> bool:
+        """
+        Mark a repo claimed or merged by the owner as done.
+
+        :param name: Name of the repo.
+        :param owner: Owner of the lease.
+        :return: False if the lease was lost and the repo is handled by another worker.
+        """
+        with self.transaction() as connection:
+            done = connection.execute(
+                "UPDATE repos SET state = 'done', owner = NULL, expires = NULL, plan = NULL, error = NULL "
+                "WHERE name = ? AND state IN ('claimed', 'merging') AND owner = ?", (name, owner)).rowcount > 0
+            if done:
+                connection.execute("DELETE FROM chunks WHERE repo = ?", (name,))
+        if done:
+            shutil.rmtree(self.chunks_path / name, ignore_errors=True)
+        return done
+
+    def fail_repo(self, name: str, owner: str, error: str) -> None:
+        """
+        Return a repo claimed by the owner to the queue or fail it if it was claimed max_attempts times.
+
+        :param name: Name of the repo.
+        :param owner: Owner of the lease.
+        :param error: Description of the failure.
+        """
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE repos SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, owner = NULL, "
+                "expires = NULL, error = ? WHERE name = ? AND state = 'claimed' AND owner = ?",
+                (self.max_attempts, error, name, owner))
+
+    def add_chunks(self, name: str, owner: str, plan: MiningPlan, chunks: List[List[bytes]]) -> bool:
+        """
+        Split the mining of a repo claimed by the owner into chunk tasks and release the repo.
+
+        :param name: Name of the repo.
+        :param owner: Owner of the lease.
+        :param plan: Mining plan of the repo.
+        :param chunks: Commit ids of the chunks in the walk order.
+        :return: False if the lease was lost.
+        """
+        shutil.rmtree(self.chunks_path / name, ignore_errors=True)
+        with self.transaction() as connection:
+            updated = connection.execute(
+                "UPDATE repos SET state = 'chunked', owner = NULL, expires = NULL, attempts = 0, plan = ?, chunks = ? "
+                "WHERE name = ? AND state = 'claimed' AND owner = ?",
+                (pickle.dumps(plan), len(chunks), name, owner)).rowcount > 0
+            if updated:
+                connection.execute("DELETE FROM chunks WHERE repo = ?", (name,))
+                connection.executemany(
+                    "INSERT INTO chunks (repo, number, commit_ids, state) VALUES (?, ?, ?, 'pending')",
+                    [(name, number, pickle.dumps(commit_ids)) for number, commit_ids in enumerate(chunks)])
+        return updated
+
+    def claim_chunk(self, owner: str) -> Optional[QueueChunk]:
+        """
+        Claim a chunk that waits for a worker or whose lease expired, the chunks of the earlier repos first.
+
+        :param owner: Owner of the lease.
+        :return: The chunk or None if there is no such chunk.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            self.fail_expired(connection, now)
+            row = connection.execute(
+                "SELECT c.repo, c.number, c.commit_ids, r.plan FROM chunks c JOIN repos r ON r.name = c.repo "
+                "WHERE r.state = 'chunked' AND (c.state = 'pending' OR (c.state = 'claimed' AND c.expires < ?)) "
+                "ORDER BY r.position, c.number LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE chunks SET state = 'claimed', owner = ?, expires = ?, attempts = attempts + 1 "
+                "WHERE repo = ? AND number = ?", (owner, now + self.lease_seconds, row[0], row[1]))
+        return QueueChunk(row[0], row[1], pickle.loads(row[3]), pickle.loads(row[2]))
+
+    def get_chunk_path(self, name: str, number: int) -> Path:
+        return self.chunks_path / name / f"{number:06d}.pickle"
+
+    def complete_chunk(self, chunk: QueueChunk, owner: str, commits: List[Commit]) -> bool:
+        """
+        Save the mined commits of a chunk claimed by the owner. The owner completing the last chunk of a repo
+        claims the merge of the repo.
+
+        :param chunk: The chunk.
+        :param owner: Owner of the lease.
+        :param commits: Mined commits of the chunk.
+        :return: True if the owner has to merge the repo.
+        """
+        path = self.get_chunk_path(chunk.repo, chunk.number)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(str(path) + ".part", "wb") as f:
+            pickle.dump(commits, f)
+        os.replace(str(path) + ".part", path)
+        with self.transaction() as connection:
+            completed = connection.execute(
+                "UPDATE chunks SET state = 'done', owner = NULL, expires = NULL "
+                "WHERE repo = ? AND number = ? AND state = 'claimed' AND owner = ?",
+                (chunk.repo, chunk.number, owner)).rowcount > 0
+            remaining = connection.execute(
+                "SELECT COUNT(*) FROM chunks WHERE repo = ? AND state != 'done'", (chunk.repo,)).fetchone()[0]
+            if not completed or remaining > 0:
+                return False
+            return connection.execute(
+                "UPDATE repos SET state = 'merging', owner = ?, expires = ?, attempts = attempts + 1 "
+                "WHERE name = ? AND state = 'chunked'",
+                (owner, time.time() + self.lease_seconds, chunk.repo)).rowcount > 0
+
+    def fail_chunk(self, chunk: QueueChunk, owner: str, error: str) -> None:
+        """
+        Return a chunk claimed by the owner to the queue or fail its repo if it was claimed max_attempts times.
+
+        :param chunk: The chunk.
+        :param owner: Owner of the lease.
+        :param error: Description of the failure.
+        """
+        with self.transaction() as connection:
+            row = connection.execute(
+                "SELECT attempts FROM chunks WHERE repo = ? AND number = ? AND state = 'claimed' AND owner = ?",
+                (chunk.repo, chunk.number, owner)).fetchone()
+            if row is None:
+                return
+            if row[0] >= self.max_attempts:
+                self.fail_chunked_repo(connection, chunk.repo, error)
+            else:
+                connection.execute(
+                    "UPDATE chunks SET state = 'pending', owner = NULL, expires = NULL WHERE repo = ? AND number = ?",
+                    (chunk.repo, chunk.number))
+
+    def claim_merge(self, owner: str) -> Optional[tuple]:
+        """
+        Claim the merge of a repo whose merging worker stopped.
+
+        :param owner: Owner of the lease.
+        :return: Name of the repo and its mining plan or None if there is no such repo.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            self.fail_expired(connection, now)
+            row = connection.execute(
+                "SELECT name, plan FROM repos WHERE state = 'merging' AND expires < ? ORDER BY position LIMIT 1",
+                (now,)).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE repos SET owner = ?, expires = ?, attempts = attempts + 1 WHERE name = ?",
+                (owner, now + self.lease_seconds, row[0]))
+        return row[0], pickle.loads(row[1])
+
+    def iter_merged_commits(self, name: str) -> Iterator[Commit]:
+        """
+        Read the mined commits of all chunks of a repo in the walk order.
+
+        :param name: Name of the repo.
+        :return: The commits.
+        """
+        chunks = self.get_connection().execute("SELECT chunks FROM repos WHERE name = ?", (name,)).fetchone()[0]
+        for number in range(chunks):
+            with open(self.get_chunk_path(name, number), "rb") as f:
+                yield from pickle.load(f)
+
+    def start_discovery(self, owner: str) -> None:
+        """
+        Register a running discovery of the owner under a lease, the repos it will add keep the workers waiting.
+
+        :param owner: Owner of the discovery.
+        """
+        with self.transaction() as connection:
+            connection.execute("INSERT OR REPLACE INTO discoveries (owner, expires) VALUES (?, ?)",
+                               (owner, time.time() + self.lease_seconds))
+
+    def finish_discovery(self, owner: str) -> None:
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM discoveries WHERE owner = ?", (owner,))
+
+    def is_discovering(self) -> bool:
+        """
+        Check if a discovery of any owner is running, a discovery whose lease expired is considered stopped.
+        """
+        row = self.get_connection().execute(
+            "SELECT 1 FROM discoveries WHERE expires >= ? LIMIT 1", (time.time(),)).fetchone()
+        return row is not None
+
+    def heartbeat(self, owner: str) -> None:
+        """
+        Extend the leases of all tasks and of the discovery of the owner.
+
+        :param owner: Owner of the leases.
+        """
+        expires = time.time() + self.lease_seconds
+        with self.transaction() as connection:
+            connection.execute("UPDATE discoveries SET expires = ? WHERE owner = ?", (expires, owner))
+            connection.execute(
+                "UPDATE repos SET expires = ? WHERE owner = ? AND state IN ('claimed', 'merging')", (expires, owner))
+            connection.execute("UPDATE chunks SET expires = ? WHERE owner = ? AND state = 'claimed'", (expires, owner))
+
+    def has_repos_to_prepare(self) -> bool:
+        """
+        Check if a repo can still be claimed: a discovery is running or a repo waits or is claimed.
+        """
+        if self.is_discovering():
+            return True
+        row = self.get_connection().execute(
+            "SELECT 1 FROM repos WHERE state IN ('pending', 'claimed') LIMIT 1").fetchone()
+        return row is not None
+
+    def is_finished(self) -> bool:
+        """
+        Check if no discovery is running and every repo is done or failed.
+        """
+        if self.is_discovering():
+            return False
+        row = self.get_connection().execute(
+            "SELECT 1 FROM repos WHERE state NOT IN ('done', 'failed') LIMIT 1").fetchone()
+        return row is None
@@ -0,0 +1,93 @@
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+from typing import Dict, List, Tuple
+from urllib.parse import urlparse
+
+import pytest
+
+
+class FakeGithub:
+    """
+    Local HTTP server answering the GitHub API calls of the repo search from an in-memory graph:
+    repos with their star counts and contributors, users with their starred repos.
+
+    Every request path is counted in hits. Responses queued in failures for a path are returned
+    before the real answer, so rate limits and server errors can be simulated. The clone urls of the repos
+    point to clone_root/<owner>/<name>.
+    """
+
+    def __init__(self, stars: Dict[str, int], contributors: Dict[str, List[str]],
+                 starred: Dict[str, List[str]]) -> None:
+        self.stars = stars
+        self.contributors = contributors
+        self.starred = starred
+        self.failures: Dict[str, List[Tuple[int, Dict[str, str]]]] = {}
+        self.clone_root = "/tmp"
+        self.hits = Counter()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.get_handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def get_repo(self, full_name: str) -> dict:
+        owner, name = full_name.split("/")
+        return {"id": sorted(self.stars).index(full_name), "name": name, "full_name": full_name,
+                "owner": {"login": owner, "url": f"{self.url}/users/{owner}"}, "url": f"{self.url}/repos/{full_name}",
+                "clone_url": f"file://{self.clone_root}/{full_name}", "stargazers_count": self.stars[full_name]}
+
+    def get_user(self, login: str) -> dict:
+        return {"login": login, "url": f"{self.url}/users/{login}"}
+
+    def answer(self, path: str) -> (int, Dict[str, str], object):
+        with self.lock:
+            self.hits[path] += 1
+            if self.failures.get(path):
+                status, headers = self.failures[path].pop(0)
+                return status, headers, {"message": "Simulated failure"}
+        parts = path.strip("/").split("/")
+        if parts[0] == "repos" and len(parts) == 3 and "/".join(parts[1:]) in self.stars:
+            return 200, {}, self.get_repo("/".join(parts[1:]))
+        if parts[0] == "repos" and len(parts) == 4 and parts[3] == "contributors":
+            return 200, {}, [self.get_user(login) for login in self.contributors.get("/".join(parts[1:3]), [])]
+        if parts[0] == "users" and len(parts) == 3 and parts[2] == "starred":
+            return 200, {}, [self.get_repo(full_name) for full_name in self.starred.get(parts[1], [])]
+        return 404, {}, {"message": "Not Found"}
+
+    def get_handler(self) -> type:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                status, headers, body = fake.answer(urlparse(self.path).path)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def __enter__(self) -> "FakeGithub":
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def fake_github() -> FakeGithub:
+    stars = {"o/a": 1, "o/b": 5, "o/c": 9, "o/d": 3, "o/e": 2}
+    contributors = {"o/a": ["u1", "u2"], "o/b": ["u1", "u3"], "o/c": ["u2"], "o/d": ["u3"]}
+    starred = {"u1": ["o/b", "o/c"], "u2": ["o/c", "o/d"], "u3": ["o/e", "o/a"]}
+    with FakeGithub(stars, contributors, starred) as server:
+        yield server
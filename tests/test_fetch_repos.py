@@ -0,0 +1,157 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from git import Actor, Repo
+from github import Github
+
+from similar_dev_search.cli_utils import fetch_repos
+from similar_dev_search.cli_utils.fetch_repos import discover_repos, iter_repos, mine_repos_pipeline
+from similar_dev_search.data.models import MiningOptions
+from similar_dev_search.services import git
+from similar_dev_search.services.cache import HttpCache
+from similar_dev_search.services.git import GithubService
+from similar_dev_search.services.work_queue import WorkQueue
+
+
+def find(server, max_depth: int = 2) -> [str]:
+    repos = iter_repos("o", "a", max_depth=max_depth, max_top_starred_repos=2, max_contributors=10,
+                       github_service=GithubService(server.url, max_retries=2), n_threads=2)
+    return [repo.full_name for repo in repos]
+
+
+def get_repos(*names: str, clone_root: str = "/tmp") -> [SimpleNamespace]:
+    return [SimpleNamespace(name=name, clone_url=f"file://{clone_root}/{name}") for name in names]
+
+
+def create_origins(clone_root, *names: str) -> None:
+    for name in names:
+        repo = Repo.init(clone_root / name, mkdir=True)
+        for number in range(2):
+            (clone_root / name / "notes.txt").write_text(f"note {number}\n" * (number + 1))
+            repo.index.add(["notes.txt"])
+            repo.index.commit(f"Note {number}", author=Actor(f"dev{number}", f"dev{number}@example.com"))
+
+
+def get_options(tmp_path) -> MiningOptions:
+    return MiningOptions(str(tmp_path / "build") + "/", str(tmp_path / "jsons") + "/", str(tmp_path / "parse.sqlite"),
+                         2 ** 20, state_path=str(tmp_path / "state") + "/")
+
+
+def run_pipeline(*args, **kwargs) -> dict:
+    result = {}
+
+    def run() -> None:
+        try:
+            result["counters"] = mine_repos_pipeline(*args, **kwargs)
+        except Exception as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(120)
+    assert not thread.is_alive(), "The pipeline hangs"
+    return result
+
+
+def not_walked():
+    raise AssertionError("The search was walked again")
+    yield
+
+
+def test_iter_repos_breadth_first(fake_github) -> None:
+    assert find(fake_github) == ["o/a", "o/c", "o/b", "o/d", "o/e"]
+    assert find(fake_github, max_depth=1) == ["o/a", "o/c", "o/b", "o/d"]
+
+
+def test_iter_repos_visits_users_once(fake_github) -> None:
+    find(fake_github)
+    for user in ["u1", "u2", "u3"]:
+        assert fake_github.hits[f"/users/{user}/starred"] == 1
+    for repo in ["o/a", "o/c", "o/b", "o/d"]:
+        assert fake_github.hits[f"/repos/{repo}/contributors"] == 1
+
+
+def test_iter_repos_retries_rate_limits_and_server_errors(fake_github, monkeypatch) -> None:
+    monkeypatch.setattr(git, "GITHUB_BACKOFF_SECONDS", 0)
+    fake_github.failures["/users/u2/starred"] = [(403, {"Retry-After": "0", "X-RateLimit-Remaining": "0"})]
+    fake_github.failures["/repos/o/b/contributors"] = [(502, {}), (503, {})]
+    assert find(fake_github) == ["o/a", "o/c", "o/b", "o/d", "o/e"]
+    assert fake_github.hits["/users/u2/starred"] == 2
+    assert fake_github.hits["/repos/o/b/contributors"] == 3
+
+
+def test_iter_repos_skips_failed_calls(fake_github, monkeypatch) -> None:
+    monkeypatch.setattr(git, "GITHUB_BACKOFF_SECONDS", 0)
+    fake_github.failures["/users/u1/starred"] = [(404, {})]
+    fake_github.failures["/repos/o/d/contributors"] = [(500, {})] * 3
+    assert find(fake_github) == ["o/a", "o/c", "o/d"]
+
+
+def test_clients_keep_their_connections(fake_github, tmp_path) -> None:
+    cached = GithubService(fake_github.url, cache=HttpCache(str(tmp_path / "cache.sqlite")))
+    cached.get_repo("o", "a")
+    cached.get_repo("o", "a")
+    assert fake_github.hits["/repos/o/a"] == 1
+    other = Github(base_url=fake_github.url)
+    other.get_repo("o/a")
+    other.get_repo("o/a")
+    assert fake_github.hits["/repos/o/a"] == 3
+
+
+def test_discover_repos_per_search(tmp_path) -> None:
+    work_queue = WorkQueue(str(tmp_path / "queue.sqlite"))
+    errors, stop = [], threading.Event()
+
+    def discover(repos, max_repos: int, username: str) -> None:
+        work_queue.start_discovery("owner")
+        discover_repos(repos, work_queue, "owner", max_repos, errors, stop, {"username": username})
+        assert not work_queue.is_discovering()
+
+    discover(iter(get_repos("a1", "a2", "a3", "a4")), 3, "a")
+    assert work_queue.count_repos() == 3
+    discover(iter(get_repos("b1", "a1", "b2", "b3")), 3, "b")
+    assert work_queue.count_repos() == 5
+    discover(not_walked(), 3, "a")
+    discover(iter(get_repos("a1", "a2", "a3", "a4")), 10, "a")
+    assert work_queue.count_repos() == 6
+    discover(not_walked(), 20, "a")
+    assert errors == []
+
+
+def test_pipeline_mines_a_new_search_on_a_finished_queue(fake_github, tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(fetch_repos, "QUEUE_POLL_SECONDS", 0.1)
+    fake_github.clone_root = tmp_path / "origins"
+    create_origins(fake_github.clone_root, "o/a", "o/b", "o/c", "o/d", "o/e")
+    work_queue = WorkQueue(str(tmp_path / "queue.sqlite"))
+    options = get_options(tmp_path)
+    repos_path = str(tmp_path / "repos") + "/"
+    assert run_pipeline(iter([]), 3, repos_path, options, work_queue, 2, 1, search={"seed": "none"}) == {"counters": {}}
+
+    def slow_search():
+        time.sleep(1)  # the preparers find no repos first
+        yield from iter_repos("o", "a", max_depth=2, max_top_starred_repos=2, max_contributors=10,
+                              github_service=GithubService(fake_github.url), n_threads=2)
+
+    result = run_pipeline(slow_search(), 3, repos_path, options, work_queue, 2, 1, search={"seed": "o/a"})
+    assert "error" not in result
+    assert work_queue.get_counts()["done"] == 3
+    assert sorted(path.name for path in (tmp_path / "jsons").iterdir()) == ["a.json", "b.json", "c.json"]
+
+
+def test_pipeline_raises_discovery_errors_with_a_full_plan_queue(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(fetch_repos, "QUEUE_POLL_SECONDS", 0.1)
+    monkeypatch.setattr(fetch_repos.MiningScheduler, "has_capacity", lambda self: False)
+    create_origins(tmp_path / "origins", "r1", "r2", "r3")
+    work_queue = WorkQueue(str(tmp_path / "queue.sqlite"))
+
+    def failing_search():
+        yield from get_repos("r1", "r2", "r3", clone_root=tmp_path / "origins")
+        time.sleep(2)  # the preparers fill the plan queue and wait for a free place
+        raise RuntimeError("Search failed")
+
+    result = run_pipeline(failing_search(), 10, str(tmp_path / "repos") + "/", get_options(tmp_path), work_queue,
+                          2, 1, queue_size=1)
+    assert isinstance(result.get("error"), RuntimeError)
+    assert work_queue.get_counts()["pending"] == 3
+    assert not work_queue.is_discovering()